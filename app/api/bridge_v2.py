@@ -4,15 +4,16 @@ from __future__ import annotations
 import os
 import time
 from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
 from contextlib import contextmanager
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from pydantic import BaseModel, Field
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine, Connection
-from sqlalchemy.pool import NullPool
+from app.services import fifo_queue, metrics
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine, Connection
 
 router = APIRouter(tags=["bridge_v2"])
 PFX = ("/profit/bridge", "/bridge")
@@ -37,34 +38,56 @@ def _sa_url(url: str) -> str:
         return url.replace("postgresql://", "postgresql+psycopg://", 1)
     return url
 
-# Создание движка
-if DATABASE_URL:
-    SA_URL = _sa_url(DATABASE_URL)
-    _engine: Engine = create_engine(
-        SA_URL,
-        future=True,
-        pool_pre_ping=True,
-        connect_args=PG_CONNECT_ARGS,
-        poolclass=NullPool,# <— ключ к решению DuplicatePreparedStatement
-        pool_recycle=1800,
-    )
-    DIALECT = _engine.dialect.name  # 'postgresql'
-else:
-    # SQLite fallback для локального запуска
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    _engine = create_engine(
-        f"sqlite+pysqlite:///{DB_PATH}",
-        future=True,
-        connect_args={"check_same_thread": False},
-    )
-    DIALECT = "sqlite"
-
+# Движок создаётся лениво, при первом запросе: импорт модуля не трогает БД и
+# не тянет SQLAlchemy, а кратковременно недоступная БД не роняет старт приложения.
+DIALECT = (DATABASE_URL.split(":", 1)[0].split("+", 1)[0] or "sqlite") if DATABASE_URL else "sqlite"
+if DIALECT == "postgres":
+    DIALECT = "postgresql"
 IS_PG = DIALECT.startswith("postgres")
 NOW_MS = lambda: int(time.time() * 1000)
 
+_engine: Optional["Engine"] = None
+
+def get_engine() -> "Engine":
+    global _engine
+    if _engine is None:
+        from sqlalchemy import create_engine
+        if DATABASE_URL:
+            from sqlalchemy.pool import NullPool
+            _engine = create_engine(
+                _sa_url(DATABASE_URL),
+                future=True,
+                pool_pre_ping=True,
+                connect_args=PG_CONNECT_ARGS,
+                poolclass=NullPool,# <— ключ к решению DuplicatePreparedStatement
+                pool_recycle=1800,
+            )
+        else:
+            # SQLite fallback для локального запуска
+            os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+            _engine = create_engine(
+                f"sqlite+pysqlite:///{DB_PATH}",
+                future=True,
+                connect_args={"check_same_thread": False, "timeout": 30},
+            )
+            # несколько воркеров пишут в один файл: WAL + ожидание блокировки вместо "database is locked"
+            from sqlalchemy import event
+
+            @event.listens_for(_engine, "connect")
+            def _sqlite_pragmas(dbapi_con, _rec):
+                dbapi_con.execute("PRAGMA journal_mode=WAL")
+                dbapi_con.execute("PRAGMA busy_timeout=30000")
+        metrics.instrument_engine(_engine, "bridge_v2")
+    return _engine
+
+def text(sql: str):
+    """sqlalchemy.text с отложенным импортом SQLAlchemy."""
+    from sqlalchemy import text as _sa_text
+    return _sa_text(sql)
+
 @contextmanager
-def db() -> Iterable[Connection]:
-    with _engine.begin() as con:
+def db() -> Iterable["Connection"]:
+    with get_engine().begin() as con:
         yield con
 
 def require_api_key(request: Request) -> bool:
@@ -84,81 +107,7 @@ def require_api_key(request: Request) -> bool:
         raise HTTPException(status_code=401, detail="Invalid API key")
     return True
 
-# ──────────────────────────────────────────────────────────────────────────────
-# Инициализация таблиц
-# ──────────────────────────────────────────────────────────────────────────────
-def _init_bridge_tables() -> None:
-    with _engine.begin() as con:
-        if IS_PG:
-            con.execute(text("""
-                CREATE TABLE IF NOT EXISTS public.batches (
-                  id             bigserial PRIMARY KEY,
-                  sku            text NOT NULL,
-                  unit_cost      numeric NOT NULL DEFAULT 0,
-                  commission_pct numeric NOT NULL DEFAULT 0,
-                  date           date,
-                  created_at     timestamptz NOT NULL DEFAULT now()
-                )
-            """))
-            con.execute(text("CREATE INDEX IF NOT EXISTS idx_batches_sku ON public.batches(sku)"))
-
-            con.execute(text("""
-                CREATE TABLE IF NOT EXISTS public.bridge_lines(
-                  order_id     text NOT NULL,
-                  order_code   text,
-                  state        text,
-                  date_utc_ms  bigint,
-                  sku          text,
-                  title        text,
-                  qty          integer DEFAULT 1,
-                  unit_price   double precision DEFAULT 0,
-                  total_price  double precision DEFAULT 0,
-                  line_index   integer NOT NULL,
-                  created_at   bigint,
-                  updated_at   bigint,
-                  PRIMARY KEY(order_id, line_index)
-                )
-            """))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_date  ON public.bridge_lines(date_utc_ms)"))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_state ON public.bridge_lines(state)"))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_sku   ON public.bridge_lines(sku)"))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_code  ON public.bridge_lines(order_code)"))
-        else:
-            con.execute(text("""
-                CREATE TABLE IF NOT EXISTS batches (
-                  id             integer PRIMARY KEY AUTOINCREMENT,
-                  sku            text NOT NULL,
-                  unit_cost      real NOT NULL DEFAULT 0,
-                  commission_pct real NOT NULL DEFAULT 0,
-                  date           text,
-                  created_at     integer NOT NULL DEFAULT 0
-                )
-            """))
-            con.execute(text("CREATE INDEX IF NOT EXISTS idx_batches_sku ON batches(sku)"))
-
-            con.execute(text("""
-                CREATE TABLE IF NOT EXISTS bridge_lines(
-                  order_id     text NOT NULL,
-                  order_code   text,
-                  state        text,
-                  date_utc_ms  integer,
-                  sku          text,
-                  title        text,
-                  qty          integer DEFAULT 1,
-                  unit_price   real DEFAULT 0,
-                  total_price  real DEFAULT 0,
-                  line_index   integer NOT NULL,
-                  created_at   integer,
-                  updated_at   integer,
-                  PRIMARY KEY(order_id, line_index)
-                )
-            """))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_date  ON bridge_lines(date_utc_ms)"))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_state ON bridge_lines(state)"))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_sku   ON bridge_lines(sku)"))
-            con.execute(text("CREATE INDEX IF NOT EXISTS ix_lines_code  ON bridge_lines(order_code)"))
-
-_init_bridge_tables()
+# Схема bridge_lines — см. migrations/ (применяется один раз при старте)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Модели
@@ -241,6 +190,25 @@ def _canon_sku(s: Optional[str]) -> Optional[str]:
 # ──────────────────────────────────────────────────────────────────────────────
 # Себестоимость / комиссия
 # ──────────────────────────────────────────────────────────────────────────────
+def _lines_by_order(con: Connection, order_ids: Iterable[str]) -> Dict[Tuple[str, int], tuple]:
+    """Текущие строки заказов: (order_id, line_index) → поля, влияющие на FIFO."""
+    ids = sorted(order_ids)
+    if not ids:
+        return {}
+    from sqlalchemy import bindparam
+    sql = text("""
+        SELECT order_id, line_index, order_code, state, date_utc_ms, sku, qty, unit_price, total_price
+          FROM bridge_lines
+         WHERE order_id IN :ids
+    """).bindparams(bindparam("ids", expanding=True))
+    out: Dict[Tuple[str, int], tuple] = {}
+    for r in con.execute(sql, {"ids": ids}).mappings():
+        out[(r["order_id"], int(r["line_index"]))] = (
+            r["order_code"], r["state"], r["date_utc_ms"], r["sku"], r["qty"],
+            float(r["unit_price"] or 0.0), float(r["total_price"] or 0.0),
+        )
+    return out
+
 def _latest_batch(con: Connection, sku: str) -> Optional[Dict[str, Any]]:
     if IS_PG:
         row = con.execute(text("""
@@ -309,6 +277,83 @@ def ping(_: bool = Depends(require_api_key)):
             cat = 0
     return {"ok": True, "dialect": DIALECT, "bridge_lines": int(c), "batches": int(b), "categories": int(cat), "ts": NOW_MS()}
 
+# upsert строк bridge_lines по (order_id, line_index)
+_UPSERT_PG = """
+    INSERT INTO bridge_lines
+      (order_id, order_code, state, date_utc_ms, sku, title, qty, unit_price, total_price, line_index, created_at, updated_at)
+    VALUES
+      (:order_id, :order_code, :state, :date_utc_ms, :sku, :title, :qty, :unit_price, :total_price, :line_index, :created_at, :updated_at)
+    ON CONFLICT (order_id, line_index) DO UPDATE SET
+      order_code = EXCLUDED.order_code,
+      state      = EXCLUDED.state,
+      date_utc_ms= EXCLUDED.date_utc_ms,
+      sku        = EXCLUDED.sku,
+      title      = EXCLUDED.title,
+      qty        = EXCLUDED.qty,
+      unit_price = EXCLUDED.unit_price,
+      total_price= EXCLUDED.total_price,
+      updated_at = EXCLUDED.updated_at
+"""
+
+_UPSERT_SQLITE = """
+    INSERT INTO bridge_lines
+      (order_id, order_code, state, date_utc_ms, sku, title, qty, unit_price, total_price, line_index, created_at, updated_at)
+    VALUES
+      (:order_id, :order_code, :state, :date_utc_ms, :sku, :title, :qty, :unit_price, :total_price, :line_index, :created_at, :updated_at)
+    ON CONFLICT(order_id, line_index) DO UPDATE SET
+      order_code = excluded.order_code,
+      state      = excluded.state,
+      date_utc_ms= excluded.date_utc_ms,
+      sku        = excluded.sku,
+      title      = excluded.title,
+      qty        = excluded.qty,
+      unit_price = excluded.unit_price,
+      total_price= excluded.total_price,
+      updated_at = excluded.updated_at
+"""
+
+_LINE_FIELDS = ("order_code", "state", "date_utc_ms", "sku", "qty", "unit_price", "total_price")
+
+def upsert_lines(con: Connection, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Upsert нормализованных строк (ключи — колонки bridge_lines) в транзакции вызывающего.
+    SKU строк, изменившихся для FIFO, ставятся в fifo_queue. Общий путь для sync-by-ids и
+    серверной загрузки из Kaspi (app/services/bridge_ingest.py).
+    """
+    if not rows:
+        return {"written": 0, "changed": 0, "fifo_queued": 0}
+    now_ms = NOW_MS()
+    prev = _lines_by_order(con, {r["order_id"] for r in rows})
+    events: List[fifo_queue.Event] = []
+    changed = 0
+    for r in rows:
+        # FIFO переигрывается только по SKU строк, которые действительно изменились
+        old = prev.get((r["order_id"], int(r["line_index"])))
+        new = tuple(r[k] for k in _LINE_FIELDS)
+        if old == new:
+            continue
+        changed += 1
+        date_ms, sku = r["date_utc_ms"], r["sku"]
+        events.append((sku, date_ms if date_ms is not None else 0, None))
+        if old is not None and old[3] and old[3] != sku:
+            events.append((old[3], old[2] if old[2] is not None else 0, None))
+        elif old is not None and old[2] is not None and date_ms is not None and old[2] < date_ms:
+            events.append((sku, old[2], None))
+    con.execute(text(_UPSERT_PG if IS_PG else _UPSERT_SQLITE),
+                [dict(r, created_at=now_ms, updated_at=now_ms) for r in rows])
+    return {"written": len(rows), "changed": changed, "fifo_queued": fifo_queue.enqueue(con, events)}
+
+def delete_orders(con: Connection, order_ids: Iterable[str]) -> Dict[str, int]:
+    """Удаляет строки заказов (заказ ушёл в исключённый статус); их SKU — в fifo_queue."""
+    prev = _lines_by_order(con, order_ids)
+    if not prev:
+        return {"deleted": 0, "fifo_queued": 0}
+    from sqlalchemy import bindparam
+    con.execute(text("DELETE FROM bridge_lines WHERE order_id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                {"ids": sorted({oid for oid, _ in prev})})
+    events: List[fifo_queue.Event] = [(v[3], v[2] if v[2] is not None else 0, None) for v in prev.values()]
+    return {"deleted": len(prev), "fifo_queued": fifo_queue.enqueue(con, events)}
+
 @router.post(f"{PFX[0]}/sync-by-ids")
 @router.post(f"{PFX[1]}/sync-by-ids")
 def sync_by_ids(items: List[BridgeLineIn], _: bool = Depends(require_api_key)):
@@ -317,42 +362,10 @@ def sync_by_ids(items: List[BridgeLineIn], _: bool = Depends(require_api_key)):
         return {"inserted": 0, "updated": 0, "skipped": 0}
 
     counters: Dict[str, int] = {}
-    now_ms = NOW_MS()
-
-    upsert_sql = text("""
-        INSERT INTO bridge_lines
-          (order_id, order_code, state, date_utc_ms, sku, title, qty, unit_price, total_price, line_index, created_at, updated_at)
-        VALUES
-          (:order_id, :order_code, :state, :date_utc_ms, :sku, :title, :qty, :unit_price, :total_price, :line_index, :created_at, :updated_at)
-        ON CONFLICT (order_id, line_index) DO UPDATE SET
-          order_code = EXCLUDED.order_code,
-          state      = EXCLUDED.state,
-          date_utc_ms= EXCLUDED.date_utc_ms,
-          sku        = EXCLUDED.sku,
-          title      = EXCLUDED.title,
-          qty        = EXCLUDED.qty,
-          unit_price = EXCLUDED.unit_price,
-          total_price= EXCLUDED.total_price,
-          updated_at = EXCLUDED.updated_at
-    """) if IS_PG else text("""
-        INSERT INTO bridge_lines
-          (order_id, order_code, state, date_utc_ms, sku, title, qty, unit_price, total_price, line_index, created_at, updated_at)
-        VALUES
-          (:order_id, :order_code, :state, :date_utc_ms, :sku, :title, :qty, :unit_price, :total_price, :line_index, :created_at, :updated_at)
-        ON CONFLICT(order_id, line_index) DO UPDATE SET
-          order_code = excluded.order_code,
-          state      = excluded.state,
-          date_utc_ms= excluded.date_utc_ms,
-          sku        = excluded.sku,
-          title      = excluded.title,
-          qty        = excluded.qty,
-          unit_price = excluded.unit_price,
-          total_price= excluded.total_price,
-          updated_at = excluded.updated_at
-    """)
 
     updated = 0
     skipped = 0
+    rows: List[Dict[str, Any]] = []
     with db() as con:
         for it in items:
             oid = (it.id or "").strip()
@@ -400,16 +413,18 @@ def sync_by_ids(items: List[BridgeLineIn], _: bool = Depends(require_api_key)):
                 line_index = counters.get(oid, 0)
                 counters[oid] = line_index + 1
 
-            con.execute(upsert_sql, {
+            rows.append({
                 "order_id": oid, "order_code": order_code, "state": state, "date_utc_ms": date_ms,
                 "sku": sku, "title": title, "qty": qty, "unit_price": unit, "total_price": total,
-                "line_index": line_index, "created_at": now_ms, "updated_at": now_ms
+                "line_index": line_index,
             })
             updated += 1
 
+        res = upsert_lines(con, rows)
+
     processed = len(items) - skipped
     inserted = max(0, processed - updated)  # точное различение не делаем — упрощённая метрика
-    return {"inserted": inserted, "updated": updated, "skipped": skipped}
+    return {"inserted": inserted, "updated": updated, "skipped": skipped, "fifo_queued": res["fifo_queued"]}
 
 def _collect_orders(where_sql: str, params: Dict[str, Any], order_dir: str) -> OrdersResponse:
     with db() as con:
@@ -7,39 +7,28 @@ from fastapi.responses import Response, FileResponse
 from pydantic import BaseModel
 from contextlib import contextmanager
 from dataclasses import asdict, is_dataclass, dataclass
+import asyncio
 import io
 import os
 import shutil
 import sqlite3
 import datetime as _dt
 
+from app.services import cpu_pool, fifo_queue, metrics, migrations, sku_summary
+
 # ──────────────────────────────────────────────────────────────────────────────
-# optional deps
+# optional deps: openpyxl / requests / SQLAlchemy импортируются лениво,
+# только когда реально нужны (Excel пришёл, XML-фид включён, PG настроен)
 # ──────────────────────────────────────────────────────────────────────────────
-try:
-    import openpyxl
-    _OPENPYXL_OK = True
-except Exception:
-    _OPENPYXL_OK = False
-
-try:
-    import requests  # для XML-фида Kaspi
-    _REQ_OK = True
-except Exception:
-    _REQ_OK = False
+import importlib.util as _ilu
+
+_SQLA_OK = _ilu.find_spec("sqlalchemy") is not None
 
 # ──────────────────────────────────────────────────────────────────────────────
 # DB backends (PG via SQLAlchemy / fallback SQLite)
 # ──────────────────────────────────────────────────────────────────────────────
 CONNECT_ARGS = {"prepare_threshold": None}
 
-
-try:
-    from sqlalchemy import create_engine, text
-    _SQLA_OK = True
-except Exception:
-    _SQLA_OK = False
-
 DATABASE_URL = (os.getenv("DATABASE_URL") or "").strip()  # PG URL из окружения
 # psycopg3: полностью отключаем server-side prepared statements
 
@@ -67,33 +56,51 @@ def _resolve_db_path() -> str:
 
 DB_PATH = _resolve_db_path()
 
-# migrate old local file if path changed
 _OLD_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data.sqlite3"))
-if DB_PATH != _OLD_PATH and os.path.exists(_OLD_PATH) and not os.path.exists(DB_PATH):
-    try:
-        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-        shutil.copy2(_OLD_PATH, DB_PATH)
-    except Exception:
-        pass
+_storage_ready = False
+
+def init_storage() -> None:
+    """
+    Подготовка локального хранилища (вызывается из lifespan, до миграций):
+    переносит старый app/data.sqlite3 в DB_PATH, если путь сменился.
+    """
+    global _storage_ready
+    if _storage_ready:
+        return
+    _storage_ready = True
+    if _USE_PG:
+        return
+    if DB_PATH != _OLD_PATH and os.path.exists(_OLD_PATH) and not os.path.exists(DB_PATH):
+        try:
+            os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+            shutil.copy2(_OLD_PATH, DB_PATH)
+        except Exception:
+            pass
+
+# Движок PG создаётся при первом обращении. Для SQLite движок не нужен — открываем вручную в _db().
+_engine = None
+
+def _get_engine():
+    global _engine
+    if _engine is None:
+        from sqlalchemy import create_engine
+        _engine = metrics.instrument_engine(create_engine(
+            _sa_url(DATABASE_URL),
+            pool_pre_ping=True,
+            future=True,
+            connect_args=CONNECT_ARGS,
+        ), "products")
+    return _engine
 
-# Создаём движок PG (если он нужен). Для SQLite движок не нужен — открываем вручную в _db().
-if _USE_PG:
-    _engine = create_engine(
-        _sa_url(DATABASE_URL),
-        pool_pre_ping=True,
-        future=True,
-        connect_args=CONNECT_ARGS,
-    )
-else:
-    _engine = None  # для SQLite используем _db() с sqlite3
-    
 @contextmanager
 def _db():
     if _USE_PG:
-        with _engine.begin() as conn:
+        with _get_engine().begin() as conn:
             yield conn
     else:
-        conn = sqlite3.connect(DB_PATH)
+        init_storage()
+        # WAL включается миграциями (persist в файле); timeout — ждать писателя из соседнего воркера
+        conn = sqlite3.connect(DB_PATH, timeout=30, factory=metrics.sqlite_factory("products"))
         conn.row_factory = sqlite3.Row
         try:
             yield conn
@@ -105,7 +112,10 @@ def _db():
             conn.close()
 
 def _q(sql: str):
-    return text(sql) if _USE_PG else sql
+    if _USE_PG:
+        from sqlalchemy import text
+        return text(sql)
+    return sql
 
 def _rows_to_dicts(rows):
     if _USE_PG:
@@ -209,153 +219,45 @@ def _sku_of(row: dict) -> str:
     return _norm_sku(raw)
 
 # ──────────────────────────────────────────────────────────────────────────────
-# Schema & migrations
+# Schema: см. migrations/ (применяются один раз при старте, app.services.migrations)
+# ──────────────────────────────────────────────────────────────────────────────
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Per-SKU inventory summary (поддерживается инкрементально)
 # ──────────────────────────────────────────────────────────────────────────────
-def _ensure_schema():
+def _refresh_sku_summary(c, skus: Optional[List[str]] = None) -> None:
+    """
+    Пересчитывает строки sku_inventory_summary только для переданных SKU
+    (по индексу idx_batches_sku). skus=None → полный пересчёт (бэкфилл).
+    SKU без партий из сводки удаляются.
+    """
+    if skus is None:
+        c.execute(_q("DELETE FROM sku_inventory_summary WHERE sku NOT IN (SELECT sku FROM batches)"))
+        c.execute(_q(sku_summary.upsert_sql(pg=_USE_PG)))
+        return
+
+    uniq = sorted({s for s in skus if s})
+    if not uniq:
+        return
     if _USE_PG:
-        with _db() as c:
-            c.execute(_q("""
-            CREATE TABLE IF NOT EXISTS products(
-                sku TEXT PRIMARY KEY,
-                name TEXT,
-                brand TEXT,
-                category TEXT,
-                price DOUBLE PRECISION,
-                quantity INTEGER,
-                active INTEGER DEFAULT 1,
-                barcode TEXT,
-                updated_at TIMESTAMP DEFAULT NOW()
-            );"""))
-            c.execute(_q("""
-            CREATE TABLE IF NOT EXISTS batches(
-                id SERIAL PRIMARY KEY,
-                sku TEXT NOT NULL REFERENCES products(sku) ON DELETE CASCADE,
-                date DATE NOT NULL,
-                qty INTEGER NOT NULL,
-                unit_cost DOUBLE PRECISION NOT NULL,
-                note TEXT,
-                commission_pct DOUBLE PRECISION,
-                batch_code TEXT UNIQUE,
-                qty_sold INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT NOW()
-            );"""))
-            c.execute(_q("""
-            CREATE TABLE IF NOT EXISTS categories(
-                name TEXT PRIMARY KEY,
-                base_percent DOUBLE PRECISION DEFAULT 0.0,
-                extra_percent DOUBLE PRECISION DEFAULT 3.0,
-                tax_percent DOUBLE PRECISION DEFAULT 0.0
-            );"""))
-            c.execute(_q("CREATE INDEX IF NOT EXISTS idx_batches_sku ON batches(sku)"))
-            c.execute(_q("CREATE INDEX IF NOT EXISTS idx_batches_date ON batches(date)"))
-
-            if not _has_column(c, "batches", "qty_sold"):
-                c.execute(_q("ALTER TABLE batches ADD COLUMN qty_sold INTEGER DEFAULT 0"))
-
-            # cleanup dupes (safety)
-            dup = c.execute(_q("""SELECT sku, COUNT(*) AS c
-                                  FROM products GROUP BY sku HAVING COUNT(*)>1""")).all()
-            if dup:
-                c.execute(_q("""
-                    DELETE FROM products p USING (
-                        SELECT ctid, sku, row_number() OVER (PARTITION BY sku ORDER BY updated_at NULLS LAST) AS rn
-                        FROM products
-                    ) t
-                    WHERE p.ctid=t.ctid AND t.rn>1
-                """))
+        placeholders = ", ".join([f":s{i}" for i in range(len(uniq))])
+        params: Any = {f"s{i}": s for i, s in enumerate(uniq)}
     else:
-        with _db() as c:
-            c.executescript("""
-            PRAGMA journal_mode=WAL;
-
-            CREATE TABLE IF NOT EXISTS products(
-                sku TEXT PRIMARY KEY,
-                name TEXT,
-                brand TEXT,
-                category TEXT,
-                price REAL,
-                quantity INTEGER,
-                active INTEGER DEFAULT 1,
-                barcode TEXT,
-                updated_at TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS batches(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sku TEXT NOT NULL,
-                date TEXT NOT NULL,
-                qty INTEGER NOT NULL,
-                unit_cost REAL NOT NULL,
-                note TEXT,
-                commission_pct REAL,
-                batch_code TEXT UNIQUE,
-                qty_sold INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            );
-
-            CREATE TABLE IF NOT EXISTS categories(
-                name TEXT PRIMARY KEY,
-                base_percent REAL DEFAULT 0.0,
-                extra_percent REAL DEFAULT 3.0,
-                tax_percent REAL DEFAULT 0.0
-            );
-
-            CREATE INDEX IF NOT EXISTS idx_batches_sku ON batches(sku);
-            CREATE INDEX IF NOT EXISTS idx_batches_date ON batches(date);
-            """)
-            cols = {r["name"] for r in c.execute("PRAGMA table_info(batches)")}
-
-            if "commission_pct" not in cols:
-                c.execute("ALTER TABLE batches ADD COLUMN commission_pct REAL")
-            if "qty_sold" not in cols:
-                c.execute("ALTER TABLE batches ADD COLUMN qty_sold INTEGER DEFAULT 0")
-            if "batch_code" not in cols:
-                c.execute("ALTER TABLE batches ADD COLUMN batch_code TEXT")
-
-            # generate missing codes
-            for r in c.execute("SELECT id FROM batches WHERE batch_code IS NULL OR batch_code=''").fetchall():
-                c.execute("UPDATE batches SET batch_code=? WHERE id=?", (_gen_batch_code(), r["id"]))
-
-            # ensure sku uniqueness
-            c.executescript("""
-                DELETE FROM products
-                 WHERE rowid NOT IN (SELECT MIN(rowid) FROM products GROUP BY sku);
-            """)
-            _commit(c)
-
-def _seed_categories_if_empty():
-    _ensure_schema()
-    with _db() as c:
-        if _USE_PG:
-            cnt = c.execute(_q("SELECT COUNT(*) AS c FROM categories")).scalar_one()
-        else:
-            cnt = c.execute("SELECT COUNT(*) AS c FROM categories").fetchone()["c"]
-        if int(cnt) == 0:
-            defaults = [
-                ("Витамины/БАДы", 10.0, 3.0, 0.0),
-                ("Сад/освещение", 10.0, 3.0, 0.0),
-                ("Товары для дома", 10.0, 3.0, 0.0),
-                ("Прочее", 10.0, 3.0, 0.0),
-            ]
-            if _USE_PG:
-                for n,b,e,t in defaults:
-                    c.execute(_q("""
-                        INSERT INTO categories(name,base_percent,extra_percent,tax_percent)
-                        VALUES(:n,:b,:e,:t)
-                        ON CONFLICT (name) DO NOTHING
-                    """), {"n": n, "b": b, "e": e, "t": t})
-            else:
-                c.executemany(
-                    "INSERT OR IGNORE INTO categories(name,base_percent,extra_percent,tax_percent) VALUES(?,?,?,?)",
-                    defaults
-                )
-                _commit(c)
+        placeholders = ", ".join(["?"] * len(uniq))
+        params = uniq
+    c.execute(_q(sku_summary.upsert_sql(f"WHERE b.sku IN ({placeholders})", pg=_USE_PG)), params)
+    c.execute(_q(f"""
+        DELETE FROM sku_inventory_summary
+         WHERE sku IN ({placeholders})
+           AND NOT EXISTS (SELECT 1 FROM batches b WHERE b.sku = sku_inventory_summary.sku)
+    """), params)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # UPSERT & SYNC
 # ──────────────────────────────────────────────────────────────────────────────
 def _upsert_products(items: List[Dict[str, Any]], *, price_only: bool = True) -> Tuple[int, int]:
-    _ensure_schema()
+    # весь файл — одна транзакция (коммит при выходе из _db), как и на PG: коммит на строку
+    # в SQLite — fsync на каждую из тысяч строк
     inserted = updated = 0
     po = 1 if price_only else 0
 
@@ -415,7 +317,6 @@ def _upsert_products(items: List[Dict[str, Any]], *, price_only: bool = True) ->
                 """, (params["sku"], params["name"], params["brand"], params["category"],
                       params["price"], params["quantity"], params["active"], params["barcode"],
                       po, po))
-                _commit(c)
 
             if existed: updated += 1
             else: inserted += 1
@@ -453,21 +354,26 @@ def _deactivate_missing(keep_skus: List[str]) -> int:
             return n
 
 def _delete_missing(keep_skus: List[str]) -> int:
+    # партии удаляются каскадом вместе с товаром — сводку склада по этим SKU пересчитываем
+    # в той же транзакции, иначе stock-value продолжит считать их себестоимость
     if not keep_skus:
         return 0
     with _db() as c:
         if _USE_PG:
             placeholders = ", ".join([f":s{i}" for i in range(len(keep_skus))])
-            sql = _q(f"DELETE FROM products WHERE sku NOT IN ({placeholders})")
             params = {f"s{i}": s for i, s in enumerate(keep_skus)}
-            r = c.execute(sql, params)
-            return r.rowcount or 0
+            gone = [r._mapping["sku"] for r in c.execute(
+                _q(f"DELETE FROM products WHERE sku NOT IN ({placeholders}) RETURNING sku"), params)]
+            _refresh_sku_summary(c, gone)
+            return len(gone)
         else:
             placeholders = ", ".join(["?"] * len(keep_skus))
-            r = c.execute(f"DELETE FROM products WHERE sku NOT IN ({placeholders})", keep_skus)
-            n = r.rowcount or 0
+            gone = [r["sku"] for r in c.execute(
+                f"SELECT sku FROM products WHERE sku NOT IN ({placeholders})", keep_skus).fetchall()]
+            c.execute(f"DELETE FROM products WHERE sku NOT IN ({placeholders})", keep_skus)
+            _refresh_sku_summary(c, gone)
             _commit(c)
-            return n
+            return len(gone)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Parsers (Kaspi XML / Excel)
@@ -529,7 +435,9 @@ def _parse_xml_smart(raw: bytes, *, city_id: str) -> List[Dict[str, Any]]:
     return list(rows.values())
 
 def _parse_excel_smart(raw: bytes) -> List[Dict[str, Any]]:
-    if not _OPENPYXL_OK:
+    try:
+        import openpyxl
+    except ImportError:
         raise HTTPException(500, "openpyxl не установлен на сервере.")
     try:
         wb = openpyxl.load_workbook(io.BytesIO(raw), read_only=True, data_only=True)
@@ -646,6 +554,13 @@ def _smart_import_bytes(filename: str, content: bytes, *, city_id: str) -> List[
     cleaned, _ = _dedupe(items)
     return cleaned
 
+
+async def _parse_upload(file: UploadFile, city_id: str) -> List[Dict[str, Any]]:
+    """Читает загруженный файл и разбирает его (_smart_import_bytes)."""
+    raw = await file.read()
+    # разбор файла — CPU: через cpu_pool (процесс пула, без пула — поток), не в event loop
+    return await cpu_pool.run(_smart_import_bytes, file.filename or "", raw, city_id=city_id)
+
 def _sync_with_file(
     items: List[Dict[str,Any]],
     *, mode: str = "replace",
@@ -708,7 +623,9 @@ def _fetch_kaspi_items_via_xml() -> Tuple[List[Dict[str,Any]], str]:
     url = os.getenv("KASPI_PRICE_XML_URL") or ""
     if not url:
         return [], "disabled:no-url"
-    if not _REQ_OK:
+    try:
+        import requests
+    except ImportError:
         raise HTTPException(500, "Для KASPI_PRICE_XML_URL требуется пакет 'requests'. Установите его в образ.")
     try:
         r = requests.get(url, timeout=60)
@@ -716,7 +633,7 @@ def _fetch_kaspi_items_via_xml() -> Tuple[List[Dict[str,Any]], str]:
     except Exception as e:
         raise HTTPException(502, f"Не удалось скачать XML-фид Kaspi: {e}")
     city_id = os.getenv("KASPI_CITY_ID", "196220100")
-    items = _parse_xml_smart(r.content, city_id=city_id)
+    items = cpu_pool.run_sync(_parse_xml_smart, r.content, city_id=city_id)
     items, _ = _dedupe(items)
     return items, f"xml:{url}"
 
@@ -796,8 +713,16 @@ class BatchListIn(BaseModel):
 # ──────────────────────────────────────────────────────────────────────────────
 # FIFO recount helper
 # ──────────────────────────────────────────────────────────────────────────────
+def _batch_date(c, sku: str, bid: int) -> Optional[str]:
+    if _USE_PG:
+        r = c.execute(_q("SELECT date FROM batches WHERE id=:bid AND sku=:sku"), {"bid": bid, "sku": sku}).first()
+        v = r._mapping["date"] if r else None
+    else:
+        r = c.execute("SELECT date FROM batches WHERE id=? AND sku=?", (bid, sku)).fetchone()
+        v = r["date"] if r else None
+    return str(v)[:10] if v else None
+
 def _recount_qty_sold_from_ledger() -> int:
-    _ensure_schema()
     updated = 0
     with _db() as c:
         ledgers = ["profit_fifo_ledger", "fifo_ledger", "ledger_fifo"]
@@ -821,6 +746,7 @@ def _recount_qty_sold_from_ledger() -> int:
                 ), {"v": int(val), "bid": int(bid)})
                 updated += (r.rowcount or 0)
             c.execute(_q("UPDATE batches SET qty_sold = qty WHERE qty_sold > qty"))
+            _refresh_sku_summary(c)
         else:
             rows = c.execute(
                 f"SELECT {batch_col} AS bid, SUM({qty_col}) AS used FROM {ledger} GROUP BY {batch_col}"
@@ -834,6 +760,7 @@ def _recount_qty_sold_from_ledger() -> int:
                 )
                 updated += cur.rowcount or 0
             c.execute("UPDATE batches SET qty_sold = qty WHERE qty_sold > qty")
+            _refresh_sku_summary(c)
             _commit(c)
     return updated
 
@@ -841,7 +768,6 @@ def _recount_qty_sold_from_ledger() -> int:
 # Local DB listings helper (fix active filter)
 # ──────────────────────────────────────────────────────────────────────────────
 def list_from_db(*, active: Optional[bool], limit: int = 1000, offset: int = 0, search: str = "") -> List[Dict[str, Any]]:
-    _ensure_schema()
     with _db() as c:
         if _USE_PG:
             sql = "SELECT sku, name, brand, category, price, quantity, active FROM products"
@@ -887,7 +813,6 @@ def get_products_router(*_, **__) -> APIRouter:
     # Ping
     @router.get("/db/ping")
     async def db_ping():
-        _ensure_schema()
         if _USE_PG:
             with _db() as c:
                 c.execute(_q("SELECT 1"))
@@ -905,102 +830,67 @@ def get_products_router(*_, **__) -> APIRouter:
         page: int = Query(1, ge=1),
         page_size: int = Query(200, ge=1, le=100_000),
     ):
-        _ensure_schema()
-        _seed_categories_if_empty()
-
-        # categories
-        with _db() as c:
-            if _USE_PG:
-                cats_rows = c.execute(_q(
-                    "SELECT name, base_percent, extra_percent, tax_percent FROM categories ORDER BY name"
-                )).all()
-                cats = {r._mapping["name"]: dict(r._mapping) for r in cats_rows}
-            else:
-                rows = c.execute(
-                    "SELECT name,base_percent,extra_percent,tax_percent FROM categories ORDER BY name COLLATE NOCASE"
-                ).fetchall()
-                cats = {r["name"]: dict(r) for r in rows}
-
-        # products
+        # один индексированный запрос на страницу: products ⋈ summary ⋈ categories
         offset = (page - 1) * page_size
+        base_sql = """
+            SELECT p.sku, p.name, p.brand, p.category, p.price, p.quantity, p.active,
+                   s.batch_count, s.left_qty, s.last_unit_cost, s.last_commission_pct,
+                   cat.base_percent, cat.extra_percent, cat.tax_percent
+              FROM products p
+         LEFT JOIN sku_inventory_summary s ON s.sku = p.sku
+         LEFT JOIN categories cat ON cat.name = p.category
+        """
         with _db() as c:
             if _USE_PG:
-                sql = "SELECT sku,name,brand,category,price,quantity,active FROM products"
+                sql = base_sql
                 conds, params = [], {}
                 if active_only:
-                    conds.append("active=1")
+                    conds.append("p.active=1")
                 if search:
-                    conds.append("(sku ILIKE :q OR name ILIKE :q)")
+                    conds.append("(p.sku ILIKE :q OR p.name ILIKE :q)")
                     params["q"] = f"%{search}%"
                 if conds:
                     sql += " WHERE " + " AND ".join(conds)
-                sql += " ORDER BY name LIMIT :lim OFFSET :off"
+                sql += " ORDER BY p.name LIMIT :lim OFFSET :off"
                 params.update({"lim": page_size, "off": offset})
                 rows = _rows_to_dicts(c.execute(_q(sql), params).all())
             else:
-                sql = "SELECT sku,name,brand,category,price,quantity,active FROM products"
+                sql = base_sql
                 conds, params = [], []
                 if active_only:
-                    conds.append("active=1")
+                    conds.append("p.active=1")
                 if search:
-                    conds.append("(sku LIKE ? OR name LIKE ?)")
+                    conds.append("(p.sku LIKE ? OR p.name LIKE ?)")
                     params += [f"%{search}%", f"%{search}%"]
                 if conds:
                     sql += " WHERE " + " AND ".join(conds)
-                sql += " ORDER BY name COLLATE NOCASE LIMIT ? OFFSET ?"
+                sql += " ORDER BY p.name COLLATE NOCASE LIMIT ? OFFSET ?"
                 params += [page_size, offset]
                 rows = [dict(r) for r in c.execute(sql, params).fetchall()]
 
-        # meta by batches
-        with _db() as c:
-            if _USE_PG:
-                bc_rows = c.execute(_q("SELECT sku, COUNT(*) AS cnt FROM batches GROUP BY sku")).all()
-                bc = {r._mapping["sku"]: r._mapping["cnt"] for r in bc_rows}
-                last_rows = c.execute(_q(
-                    "SELECT DISTINCT ON (sku) sku, unit_cost, commission_pct FROM batches ORDER BY sku, date DESC, id DESC"
-                )).all()
-                last = {r._mapping["sku"]: (r._mapping["unit_cost"], r._mapping["commission_pct"]) for r in last_rows}
-                left_rows = c.execute(_q(
-                    "SELECT sku, SUM(qty - COALESCE(qty_sold,0)) AS left FROM batches GROUP BY sku"
-                )).all()
-                left_by_sku = {r._mapping["sku"]: int(r._mapping["left"] or 0) for r in left_rows}
-            else:
-                bc = {r["sku"]: r["cnt"] for r in c.execute(
-                    "SELECT sku, COUNT(*) AS cnt FROM batches GROUP BY sku"
-                )}
-                last = {}
-                for r in c.execute(
-                    "SELECT sku, unit_cost, commission_pct FROM batches ORDER BY sku, date DESC, id DESC"
-                ):
-                    if r["sku"] not in last:
-                        last[r["sku"]] = (r["unit_cost"], r["commission_pct"])
-                left_by_sku = {r["sku"]: int(r["left"] or 0) for r in c.execute(
-                    "SELECT sku, SUM(qty - COALESCE(qty_sold,0)) AS left FROM batches GROUP BY sku"
-                ).fetchall()}
-
         items: List[Dict[str, Any]] = []
         for r in rows:
             sku = r["sku"]
             price = float(r.get("price") or 0)
             qty = int(r.get("quantity") or 0)
             cat = r.get("category") or ""
-            commissions = cats.get(cat)
+            batch_count = int(r.get("batch_count") or 0)
             last_margin = None
-            if sku in last:
-                ucost, comm = last[sku]
+            if batch_count and r.get("last_unit_cost") is not None:
+                comm = r.get("last_commission_pct")
                 eff_comm = float(comm) if comm is not None else (
-                    (float(commissions["base_percent"]) + float(commissions["extra_percent"]) + float(commissions["tax_percent"]))
-                    if commissions else 0.0
+                    (float(r.get("base_percent") or 0) + float(r.get("extra_percent") or 0) + float(r.get("tax_percent") or 0))
+                    if r.get("base_percent") is not None else 0.0
                 )
-                last_margin = price - (price * eff_comm/100.0) - float(ucost)
+                last_margin = price - (price * eff_comm/100.0) - float(r["last_unit_cost"])
 
-            left_total = int(left_by_sku.get(sku, 0))
+            left_total = int(r.get("left_qty") or 0)
             deficit = max(qty - left_total, 0)  # «не хватает партий»
 
             items.append({
                 "code": sku, "id": sku, "name": r.get("name"), "brand": r.get("brand"), "category": cat,
                 "qty": qty, "price": price, "active": bool(r.get("active")),
-                "batch_count": int(bc.get(sku, 0)),
+                "batch_count": batch_count,
                 "last_margin": round(last_margin, 2) if last_margin is not None else None,
                 "left_total": left_total,
 
@@ -1014,19 +904,15 @@ def get_products_router(*_, **__) -> APIRouter:
     # Стоимость остатков (для виджета)
     @router.get("/db/stock-value")
     async def stock_value(with_retail: int = Query(0), details: int = Query(0)):
-        _ensure_schema()
         total_cost = 0.0
         total_retail = 0.0
         per_sku: Dict[str, Dict[str, Any]] = {}
 
         with _db() as c:
-            # left * unit_cost
+            # left * unit_cost — из сводки, без агрегации по batches
             if _USE_PG:
                 rows = c.execute(_q("""
-                    SELECT b.sku, SUM(b.qty - COALESCE(b.qty_sold,0)) AS left_qty,
-                           SUM( (b.qty - COALESCE(b.qty_sold,0)) * b.unit_cost ) AS cost
-                      FROM batches b
-                  GROUP BY b.sku
+                    SELECT sku, left_qty, left_cost AS cost FROM sku_inventory_summary
                 """)).all()
                 left_map = {r._mapping["sku"]: (float(r._mapping["cost"] or 0.0), int(r._mapping["left_qty"] or 0)) for r in rows}
                 if with_retail:
@@ -1036,10 +922,7 @@ def get_products_router(*_, **__) -> APIRouter:
                     price_map = {}
             else:
                 rows = c.execute("""
-                    SELECT sku, SUM(qty - COALESCE(qty_sold,0)) AS left_qty,
-                           SUM( (qty - COALESCE(qty_sold,0)) * unit_cost ) AS cost
-                      FROM batches
-                  GROUP BY sku
+                    SELECT sku, left_qty, left_cost AS cost FROM sku_inventory_summary
                 """).fetchall()
                 left_map = {r["sku"]: (float(r["cost"] or 0.0), int(r["left_qty"] or 0)) for r in rows}
                 if with_retail:
@@ -1065,7 +948,6 @@ def get_products_router(*_, **__) -> APIRouter:
     # Точная карточка товара
     @router.get("/db/sku/{sku}")
     async def get_sku(sku: str):
-        _ensure_schema()
         with _db() as c:
             if _USE_PG:
                 r = c.execute(_q("SELECT * FROM products WHERE sku=:s"), {"s": sku}).first()
@@ -1102,7 +984,8 @@ def get_products_router(*_, **__) -> APIRouter:
         price_only: bool = Query(True),
         hard_delete_missing: bool = Query(False),
     ):
-        res = _run_kaspi_sync_inline(
+        res = await asyncio.to_thread(
+            _run_kaspi_sync_inline,
             mode=mode, price_only=price_only, hard_delete_missing=hard_delete_missing
         )
         if is_dataclass(res):
@@ -1116,7 +999,8 @@ def get_products_router(*_, **__) -> APIRouter:
         price_only: int = Query(0),
         hard_delete_missing: int = Query(0),
     ):
-        res = _run_kaspi_sync_inline(
+        res = await asyncio.to_thread(
+            _run_kaspi_sync_inline,
             mode=mode, price_only=bool(price_only), hard_delete_missing=bool(hard_delete_missing)
         )
         if is_dataclass(res):
@@ -1146,7 +1030,6 @@ def get_products_router(*_, **__) -> APIRouter:
     # Экспорт CSV (из БД)
     @router.get("/db/export.csv")
     async def export_db_csv(active_only: int = Query(1), q: str = Query("", alias="search")):
-        _ensure_schema()
         with _db() as c:
             if _USE_PG:
                 sql = "SELECT sku,name,brand,category,price,quantity,active,barcode FROM products"
@@ -1205,8 +1088,7 @@ def get_products_router(*_, **__) -> APIRouter:
         city_id: str = Query(os.getenv("KASPI_CITY_ID", "196220100")),
         dry_run: int = Query(0),
     ):
-        raw = await file.read()
-        items = _smart_import_bytes(file.filename or "", raw, city_id=city_id)
+        items = await _parse_upload(file, city_id)
         items, duplicates = _dedupe(items)
 
         if dry_run:
@@ -1251,8 +1133,7 @@ def get_products_router(*_, **__) -> APIRouter:
         city_id: str = Query(os.getenv("KASPI_CITY_ID", "196220100")),
         dry_run: int = Query(0),
     ):
-        raw = await file.read()
-        items = _smart_import_bytes(file.filename or "", raw, city_id=city_id)
+        items = await _parse_upload(file, city_id)
         items, duplicates = _dedupe(items)
         if dry_run:
             skus = [_sku_of(x) for x in items]
@@ -1277,8 +1158,7 @@ def get_products_router(*_, **__) -> APIRouter:
         dry_run: int = Query(0),
     ):
         # пробрасываем на новый синхро-эндпоинт
-        raw = await file.read()
-        items = _smart_import_bytes(file.filename or "", raw, city_id=city_id)
+        items = await _parse_upload(file, city_id)
         items, duplicates = _dedupe(items)
         if dry_run:
             skus = [_sku_of(x) for x in items]
@@ -1299,7 +1179,6 @@ def get_products_router(*_, **__) -> APIRouter:
     # ──────────────────────────────────────────────────────────────────────
     @router.get("/db/price-batches/{sku}")
     async def get_batches(sku: str):
-        _ensure_schema()
         with _db() as c:
             if _USE_PG:
                 rows = _rows_to_dicts(c.execute(_q(
@@ -1327,7 +1206,6 @@ def get_products_router(*_, **__) -> APIRouter:
 
     @router.post("/db/price-batches/{sku}", dependencies=[Depends(_require_api_key)])
     async def add_batches(sku: str, payload: BatchListIn = Body(...)):
-        _ensure_schema()
         # safety: ensure sku exists to avoid FK error (auto-create placeholder)
         with _db() as c:
             if _USE_PG:
@@ -1355,6 +1233,9 @@ def get_products_router(*_, **__) -> APIRouter:
                         (sku, e.date, int(e.qty), float(e.unit_cost), e.note,
                          float(e.commission_pct) if e.commission_pct is not None else None, code)
                     )
+            # новая партия может закрыть дыры и сдвинуть FIFO продаж после её даты
+            fifo_queue.enqueue(c, [(sku, None, str(e.date)) for e in payload.entries])
+            _refresh_sku_summary(c, [sku])
             _commit(c)
         return {"ok": True}
 
@@ -1371,25 +1252,31 @@ def get_products_router(*_, **__) -> APIRouter:
         sets = {k: v for k, v in fields.items() if v is not None}
         if not sets:
             return {"ok": True, "status": "noop"}
-        _ensure_schema()
+        # note/batch_code на журнал FIFO не влияют
+        replay = bool(set(sets) & {"date", "qty", "unit_cost", "commission_pct"})
         with _db() as c:
+            if replay and fifo_queue.drained(c):
+                old_date = _batch_date(c, sku, bid)
+                dates = [d for d in (old_date, sets.get("date")) if d]
+                fifo_queue.enqueue(c, [(sku, None, str(d)) for d in dates])
             if _USE_PG:
                 parts = [f"{k}=:{k}" for k in sets.keys()]
                 sets["bid"] = bid; sets["sku"] = sku
                 c.execute(_q(f"UPDATE batches SET {', '.join(parts)} WHERE id=:bid AND sku=:sku"), sets)
                 c.execute(_q("UPDATE batches SET qty_sold = LEAST(qty_sold, qty) WHERE id=:bid AND sku=:sku"),
                           {"bid": bid, "sku": sku})
+                _refresh_sku_summary(c, [sku])
             else:
                 parts = [f"{k}=?" for k in sets.keys()]
                 params = list(sets.values()) + [bid, sku]
                 c.execute(f"UPDATE batches SET {', '.join(parts)} WHERE id=? AND sku=?", params)
                 c.execute("UPDATE batches SET qty_sold = MIN(qty_sold, qty) WHERE id=? AND sku=?", (bid, sku))
+                _refresh_sku_summary(c, [sku])
                 _commit(c)
         return {"ok": True}
 
     @router.delete("/db/price-batches/{sku}/{bid}", dependencies=[Depends(_require_api_key)])
     async def delete_batch(sku: str, bid: int):
-        _ensure_schema()
         with _db() as c:
             if _USE_PG:
                 r = c.execute(_q("SELECT COALESCE(qty_sold,0) AS s FROM batches WHERE id=:bid AND sku=:sku"),
@@ -1398,7 +1285,9 @@ def get_products_router(*_, **__) -> APIRouter:
                     raise HTTPException(404, "Batch not found")
                 if int(r._mapping["s"]) > 0:
                     raise HTTPException(400, "Cannot delete: batch has sales")
+                fifo_queue.enqueue(c, [(sku, None, _batch_date(c, sku, bid))])
                 c.execute(_q("DELETE FROM batches WHERE id=:bid AND sku=:sku"), {"bid": bid, "sku": sku})
+                _refresh_sku_summary(c, [sku])
             else:
                 r = c.execute("SELECT COALESCE(qty_sold,0) AS s FROM batches WHERE id=? AND sku=?", (bid, sku)).fetchone()
                 if not r:
@@ -1406,6 +1295,7 @@ def get_products_router(*_, **__) -> APIRouter:
                 if int(r["s"]) > 0:
                     raise HTTPException(400, "Cannot delete: batch has sales")
                 c.execute("DELETE FROM batches WHERE id=? AND sku=?", (bid, sku))
+                _refresh_sku_summary(c, [sku])
                 _commit(c)
         return {"ok": True}
 
@@ -1417,7 +1307,6 @@ def get_products_router(*_, **__) -> APIRouter:
     # История по SKU из profit_fifo_ledger (если есть)
     @router.get("/db/ledger/{sku}")
     async def ledger_by_sku(sku: str, limit: int = Query(200, ge=1, le=2000)):
-        _ensure_schema()
         with _db() as c:
             if not _table_exists(c, "profit_fifo_ledger"):
                 return {"ok": True, "items": []}
@@ -1465,7 +1354,6 @@ def get_products_router(*_, **__) -> APIRouter:
     # Бэкап/восстановление (SQLite only)
     @router.get("/db/backup.sqlite3")
     async def backup_db():
-        _ensure_schema()
         if _USE_PG:
             raise HTTPException(501, "Backup доступен только для локальной SQLite.")
         fname = os.path.basename(DB_PATH) or "data.sqlite3"
@@ -1486,6 +1374,15 @@ def get_products_router(*_, **__) -> APIRouter:
             f.write(content)
         with _db() as c:
             ok = c.execute("PRAGMA integrity_check").fetchone()[0]
-        return {"ok": True, "integrity": ok}
+        # схему создают только миграции при старте: копию, снятую до новых миграций,
+        # приводим к текущей схеме сразу и пересобираем сводку склада по её партиям
+        try:
+            schema = await asyncio.to_thread(migrations.run_migrations)
+        except Exception as e:
+            raise HTTPException(400, f"Файл восстановлен, но миграции не применились: {e}")
+        with _db() as c:
+            _refresh_sku_summary(c)
+            _commit(c)
+        return {"ok": True, "integrity": ok, "applied": schema.get("applied") or []}
 
     return router
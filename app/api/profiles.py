@@ -0,0 +1,34 @@
+# app/api/profiles.py
+from __future__ import annotations
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+
+from app.services import profiling
+
+# профили запросов (см. app/services/profiling.py) — только для админов
+router = APIRouter(prefix="/debug/profiles", tags=["debug"], dependencies=[Depends(profiling.require_admin)])
+
+
+@router.get("")
+async def profiles_list():
+    return {"keep": profiling.PROFILE_KEEP, "items": profiling.list_profiles()}
+
+
+@router.get("/{profile_id}")
+async def profile_report(profile_id: str):
+    """HTML pyinstrument или текстовый отчёт cProfile; если сэмплер был занят — trace span'ов."""
+    path = profiling.profile_file(profile_id, "report") or profiling.profile_file(profile_id, "trace")
+    if path is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    media = {".html": "text/html", ".txt": "text/plain"}.get(path.suffix, "application/json")
+    return FileResponse(path, media_type=media)
+
+
+@router.get("/{profile_id}/trace")
+async def profile_trace(profile_id: str):
+    """Chrome trace JSON span'ов — открывается в speedscope / Perfetto."""
+    path = profiling.profile_file(profile_id, "trace")
+    if path is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return FileResponse(path, media_type="application/json", filename=f"{profile_id}.trace.json")
@@ -9,11 +9,19 @@ from fastapi import APIRouter, HTTPException, Query
 import psycopg
 from psycopg.rows import dict_row
 
+from app.services import cpu_pool, metrics, profiling, sku_summary
+from app.services.fifo import LEDGER_COLUMNS, allocate_fifo
+
 # ──────────────────────────────────────────────────────────────────────────────
 # DB: нормализация URL для прямого psycopg
 # ──────────────────────────────────────────────────────────────────────────────
 _RAW_URL = os.getenv("DATABASE_URL") or os.getenv("DB_URL")
 
+# сколько SKU из fifo_queue переигрывать в одной транзакции
+FIFO_QUEUE_BATCH = int(os.getenv("FIFO_QUEUE_BATCH", "200") or 200)
+
+FIFO_REPLAYED = metrics.counter("fifo_replayed_skus_total", "SKUs replayed from the incremental FIFO queue")
+
 def _normalize_pg_url(u: str | None) -> str:
     if not u:
         raise RuntimeError("DATABASE_URL/DB_URL is not set")
@@ -28,7 +36,8 @@ def _normalize_pg_url(u: str | None) -> str:
 
 def _pg():
     url = _normalize_pg_url(_RAW_URL)
-    return psycopg.connect(url, autocommit=False, row_factory=dict_row)
+    return psycopg.connect(url, autocommit=False, row_factory=dict_row,
+                           **metrics.pg_connect_kwargs("profit_fifo"))
 
 # ──────────────────────────────────────────────────────────────────────────────
 # SQL helpers
@@ -41,102 +50,6 @@ def _fetchone(cur, sql: str, params: Iterable[Any] = ()) -> Optional[dict]:
     cur.execute(sql, tuple(params or []))
     return cur.fetchone()
 
-# ──────────────────────────────────────────────────────────────────────────────
-# Schema bootstrap
-# ──────────────────────────────────────────────────────────────────────────────
-def _ensure_schema(con) -> None:
-    """
-    Гарантируем:
-      - в batches есть qty_sold
-      - таблица profit_fifo_ledger и индексы
-      - уникальный индекс (order_code, line_index, batch_id) для идемпотентности
-      - VIEW bridge_sales поверх bridge_lines (если таблицы bridge_sales нет)
-    """
-    cur = con.cursor()
-
-    # qty_sold в партиях (если нет)
-    cur.execute("""
-    DO $$
-    BEGIN
-      IF NOT EXISTS (
-        SELECT 1 FROM information_schema.columns
-         WHERE table_name='batches' AND column_name='qty_sold'
-      ) THEN
-        EXECUTE 'ALTER TABLE batches ADD COLUMN qty_sold INTEGER DEFAULT 0';
-      END IF;
-    END$$;
-    """)
-
-    # FIFO-леджер
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS profit_fifo_ledger(
-        id BIGSERIAL PRIMARY KEY,
-        order_id TEXT,
-        order_code TEXT,
-        date_utc_ms BIGINT,
-        sku TEXT NOT NULL,
-        line_index INTEGER DEFAULT 0,
-        qty INTEGER NOT NULL,
-        unit_price DOUBLE PRECISION DEFAULT 0,
-        total_price DOUBLE PRECISION DEFAULT 0,
-        batch_id BIGINT,
-        batch_date DATE,
-        unit_cost DOUBLE PRECISION DEFAULT 0,
-        commission_pct DOUBLE PRECISION DEFAULT 0,
-        commission_amount DOUBLE PRECISION DEFAULT 0,
-        cost_amount DOUBLE PRECISION DEFAULT 0,
-        profit_amount DOUBLE PRECISION DEFAULT 0,
-        created_at TIMESTAMPTZ DEFAULT now()
-    );
-    """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_fifo_order ON profit_fifo_ledger(order_code)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_fifo_sku   ON profit_fifo_ledger(sku)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_fifo_batch ON profit_fifo_ledger(batch_id)")
-
-    # Уникальный индекс для UPSERT (идемпотентность)
-    cur.execute("""
-    DO $$
-    BEGIN
-      IF NOT EXISTS (
-        SELECT 1 FROM pg_indexes WHERE indexname = 'uq_fifo_code_line_batch'
-      ) THEN
-        EXECUTE 'CREATE UNIQUE INDEX uq_fifo_code_line_batch
-                 ON profit_fifo_ledger(order_code, line_index, batch_id)';
-      END IF;
-    END$$;
-    """)
-
-    # Совместимость: если нет таблицы/вьюхи bridge_sales — создаём VIEW поверх bridge_lines
-    cur.execute("""
-    DO $$
-    BEGIN
-      IF NOT EXISTS (
-        SELECT 1 FROM information_schema.tables WHERE table_name='bridge_sales'
-      ) AND NOT EXISTS (
-        SELECT 1 FROM information_schema.views  WHERE table_name='bridge_sales'
-      ) AND EXISTS (
-        SELECT 1 FROM information_schema.tables WHERE table_name='bridge_lines'
-      ) THEN
-        EXECUTE $V$
-          CREATE VIEW bridge_sales AS
-          SELECT order_id,
-                 order_code,
-                 date_utc_ms,
-                 state,
-                 line_index,
-                 sku,
-                 title,
-                 qty,
-                 unit_price,
-                 total_price
-            FROM bridge_lines
-        $V$;
-      END IF;
-    END$$;
-    """)
-
-    con.commit()
-
 # ──────────────────────────────────────────────────────────────────────────────
 # Misc helpers
 # ──────────────────────────────────────────────────────────────────────────────
@@ -147,25 +60,35 @@ def _iso_to_day_ms(s: str, end: bool = False) -> int:
         return int((dt.timestamp() + 86399.999) * 1000)
     return int(dt.timestamp() * 1000)
 
-def _category_commission_sum(cur, sku: str) -> float:
-    row = _fetchone(cur, """
-        SELECT COALESCE(c.base_percent,0) + COALESCE(c.extra_percent,0) + COALESCE(c.tax_percent,0) AS pct
+def _category_commission_by_sku(cur, skus: List[str]) -> Dict[str, float]:
+    if not skus:
+        return {}
+    fmt = ",".join(["%s"] * len(skus))
+    rows = _fetchall(cur, f"""
+        SELECT p.sku,
+               COALESCE(c.base_percent,0) + COALESCE(c.extra_percent,0) + COALESCE(c.tax_percent,0) AS pct
           FROM products p
           JOIN categories c ON c.name = p.category
-         WHERE p.sku = %s
-         LIMIT 1
-    """, [sku])
-    return float(row["pct"]) if row and row.get("pct") is not None else 0.0
-
-def _batches_for_sku(cur, sku: str) -> List[dict]:
-    return _fetchall(cur, """
+         WHERE p.sku IN ({fmt})
+    """, skus)
+    return {r["sku"]: float(r["pct"] or 0.0) for r in rows}
+
+def _batches_by_sku(cur, skus: List[str]) -> Dict[str, List[dict]]:
+    if not skus:
+        return {}
+    fmt = ",".join(["%s"] * len(skus))
+    rows = _fetchall(cur, f"""
         SELECT id, sku, date, qty, COALESCE(qty_sold,0) AS qty_sold,
                COALESCE(unit_cost,0) AS unit_cost,
                commission_pct
           FROM batches
-         WHERE sku = %s
-         ORDER BY date ASC, id ASC
-    """, [sku])
+         WHERE sku IN ({fmt})
+         ORDER BY sku ASC, date ASC, id ASC
+    """, skus)
+    out: Dict[str, List[dict]] = {}
+    for r in rows:
+        out.setdefault(r["sku"], []).append(r)
+    return out
 
 def _sales_from_bridge_by_codes(cur, codes: List[str]) -> List[dict]:
     """Берём продажи из bridge_sales (view/table)."""
@@ -207,163 +130,253 @@ def _codes_from_period(cur, date_from_iso: str, date_to_iso: str) -> List[str]:
     """, [a, b])
     return [r["order_code"] for r in rows if r.get("order_code")]
 
-def _already_allocated(cur, order_code: str, line_index: int) -> int:
-    row = _fetchone(cur, """
-        SELECT COALESCE(SUM(qty),0) AS q
+def _allocated_by_line(cur, codes: List[str]) -> Dict[tuple, int]:
+    if not codes:
+        return {}
+    fmt = ",".join(["%s"] * len(codes))
+    rows = _fetchall(cur, f"""
+        SELECT order_code, line_index, COALESCE(SUM(qty),0) AS q
           FROM profit_fifo_ledger
-         WHERE order_code = %s AND line_index = %s
-    """, [order_code, int(line_index)])
-    return int(row["q"]) if row else 0
+         WHERE order_code IN ({fmt})
+         GROUP BY order_code, line_index
+    """, codes)
+    return {(r["order_code"], int(r["line_index"] or 0)): int(r["q"]) for r in rows}
 
-def _update_qty_sold(cur, touched_batch_ids: Iterable[int]) -> None:
-    ids = list({int(i) for i in touched_batch_ids if i is not None})
-    if not ids:
+def _add_qty_sold(cur, deltas: Dict[int, int]) -> None:
+    """qty_sold += разница по партиям — без пересуммирования журнала."""
+    items = [(int(b), int(d)) for b, d in deltas.items() if b is not None and d]
+    if not items:
         return
-    fmt = ",".join(["%s"] * len(ids))
-    cur.execute(f"""
-        WITH agg AS (
-          SELECT batch_id, COALESCE(SUM(qty),0) AS sold
-            FROM profit_fifo_ledger
-           WHERE batch_id IN ({fmt})
-           GROUP BY batch_id
-        )
+    cur.execute("""
         UPDATE batches b
-           SET qty_sold = COALESCE(agg.sold,0)
-          FROM agg
-         WHERE b.id = agg.batch_id
-    """, ids)
+           SET qty_sold = GREATEST(0, COALESCE(b.qty_sold,0) + d.delta)
+          FROM unnest(%s::bigint[], %s::int[]) AS d(id, delta)
+         WHERE b.id = d.id
+    """, ([b for b, _ in items], [d for _, d in items]))
+
+def _taken_by_batch(rows: List[tuple]) -> Dict[int, int]:
+    out: Dict[int, int] = {}
+    bi, qi = LEDGER_COLUMNS.index("batch_id"), LEDGER_COLUMNS.index("qty")
+    for r in rows:
+        out[int(r[bi])] = out.get(int(r[bi]), 0) + int(r[qi])
+    return out
+
+def _refresh_sku_summary_for_batches(cur, batch_ids: Optional[List[int]] = None,
+                                     skus: Optional[List[str]] = None) -> None:
+    """Обновляет sku_inventory_summary для SKU затронутых партий / skus (оба None → все SKU)."""
+    if batch_ids is None and skus is None:
+        where, params = "", []
+    elif skus is not None:
+        if not skus:
+            return
+        where, params = "WHERE b.sku = ANY(%s)", [list(skus)]
+    else:
+        if not batch_ids:
+            return
+        fmt = ",".join(["%s"] * len(batch_ids))
+        where = f"WHERE b.sku IN (SELECT DISTINCT sku FROM batches WHERE id IN ({fmt}))"
+        params = list(batch_ids)
+    cur.execute(sku_summary.upsert_sql(where, pg=True), params)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Core FIFO (идемпотентно с UPSERT)
 # ──────────────────────────────────────────────────────────────────────────────
+_LEDGER_UPSERT_SQL = f"""
+    INSERT INTO profit_fifo_ledger({", ".join(LEDGER_COLUMNS)})
+    VALUES ({", ".join(["%s"] * len(LEDGER_COLUMNS))})
+    ON CONFLICT (order_code, line_index, batch_id) DO UPDATE
+       SET qty = profit_fifo_ledger.qty + EXCLUDED.qty,
+           unit_price = EXCLUDED.unit_price,
+           total_price = profit_fifo_ledger.total_price + EXCLUDED.total_price,
+           commission_pct = EXCLUDED.commission_pct,
+           commission_amount = profit_fifo_ledger.commission_amount + EXCLUDED.commission_amount,
+           cost_amount = profit_fifo_ledger.cost_amount + EXCLUDED.cost_amount,
+           profit_amount = profit_fifo_ledger.profit_amount + EXCLUDED.profit_amount
+"""
+
 def _apply_fifo_for_sales(cur, sales: List[dict]) -> Dict[str, Any]:
-    batches_cache: Dict[str, List[dict]] = {}
-    touched_batches: Set[int] = set()
-    inserted_rows = 0
-    gaps: List[Dict[str, Any]] = []
-    sum_cost = 0.0
-    sum_comm = 0.0
-    sum_profit = 0.0
-
-    for s in sales:
-        sku = (s.get("sku") or "").strip()
-        if not sku:
-            continue
-        line_index = int(s.get("line_index") or 0)
-        order_code = (s.get("order_code") or "").strip()
-        if not order_code:
-            continue
-
-        qty_total = int(s.get("qty") or 1)
-        if qty_total <= 0:
-            continue
-
-        already = _already_allocated(cur, order_code, line_index)
-        need = qty_total - already
-        if need <= 0:
-            continue
-
-        if sku not in batches_cache:
-            batches_cache[sku] = _batches_for_sku(cur, sku)
-        batches = batches_cache[sku]
-
-        unit_price = float(s.get("unit_price") or 0.0)
-        line_total = float(s.get("total_price") or 0.0)
-        revenue_per_piece = (line_total / max(1, qty_total)) if line_total > 0 else unit_price
-
-        local_usage: Dict[int, int] = {}
-        for b in batches:
-            if need <= 0:
-                break
-            bid = int(b["id"])
-            batch_qty = int(b.get("qty") or 0)
-            batch_sold = int(b.get("qty_sold") or 0)
-            used_here = int(local_usage.get(bid, 0))
-            free = max(0, batch_qty - batch_sold - used_here)
-            if free <= 0:
-                continue
-
-            take = min(free, need)
-            if take <= 0:
-                continue
-
-            commission_pct = b.get("commission_pct")
-            if commission_pct is None:
-                commission_pct = _category_commission_sum(cur, sku)
-            commission_pct = float(commission_pct or 0.0)
-
-            unit_cost = float(b.get("unit_cost") or 0.0)
-            part_revenue = revenue_per_piece * take
-            cost_amount = unit_cost * take
-            commission_amount = part_revenue * (commission_pct / 100.0)
-            profit_amount = part_revenue - commission_amount - cost_amount
-
-            # UPSERT по уникальному индексу
-            cur.execute("""
-                INSERT INTO profit_fifo_ledger(
-                    order_id, order_code, date_utc_ms, sku, line_index,
-                    qty, unit_price, total_price,
-                    batch_id, batch_date, unit_cost,
-                    commission_pct, commission_amount, cost_amount, profit_amount
-                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                ON CONFLICT (order_code, line_index, batch_id) DO UPDATE
-                   SET qty = profit_fifo_ledger.qty + EXCLUDED.qty,
-                       unit_price = EXCLUDED.unit_price,
-                       total_price = profit_fifo_ledger.total_price + EXCLUDED.total_price,
-                       commission_pct = EXCLUDED.commission_pct,
-                       commission_amount = profit_fifo_ledger.commission_amount + EXCLUDED.commission_amount,
-                       cost_amount = profit_fifo_ledger.cost_amount + EXCLUDED.cost_amount,
-                       profit_amount = profit_fifo_ledger.profit_amount + EXCLUDED.profit_amount
-            """, [
-                s.get("order_id"), order_code, s.get("date_utc_ms"), sku, line_index,
-                take, unit_price, (revenue_per_piece * take),
-                bid, b.get("date"), unit_cost,
-                commission_pct, commission_amount, cost_amount, profit_amount
-            ])
-
-            inserted_rows += 1
-            local_usage[bid] = used_here + take
-            touched_batches.add(bid)
-
-            sum_cost += cost_amount
-            sum_comm += commission_amount
-            sum_profit += profit_amount
-            need -= take
-
-        if need > 0:
-            gaps.append({
-                "order_code": order_code,
-                "line_index": line_index,
-                "sku": sku,
-                "not_covered_qty": need
-            })
-
-    _update_qty_sold(cur, touched_batches)
+    # всё нужное для расчёта выбираем пачкой, сам расчёт — чистая функция (на больших объёмах в cpu_pool)
+    with profiling.span("apply_fifo_for_sales", sales=len(sales)):
+        skus = sorted({(s.get("sku") or "").strip() for s in sales} - {""})
+        codes = sorted({(s.get("order_code") or "").strip() for s in sales} - {""})
+        plan = cpu_pool.run_sync(
+            allocate_fifo,
+            [dict(s) for s in sales],
+            _batches_by_sku(cur, skus),
+            _allocated_by_line(cur, codes),
+            _category_commission_by_sku(cur, skus),
+            inline=len(sales) < cpu_pool.CPU_POOL_MIN_ROWS,
+        )
 
-    return {
-        "inserted_rows": inserted_rows,
-        "sum_cost": round(sum_cost, 2),
-        "sum_commission": round(sum_comm, 2),
-        "sum_profit": round(sum_profit, 2),
-        "gaps": gaps,
-    }
+        # UPSERT по уникальному индексу
+        if plan["rows"]:
+            cur.executemany(_LEDGER_UPSERT_SQL, plan["rows"])
+
+        _add_qty_sold(cur, _taken_by_batch(plan["rows"]))
+        _refresh_sku_summary_for_batches(cur, plan["touched_batches"])
 
-def _clear_ledger_for_codes(cur, codes: List[str]) -> List[int]:
+        return {
+            "inserted_rows": len(plan["rows"]),
+            "sum_cost": plan["sum_cost"],
+            "sum_commission": plan["sum_commission"],
+            "sum_profit": plan["sum_profit"],
+            "gaps": plan["gaps"],
+        }
+
+def _clear_ledger_for_codes(cur, codes: List[str]) -> Dict[int, int]:
+    """Удаляет строки журнала заказов и возвращает qty_sold к ним: {batch_id: -qty}."""
     if not codes:
-        return []
+        return {}
     fmt = ",".join(["%s"] * len(codes))
     rows = _fetchall(cur, f"""
-        SELECT DISTINCT batch_id
-          FROM profit_fifo_ledger
+        DELETE FROM profit_fifo_ledger
          WHERE order_code IN ({fmt})
+        RETURNING batch_id, qty
     """, codes)
-    touched = [int(r["batch_id"]) for r in rows if r.get("batch_id") is not None]
-    cur.execute(f"DELETE FROM profit_fifo_ledger WHERE order_code IN ({fmt})", codes)
-    return touched
+    released: Dict[int, int] = {}
+    for r in rows:
+        if r.get("batch_id") is not None:
+            released[int(r["batch_id"])] = released.get(int(r["batch_id"]), 0) - int(r["qty"] or 0)
+    _add_qty_sold(cur, released)
+    _refresh_sku_summary_for_batches(cur, list(released))
+    return released
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Инкрементальный FIFO по очереди SKU (app/services/fifo_queue.py)
+# ──────────────────────────────────────────────────────────────────────────────
+def _claim_queue(cur, limit: int) -> List[dict]:
+    # SKIP LOCKED: несколько воркеров/прогревов разбирают очередь, не мешая друг другу
+    return _fetchall(cur, """
+        SELECT sku, since_ms, since_batch
+          FROM fifo_queue
+         ORDER BY queued_at, sku
+         LIMIT %s
+           FOR UPDATE SKIP LOCKED
+    """, [limit])
+
+def _replay_from(cur, sku: str, since_ms: Optional[int], since_batch: Any) -> Optional[int]:
+    """
+    С какой продажи переигрывать SKU. Правка партии даты D затрагивает продажи, списанные
+    на партии не раньше D, и непокрытые продажи: партии раньше D они уже исчерпали.
+    """
+    points = [int(since_ms)] if since_ms is not None else []
+    if since_batch is not None:
+        r = _fetchone(cur, """
+            SELECT MIN(date_utc_ms) AS ms
+              FROM profit_fifo_ledger
+             WHERE sku = %s AND batch_date >= %s
+        """, [sku, since_batch])
+        if r and r["ms"] is not None:
+            points.append(int(r["ms"]))
+        r = _fetchone(cur, """
+            SELECT MIN(s.date_utc_ms) AS ms
+              FROM bridge_sales s
+             WHERE s.sku = %s
+               AND s.order_code IS NOT NULL
+               AND COALESCE(NULLIF(s.qty,0),1) > COALESCE((
+                     SELECT SUM(l.qty) FROM profit_fifo_ledger l
+                      WHERE l.order_code = s.order_code AND l.line_index = s.line_index), 0)
+        """, [sku])
+        if r and r["ms"] is not None:
+            points.append(int(r["ms"]))
+    return min(points) if points else None
+
+def _replay_skus(cur, since: Dict[str, int]) -> Dict[str, Any]:
+    """Переигрывает FIFO по SKU начиная с since[sku] (мс продажи) — только хвост журнала."""
+    skus = sorted(since)
+    bounds = (skus, [since[k] for k in skus])
+    with profiling.span("fifo_replay", skus=len(skus)):
+        released: Dict[int, int] = {}
+        for r in _fetchall(cur, """
+            DELETE FROM profit_fifo_ledger l
+             USING unnest(%s::text[], %s::bigint[]) AS q(sku, since_ms)
+             WHERE l.sku = q.sku AND l.date_utc_ms >= q.since_ms
+            RETURNING l.batch_id, l.qty
+        """, bounds):
+            if r.get("batch_id") is not None:
+                released[int(r["batch_id"])] = released.get(int(r["batch_id"]), 0) - int(r["qty"] or 0)
+        _add_qty_sold(cur, released)
+
+        sales = _fetchall(cur, """
+            SELECT s.order_id, s.order_code, s.date_utc_ms, s.state, s.line_index,
+                   s.sku, s.title, COALESCE(s.qty,1) AS qty,
+                   COALESCE(s.unit_price,0) AS unit_price,
+                   COALESCE(s.total_price,0) AS total_price
+              FROM bridge_sales s
+              JOIN unnest(%s::text[], %s::bigint[]) AS q(sku, since_ms)
+                ON s.sku = q.sku AND s.date_utc_ms >= q.since_ms
+             ORDER BY s.date_utc_ms ASC, s.order_code ASC, s.line_index ASC
+        """, bounds)
+        # хвост журнала по этим SKU удалён целиком — уже распределённого нет
+        plan = cpu_pool.run_sync(
+            allocate_fifo,
+            [dict(s) for s in sales],
+            _batches_by_sku(cur, skus),
+            {},
+            _category_commission_by_sku(cur, skus),
+            inline=len(sales) < cpu_pool.CPU_POOL_MIN_ROWS,
+        )
+        if plan["rows"]:
+            cur.executemany(_LEDGER_UPSERT_SQL, plan["rows"])
+        _add_qty_sold(cur, _taken_by_batch(plan["rows"]))
+    return {
+        "replayed_lines": len(sales),
+        "released": -sum(released.values()),
+        "inserted_rows": len(plan["rows"]),
+        "gaps": plan["gaps"],
+    }
+
+def process_queue(max_skus: Optional[int] = None) -> Dict[str, Any]:
+    """Разбирает fifo_queue пачками по FIFO_QUEUE_BATCH SKU, каждая — своя транзакция."""
+    out: Dict[str, Any] = {"skus": 0, "replayed_lines": 0, "inserted": 0, "gaps": []}
+    while max_skus is None or out["skus"] < max_skus:
+        limit = FIFO_QUEUE_BATCH if max_skus is None else min(FIFO_QUEUE_BATCH, max_skus - out["skus"])
+        with _pg() as con:
+            cur = con.cursor()
+            claimed = _claim_queue(cur, limit)
+            if not claimed:
+                break
+            since: Dict[str, int] = {}
+            for q in claimed:
+                ms = _replay_from(cur, q["sku"], q["since_ms"], q["since_batch"])
+                if ms is not None:
+                    since[q["sku"]] = ms
+            if since:
+                res = _replay_skus(cur, since)
+                out["replayed_lines"] += res["replayed_lines"]
+                out["inserted"] += res["inserted_rows"]
+                out["gaps"].extend(res["gaps"])
+            claimed_skus = [q["sku"] for q in claimed]
+            _refresh_sku_summary_for_batches(cur, skus=claimed_skus)
+            cur.execute("DELETE FROM fifo_queue WHERE sku = ANY(%s)", (claimed_skus,))
+            con.commit()
+        out["skus"] += len(claimed)
+        FIFO_REPLAYED.inc(len(claimed))
+    return out
+
+def enqueue_period(date_from: str, date_to: str) -> int:
+    """Ставит в очередь SKU продаж периода с начала периода — разовый бэкфилл журнала."""
+    with _pg() as con:
+        cur = con.cursor()
+        rows = _fetchall(cur, """
+            SELECT sku, MIN(date_utc_ms) AS since_ms
+              FROM bridge_lines
+             WHERE sku IS NOT NULL AND date_utc_ms BETWEEN %s AND %s
+             GROUP BY sku
+        """, [_iso_to_day_ms(date_from), _iso_to_day_ms(date_to, end=True)])
+        cur.executemany("""
+            INSERT INTO fifo_queue(sku, since_ms, queued_at) VALUES (%s, %s, now())
+            ON CONFLICT (sku) DO UPDATE SET since_ms = LEAST(fifo_queue.since_ms, excluded.since_ms)
+        """, [(r["sku"], int(r["since_ms"])) for r in rows])
+        con.commit()
+    return len(rows)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # FastAPI Router
 # ──────────────────────────────────────────────────────────────────────────────
+def enabled() -> bool:
+    return bool(_RAW_URL)
+
 def get_profit_fifo_router() -> APIRouter:
     router = APIRouter(tags=["Profit FIFO"])
 
@@ -377,7 +390,6 @@ def get_profit_fifo_router() -> APIRouter:
             raise HTTPException(400, "Передайте codes=... или date_from/date_to")
 
         with _pg() as con:
-            _ensure_schema(con)
             cur = con.cursor()
 
             if codes:
@@ -412,7 +424,6 @@ def get_profit_fifo_router() -> APIRouter:
         dry_run: int = Query(0, description="1 = откатить транзакцию"),
     ):
         with _pg() as con:
-            _ensure_schema(con)
             cur = con.cursor()
 
             if codes:
@@ -422,9 +433,7 @@ def get_profit_fifo_router() -> APIRouter:
                     raise HTTPException(400, "Передайте codes=... или date_from/date_to")
                 codes_list = _codes_from_period(cur, date_from, date_to)
 
-            touched = _clear_ledger_for_codes(cur, codes_list)
-            if touched:
-                _update_qty_sold(cur, touched)
+            _clear_ledger_for_codes(cur, codes_list)
 
             sales = _sales_from_bridge_by_codes(cur, codes_list)
             stats = _apply_fifo_for_sales(cur, sales)
@@ -446,10 +455,31 @@ def get_profit_fifo_router() -> APIRouter:
                 "dry_run": int(dry_run),
             }
 
+    @router.post("/bridge/fifo/process")
+    def fifo_process(max_skus: Optional[int] = Query(None, ge=1, description="сколько SKU разобрать; по умолчанию — всю очередь")):
+        """Переигрывает FIFO по SKU из очереди (их ставят sync-by-ids и правки партий)."""
+        if not enabled():
+            raise HTTPException(400, "FIFO-журнал ведётся только в PostgreSQL: задайте DATABASE_URL")
+        res = process_queue(max_skus)
+        with _pg() as con:
+            left = _fetchone(con.cursor(), "SELECT COUNT(*) AS n FROM fifo_queue")
+        return {"ok": True, **res, "queued_left": int(left["n"]) if left else 0}
+
+    @router.post("/bridge/fifo/enqueue")
+    def fifo_enqueue(
+        date_from: str = Query(..., description="YYYY-MM-DD"),
+        date_to: str = Query(..., description="YYYY-MM-DD"),
+    ):
+        """Бэкфилл: SKU продаж периода в очередь с начала периода (затем /bridge/fifo/process)."""
+        try:
+            n = enqueue_period(date_from, date_to)
+        except ValueError:
+            raise HTTPException(400, "Неверный формат date_from/date_to, ожидается YYYY-MM-DD")
+        return {"ok": True, "queued_skus": n}
+
     @router.post("/bridge/fifo/recalc-batches")
     def fifo_recalc_batches():
         with _pg() as con:
-            _ensure_schema(con)
             cur = con.cursor()
             cur.execute("""
                 UPDATE batches b
@@ -462,6 +492,7 @@ def get_profit_fifo_router() -> APIRouter:
                   ) agg
                  WHERE b.id = agg.batch_id
             """)
+            _refresh_sku_summary_for_batches(cur)
             con.commit()
             return {"ok": True}
 
@@ -471,7 +502,6 @@ def get_profit_fifo_router() -> APIRouter:
         limit: int = Query(200),
     ):
         with _pg() as con:
-            _ensure_schema(con)
             cur = con.cursor()
             if codes:
                 lst = [c.strip() for c in codes.split(",") if c.strip()]
@@ -498,7 +528,6 @@ def get_profit_fifo_router() -> APIRouter:
         if not lst:
             return {"ok": True, "deleted_orders": 0}
         with _pg() as con:
-            _ensure_schema(con)
             cur = con.cursor()
             touched = _clear_ledger_for_codes(cur, lst)
             con.commit()
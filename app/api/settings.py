@@ -1,14 +1,15 @@
 # app/api/settings.py
 from __future__ import annotations
 
-from typing import Optional
+from typing import List, Optional
 from typing_extensions import Annotated
 
 from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel, Field, field_validator
 
 from app.deps.auth import get_current_tenant_id
-from app.deps.tenant import get_settings, upsert_settings
+from app.deps.tenant import WARMUP_KEY, get_settings, upsert_settings
+from app.services import warmup
 
 router = APIRouter()
 HHMM = Annotated[str, Field(pattern=r"^\d{2}:\d{2}$")]
@@ -33,6 +34,22 @@ class SettingsIn(BaseModel):
             raise ValueError("amount_divisor must be > 0")
         return v
 
+class WarmupIn(BaseModel):
+    enabled: bool = True
+    ranges: List[str] = Field(default_factory=lambda: list(warmup.DEFAULT_CONFIG["ranges"]))
+    ids: bool = True
+    bridge: bool = True
+    fifo: bool = True
+    delay_min: int = Field(warmup.WARMUP_DELAY_MIN, ge=0, le=180)
+
+    @field_validator("ranges")
+    @classmethod
+    def _known_ranges(cls, v: List[str]) -> List[str]:
+        bad = [r for r in v if r not in warmup.RANGES]
+        if bad:
+            raise ValueError(f"unknown ranges: {', '.join(bad)}")
+        return v
+
 @router.get("/me")
 def me(req: Request):
     tenant_id = get_current_tenant_id(req)
@@ -64,3 +81,31 @@ def check(req: Request):
     if not get_current_tenant_id(req):
         raise HTTPException(status_code=401, detail="unauthorized")
     return {"ok": True}
+
+@router.get("/warmup")
+def warmup_get(req: Request):
+    tenant_id = get_current_tenant_id(req)
+    if not tenant_id:
+        raise HTTPException(status_code=401, detail="unauthorized")
+    cfg = warmup.normalize_config(get_settings(tenant_id, WARMUP_KEY))
+    return {**cfg, "last_run": warmup.status(tenant_id)}
+
+@router.post("/warmup")
+def warmup_save(payload: WarmupIn, req: Request):
+    tenant_id = get_current_tenant_id(req)
+    if not tenant_id:
+        raise HTTPException(status_code=401, detail="unauthorized")
+    upsert_settings(tenant_id, payload.model_dump(), key=WARMUP_KEY)
+    return {"ok": True}
+
+@router.post("/warmup/run")
+async def warmup_run(req: Request):
+    """Прогреть сейчас, не дожидаясь границы дня; результат — в GET /settings/warmup."""
+    tenant_id = get_current_tenant_id(req)
+    if not tenant_id:
+        raise HTTPException(status_code=401, detail="unauthorized")
+    if warmup.scheduler is None:
+        raise HTTPException(status_code=503, detail="warm-up disabled")
+    if not await warmup.scheduler.trigger(tenant_id):
+        raise HTTPException(status_code=409, detail="already running or no kaspi token")
+    return {"ok": True}
@@ -2,14 +2,17 @@ import os
 import psycopg
 from psycopg.rows import dict_row
 
+from app.services import metrics
+
 def _normalize_dsn(url: str) -> str:
     # postgresql+psycopg:// -> postgresql://
     return re.sub(r"^postgresql\+[^:]+://", "postgresql://", url)
 
 _DB_URL = os.getenv("DATABASE_URL", "").replace("postgresql+psycopg://", "postgresql://", 1)
 
-def get_conn():
-    return psycopg.connect(_DB_URL, row_factory=dict_row)
+def get_conn(module: str = "tenant"):
+    # module — лейбл для db_query_duration_seconds (см. app/services/metrics.py)
+    return psycopg.connect(_DB_URL, row_factory=dict_row, **metrics.pg_connect_kwargs(module))
 
 def fetchrow(sql, args=()):
     with get_conn() as conn, conn.cursor() as cur:
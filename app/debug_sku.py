@@ -9,6 +9,8 @@ import pytz
 import httpx
 from fastapi import APIRouter, Query, HTTPException
 
+from app.services import kaspi_transport
+
 # ─────────────────────────────────────────────────────────────────────────────
 # HTTPX: таймауты и лимиты
 # ─────────────────────────────────────────────────────────────────────────────
@@ -29,6 +31,11 @@ KASPI_BASEURLS_EXTRA = [
 KASPI_FALLBACKS = ["https://seller-api.kaspi.kz/shop/api/v2"]
 
 
+async def _kaspi_get(cli: httpx.AsyncClient, url: str, **kw: Any) -> httpx.Response:
+    # общий лимитер/повторы 429-5xx; перебор форм фильтра ниже ловит уже только «форма не подошла»
+    return await kaspi_transport.request(cli, "GET", url, token=KASPI_TOKEN, **kw)
+
+
 def _headers() -> Dict[str, str]:
     if not KASPI_TOKEN:
         raise HTTPException(status_code=500, detail="KASPI_TOKEN is not set")
@@ -274,7 +281,7 @@ async def _find_order_id_by_code(
                 params = {"page[number]": str(page), "page[size]": str(page_size)}
                 params.update(make_filter(date_field or "creationDate", start_ms, end_ms))
                 try:
-                    r = await cli.get("/orders", params=params, headers=headers)
+                    r = await _kaspi_get(cli, "/orders", params=params, headers=headers)
                     r.raise_for_status()
                     j = r.json()
                     data = j.get("data", []) or []
@@ -324,7 +331,7 @@ async def _iter_orders_httpx(
                 params = {"page[number]": str(page), "page[size]": str(page_size)}
                 params.update(make_filter(date_field or "creationDate", start_ms, end_ms))
                 try:
-                    r = await cli.get("/orders", params=params, headers=headers)
+                    r = await _kaspi_get(cli, "/orders", params=params, headers=headers)
                     r.raise_for_status()
                     j = r.json()
                     data = j.get("data", []) or []
@@ -399,7 +406,7 @@ async def _fetch_by_order_id(order_id: str) -> Dict[str, Any]:
         # S1: сабресурс с include product/merchantProduct/masterProduct
         try:
             params = {"page[size]": "200", "include": "product,merchantProduct,masterProduct"}
-            r = await cli.get(f"/orders/{order_id}/entries", params=params, headers=headers)
+            r = await _kaspi_get(cli, f"/orders/{order_id}/entries", params=params, headers=headers)
             debug_info["entries_sub_status"] = r.status_code
             j = r.json() if r.headers.get("content-type", "").startswith("application/vnd.api+json") else {}
             data_list = j.get("data", []) if isinstance(j, dict) else []
@@ -418,7 +425,7 @@ async def _fetch_by_order_id(order_id: str) -> Dict[str, Any]:
         # S2: order + include=entries.product
         try:
             params = {"include": "entries.product"}
-            r = await cli.get(f"/orders/{order_id}", params=params, headers=headers)
+            r = await _kaspi_get(cli, f"/orders/{order_id}", params=params, headers=headers)
             debug_info["order_inc_prod_status"] = r.status_code
             j = r.json()
             included = _index_included(j.get("included", [])) if isinstance(j, dict) else {}
@@ -440,7 +447,7 @@ async def _fetch_by_order_id(order_id: str) -> Dict[str, Any]:
         # S3: /orderentries по order.id (оставим прежнюю простую схему)
         try:
             params = {"filter[order.id]": order_id, "page[size]": "200"}
-            r = await cli.get("/orderentries", params=params, headers=headers)
+            r = await _kaspi_get(cli, "/orderentries", params=params, headers=headers)
             debug_info["orderentries_status"] = r.status_code
             j = r.json()
             data_list = j.get("data", []) if isinstance(j, dict) else []
@@ -498,7 +505,7 @@ async def _probe_on_base(
         }
         order_id: Optional[str] = order_id_hint
         try:
-            r = await cli.get("/orders", params=params_orders, headers=_headers())
+            r = await _kaspi_get(cli, "/orders", params=params_orders, headers=_headers())
             result["orders"]["status"] = r.status_code
             r.raise_for_status()
             j = r.json() if r.headers.get("content-type", "").startswith("application/vnd.api+json") else {}
@@ -519,7 +526,7 @@ async def _probe_on_base(
 
         # /orderentries?filter[order.id]
         try:
-            r = await cli.get("/orderentries", params={"filter[order.id]": order_id, "page[size]": "1"}, headers=_headers())
+            r = await _kaspi_get(cli, "/orderentries", params={"filter[order.id]": order_id, "page[size]": "1"}, headers=_headers())
             result["orderentries"]["status"] = r.status_code
             r.raise_for_status()
             j = r.json() if r.headers.get("content-type", "").startswith("application/vnd.api+json") else {}
@@ -535,7 +542,7 @@ async def _probe_on_base(
 
         # /orders/{id}?include=entries.product
         try:
-            r = await cli.get(f"/orders/{order_id}", params={"include": "entries.product"}, headers=_headers())
+            r = await _kaspi_get(cli, f"/orders/{order_id}", params={"include": "entries.product"}, headers=_headers())
             result["entries_product"]["status"] = r.status_code
             r.raise_for_status()
             j = r.json() if r.headers.get("content-type", "").startswith("application/vnd.api+json") else {}
@@ -597,7 +604,7 @@ def get_debug_router(default_tz: str = "Asia/Almaty", chunk_days: int = 3) -> AP
                     f"filter[orders][{date_field or 'creationDate'}][$ge]": str(s_ms),
                     f"filter[orders][{date_field or 'creationDate'}][$le]": str(e_ms),
                 }
-                r = await cli.get("/orders", params=params, headers=headers)
+                r = await _kaspi_get(cli, "/orders", params=params, headers=headers)
                 r.raise_for_status()
                 j = r.json()
                 data = j.get("data", []) or []
@@ -617,7 +624,7 @@ def get_debug_router(default_tz: str = "Asia/Almaty", chunk_days: int = 3) -> AP
                 return {"ok": True, "items": []}
 
             # 2) позиции заказа (+ include, чтобы достать SKU/название)
-            r = await cli.get(
+            r = await _kaspi_get(cli,
                 f"/orders/{order_id}/entries",
                 params={"page[size]": "200", "include": "product,merchantProduct,masterProduct"},
                 headers=headers,
@@ -814,7 +821,7 @@ def get_debug_router(default_tz: str = "Asia/Almaty", chunk_days: int = 3) -> AP
                 one: Dict[str, Any] = {"base": base}
                 # /orders
                 try:
-                    r = await cli.get(
+                    r = await _kaspi_get(cli,
                         "/orders",
                         params={
                             "page[number]": "0",
@@ -843,7 +850,7 @@ def get_debug_router(default_tz: str = "Asia/Almaty", chunk_days: int = 3) -> AP
                 if order_id:
                     # /orderentries
                     try:
-                        r = await cli.get(
+                        r = await _kaspi_get(cli,
                             "/orderentries",
                             params={"filter[order.id]": order_id, "page[size]": "1"},
                             headers=_headers(),
@@ -863,7 +870,7 @@ def get_debug_router(default_tz: str = "Asia/Almaty", chunk_days: int = 3) -> AP
 
                     # include=entries.product
                     try:
-                        r = await cli.get(f"/orders/{order_id}", params={"include": "entries.product"}, headers=_headers())
+                        r = await _kaspi_get(cli, f"/orders/{order_id}", params={"include": "entries.product"}, headers=_headers())
                         one["entries_product_status"] = r.status_code
                         r.raise_for_status()
                         j = r.json() if r.headers.get("content-type", "").startswith("application/vnd.api+json") else {}
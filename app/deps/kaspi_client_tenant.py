@@ -2,14 +2,25 @@
 from __future__ import annotations
 
 import os
+import threading
 from datetime import datetime, timedelta, date
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 import httpx
 from .auth import get_current_kaspi_token
+from app.services import kaspi_transport
 
 KASPI_BASE_URL = (os.getenv("KASPI_BASE_URL") or "https://kaspi.kz/shop/api/v2").rstrip("/")
 
+PAGE_SIZE = 100
+
+# профили запроса /orders:
+#   full — с include=entries (позиции заказа), для обогащения;
+#   lean — без include и, если KASPI_SPARSE_FIELDS, только нужные атрибуты (fields[orders]=…),
+#          для счётчиков и сумм — в разы меньше байт и разбора JSON
+PROFILES = ("lean", "full")
+KASPI_SPARSE_FIELDS = os.getenv("KASPI_SPARSE_FIELDS", "true").lower() in ("1", "true", "yes", "on")
+
 ALLOWED_DATE_FIELDS = (
     "creationDate",
     "plannedShipmentDate",
@@ -19,15 +30,42 @@ ALLOWED_DATE_FIELDS = (
 )
 
 
-def _to_ms(d: datetime | date) -> int:
+def _to_ms(d: datetime | date | int) -> int:
+    if isinstance(d, int):
+        return d
     if isinstance(d, date) and not isinstance(d, datetime):
         d = datetime(d.year, d.month, d.day)
     return int(d.timestamp() * 1000)
 
 
+def _with_entries(page: dict) -> Iterable[Tuple[dict, List[dict]]]:
+    included = {(x.get("type"), str(x.get("id"))): x for x in (page.get("included") or [])}
+    for it in (page.get("data") or []):
+        refs = (((it.get("relationships") or {}).get("entries") or {}).get("data")) or []
+        entries = [included[k] for k in ((r.get("type"), str(r.get("id"))) for r in refs) if k in included]
+        yield it, entries
+
+
 class KaspiClient:
     def __init__(self, *, base_url: Optional[str] = None):
         self.base_url = (base_url or KASPI_BASE_URL).rstrip("/")
+        self._cli: Optional[httpx.Client] = None
+        self._cli_lock = threading.Lock()
+
+    def _http(self) -> httpx.Client:
+        # один httpx.Client на процесс: окна сканирования и страницы идут из разных потоков,
+        # а новый клиент на окно — это новый SSL-контекст (~25 мс CPU) и новые соединения
+        if self._cli is None:
+            with self._cli_lock:
+                if self._cli is None:
+                    self._cli = httpx.Client(base_url=self.base_url, timeout=60.0)
+        return self._cli
+
+    def close(self) -> None:
+        with self._cli_lock:
+            cli, self._cli = self._cli, None
+        if cli is not None:
+            cli.close()
 
     def _headers(self) -> Dict[str, str]:
         token = get_current_kaspi_token()
@@ -43,13 +81,71 @@ class KaspiClient:
     def iter_orders(
         self,
         *,
-        start: date | datetime,
-        end: date | datetime,
+        start: date | datetime | int,
+        end: date | datetime | int,
+        filter_field: str = "creationDate",
+        stats: Optional[Dict[str, float]] = None,
+        profile: str = "full",
+        fields: Optional[Sequence[str]] = None,
+        state: Optional[str] = None,
+    ) -> Iterable[dict]:
+        for j in self._iter_pages(start=start, end=end, filter_field=filter_field, stats=stats,
+                                  profile=profile, fields=fields, state=state):
+            for it in (j.get("data") or []):
+                yield it
+
+    def iter_orders_with_entries(
+        self,
+        *,
+        start: date | datetime | int,
+        end: date | datetime | int,
         filter_field: str = "creationDate",
+        stats: Optional[Dict[str, float]] = None,
+        state: Optional[str] = None,
+    ) -> Iterable[Tuple[dict, List[dict]]]:
+        """(заказ, его позиции) — позиции из included той же страницы (profile=full)."""
+        for j in self._iter_pages(start=start, end=end, filter_field=filter_field, stats=stats, profile="full",
+                                  state=state):
+            yield from _with_entries(j)
+
+    def iter_orders_by_code(self, codes: Iterable[str]) -> Iterable[Tuple[dict, List[dict]]]:
+        """(заказ, его позиции) по кодам заказов — по запросу filter[orders][code] на код."""
+        headers = self._headers()
+        cli = self._http()
+        for code in codes:
+            params = {"page[size]": PAGE_SIZE, "page[number]": 0,
+                      "filter[orders][code]": code, "include": "entries"}
+            pages = kaspi_transport.iter_pages_sync(cli, "/orders", token=headers["X-Auth-Token"],
+                                                    endpoint="/orders", params=params, headers=headers)
+            try:
+                for j in pages:
+                    yield from _with_entries(j)
+            except httpx.HTTPStatusError as e:
+                raise RuntimeError(f"Kaspi API {e.response.status_code}: {e.response.text or e}") from e
+            finally:
+                pages.close()
+
+    def _iter_pages(
+        self,
+        *,
+        start: date | datetime | int,
+        end: date | datetime | int,
+        filter_field: str,
+        stats: Optional[Dict[str, float]],
+        profile: str,
+        fields: Optional[Sequence[str]] = None,
+        state: Optional[str] = None,
     ) -> Iterable[dict]:
-        # Диапазон включительно: [start; end 23:59:59.999]
+        # profile: lean | full (см. PROFILES); fields — атрибуты заказа для lean
+        # state — фильтр filter[orders][state] на стороне Kaspi (один статус)
+        # stats (опционально) накапливает pages / fetch_s — для метрик сканирования,
+        # page_count — meta.pageCount первой страницы (оценка плотности, app/services/scan_plan.py)
+        # Диапазон включительно: для date — [start; end 23:59:59.999], для datetime / ms — точно [start; end]
         start_ms = _to_ms(start)
-        end_ms = _to_ms(end + timedelta(days=1)) - 1
+        if isinstance(end, (datetime, int)):
+            end_ms = _to_ms(end)
+        else:
+            end_ms = _to_ms(end + timedelta(days=1)) - 1
 
         field = (filter_field or "creationDate").strip()
         if field not in ALLOWED_DATE_FIELDS:
@@ -57,11 +153,15 @@ class KaspiClient:
 
         # Базовые параметры
         params = {
-            "include": "entries",
-            "page[size]": 200,
-            "page[number]": 1,
+            # Kaspi отдаёт не больше 100 на страницу, нумерация страниц — с 0
+            "page[size]": PAGE_SIZE,
+            "page[number]": 0,
             "filter[orders][by]": field,
         }
+        if profile == "full":
+            params["include"] = "entries"
+        elif fields and KASPI_SPARSE_FIELDS:
+            params["fields[orders]"] = ",".join(dict.fromkeys(f for f in fields if f))
         # Для совместимости с разными версиями API Kaspi:
         # если ищем по creationDate — дублируем в [date]
         if field == "creationDate":
@@ -74,22 +174,18 @@ class KaspiClient:
             # если другое поле — добавляем его собственный диапазон
             params[f"filter[orders][{field}][$ge]"] = start_ms
             params[f"filter[orders][{field}][$le]"] = end_ms
+        if state:
+            params["filter[orders][state]"] = state
 
-        with httpx.Client(base_url=self.base_url, timeout=60.0) as cli:
-            url = "/orders"
-            while True:
-                r = cli.get(url, params=params, headers=self._headers())
-                try:
-                    r.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    raise RuntimeError(f"Kaspi API {r.status_code}: {r.text or e}") from e
-
-                j = r.json()
-                for it in (j.get("data") or []):
-                    yield it
-
-                nxt = (j.get("links") or {}).get("next")
-                if not nxt:
-                    break
-                url = nxt
-                params = {}
+        headers = self._headers()
+        # лимитер тенанта + повторы 429/5xx; страницы после первой — параллельно
+        # (app/services/kaspi_transport.py)
+        pages = kaspi_transport.iter_pages_sync(self._http(), "/orders", token=headers["X-Auth-Token"],
+                                                endpoint="/orders", params=params, headers=headers,
+                                                stats=stats)
+        try:
+            yield from pages
+        except httpx.HTTPStatusError as e:
+            raise RuntimeError(f"Kaspi API {e.response.status_code}: {e.response.text or e}") from e
+        finally:
+            pages.close()
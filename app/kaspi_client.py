@@ -3,7 +3,8 @@ from datetime import datetime, timedelta
 from typing import Dict, Generator, Optional, Any, List, Iterable
 import os
 import httpx
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
+
+from app.services import kaspi_transport
 
 DEFAULT_BASE_URL = "https://kaspi.kz/shop/api/v2"
 
@@ -56,16 +57,14 @@ class KaspiClient:
         return out
 
     # ---------- low-level ----------
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=8),
-        stop=stop_after_attempt(3),
-        reraise=True,
-        retry=retry_if_exception_type((httpx.RequestError, httpx.HTTPStatusError)),
-    )
+    # повторы (только 429/5xx/сеть) и лимиты — в общем транспорте app/services/kaspi_transport.py
+    def _request(self, client: httpx.Client, url: str, params: Optional[Dict[str, Any]]) -> httpx.Response:
+        return kaspi_transport.request_sync(client, "GET", url, token=self._token, params=params)
+
     def _get(self, base_url: str, path: str, params: Dict[str, object]) -> Dict:
         url = f"{base_url}/{path.lstrip('/')}"
         with httpx.Client(headers=self.headers, timeout=self.timeout) as client:
-            resp = client.get(url, params=params)
+            resp = self._request(client, url, params)
             resp.raise_for_status()
             return resp.json()
 
@@ -96,26 +95,23 @@ class KaspiClient:
         if state:
             params["filter[orders][state]"] = state
         base = self._base_urls()[0]  # orders у нас уже работают на shop/api/v2, берём первый
-        while True:
-            data = self._get(base, "orders", params)
-            items = data.get("data", [])
-            for it in items:
-                yield it
-            meta = data.get("meta", {})
-            page_count = meta.get("pageCount")
-            current = int(params["page[number]"])
-            if page_count is not None and current + 1 >= int(page_count):
-                break
-            if not items:
-                break
-            params["page[number]"] = current + 1
+        # страницы после первой — параллельно, по meta.pageCount (kaspi_transport.iter_pages_sync)
+        with httpx.Client(headers=self.headers, timeout=self.timeout) as client:
+            pages = kaspi_transport.iter_pages_sync(client, f"{base}/orders", token=self._token,
+                                                    endpoint="/orders", params=params)
+            try:
+                for data in pages:
+                    for it in data.get("data", []):
+                        yield it
+            finally:
+                pages.close()
 
     # ---------- json:api iterator ----------
     def _iter_jsonapi(self, base_url: str, rel_url: str, params: Optional[Dict[str, Any]] = None) -> Generator[Dict, None, None]:
         url = f"{base_url}/{rel_url.lstrip('/')}"
         with httpx.Client(headers=self.headers, timeout=self.timeout) as client:
             while True:
-                resp = client.get(url, params=params)
+                resp = self._request(client, url, params)
                 resp.raise_for_status()
                 js = resp.json()
                 data = js.get("data") if isinstance(js, dict) else js
@@ -292,7 +288,7 @@ class KaspiClient:
                                 q = {**base_q, **a, **c, **m}
                                 url = f"{base}/{rel.lstrip('/')}"
                                 try:
-                                    r = client.get(url, params=q)
+                                    r = self._request(client, url, q)
                                     ok = r.status_code == 200
                                     count = 0
                                     if ok:
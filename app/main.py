@@ -1,38 +1,89 @@
 from __future__ import annotations
 
 # ---------- imports ----------
+# отсчёт холодного старта — с начала импорта main (см. GET /meta/startup)
+from app.services.startup import StartupReport
+_startup = StartupReport()
+
 import os
 import re
 import uuid
 import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from time import perf_counter as _perf
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, time, date as _date
 from pathlib import Path
-from typing import Optional, Dict, List, Iterable, Tuple, Callable
+from typing import Optional, Dict, List, Iterable, Tuple, Callable, Awaitable
 
 import httpx
 from httpx import HTTPStatusError, RequestError
 import pytz
 from dotenv import load_dotenv
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse, PlainTextResponse, JSONResponse
-from cachetools import TTLCache
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 # multitenant middleware (кладёт tenant токен в request.state)
-from app.deps.auth import attach_kaspi_token_middleware, get_current_kaspi_token
+from app.deps.auth import attach_kaspi_token_middleware, get_current_kaspi_token, kaspi_token_ctx
 
 # доменные роутеры
 from app.api.bridge_v2 import router as bridge_router
 from app.api.profit_fifo import get_profit_fifo_router
 from app.api.authz import router as auth_router
-from app.api.products import get_products_router
+from app.api.products import get_products_router, init_storage as init_products_storage
 from app.api import settings as settings_api
 
 # Kaspi client c поддержкой tenant токена (для /orders)
 from app.deps.kaspi_client_tenant import KaspiClient as TenantKaspiClient
 
+# миграции схемы (один раз при старте)
+from app.services.migrations import run_migrations
+
+# общее состояние воркеров (jobs, кэши): memory | db | redis, см. STATE_BACKEND
+from app.services.state import Namespace, get_backend as get_state_backend
+
+# CPU-стадии (агрегация) — в пуле процессов
+from app.services import cpu_pool
+from app.services.aggregation import (aggregate_orders, aggregate_specs, bd_delta as _bd_delta, bucket_date,
+                                      new_batch, regroup_days, summarize_rollup)
+
+# дневные роллапы для /orders/analytics (таблица daily_order_rollup)
+from app.services import rollup
+
+# метрики Prometheus (GET /metrics) и профилирование запросов (X-Profile, только админы)
+from app.services import metrics, profiling
+
+# общий транспорт Kaspi: лимитер тенанта, повторы 429/5xx, circuit breaker
+from app.services import kaspi_transport
+
+# окна сканирования /orders под плотность заказов тенанта
+from app.services import scan_plan
+
+# чекпойнты сканирования: недочитанные окна возобновляются по resume-токену
+from app.services import scan_checkpoint
+
+# поля и границы сканирования под assign_mode (лаги дат отгрузки от приёма)
+from app.services import scan_fields
+
+# склейка одинаковых одновременных сборов, окон сканирования и обогащений
+from app.services import single_flight
+
+# stale-while-revalidate для ответов дашборда (X-Data-Age)
+from app.services import result_cache
+
+# прогрев дашборда после границы бизнес-дня и cut-off (по тенантам)
+from app.services import warmup
+from app.api import profit_fifo
+
+# серверная загрузка строк заказов Kaspi → bridge_lines
+from app.services import bridge_ingest
+from app.api.profiles import router as profiles_router
+
 # ---------- ENV ----------
 load_dotenv()
 
@@ -52,20 +103,90 @@ DATE_FIELD_OPTIONS = [s.strip() for s in os.getenv(
 CITY_KEYS          = [s.strip() for s in os.getenv("CITY_KEYS", "city,deliveryAddress.city").split(",") if s.strip()]
 
 CHUNK_DAYS  = int(os.getenv("CHUNK_DAYS", "7") or 7)
-CACHE_TTL   = int(os.getenv("CACHE_TTL", "300") or 300)
+JOB_TTL     = int(os.getenv("JOB_TTL", "3600") or 3600)
 
 BUSINESS_DAY_START = os.getenv("BUSINESS_DAY_START", "20:00")   # HH:MM
 USE_BUSINESS_DAY   = os.getenv("USE_BUSINESS_DAY", "true").lower() in ("1","true","yes","on")
 STORE_ACCEPT_UNTIL = os.getenv("STORE_ACCEPT_UNTIL", "17:00")   # HH:MM
 
+# POST /orders/analytics/batch: сколько периодов (виджетов) в одном запросе
+ANALYTICS_BATCH_MAX = int(os.getenv("ANALYTICS_BATCH_MAX", "20") or 20)
+
 ENRICH_CONCURRENCY = int(os.getenv("ENRICH_CONCURRENCY", "6") or 6)
+# первая позиция заказа не меняется — кэшируем надолго (его же заполняет прогрев)
+ENRICH_CACHE_TTL   = int(os.getenv("ENRICH_CACHE_TTL", str(7 * 86400)) or 7 * 86400)
 
 # новый подход: сканируем всегда по одному полю с запасом дней
 SCAN_FIELD        = os.getenv("SCAN_FIELD", "creationDate")
 SCAN_MARGIN_DAYS  = int(os.getenv("SCAN_MARGIN_DAYS", "2") or 2)
+# фильтр statuses → filter[orders][state]: по подскану на статус, если статусов не больше лимита
+SCAN_STATE_PUSHDOWN     = os.getenv("SCAN_STATE_PUSHDOWN", "true").lower() in ("1", "true", "yes", "on")
+SCAN_STATE_PUSHDOWN_MAX = int(os.getenv("SCAN_STATE_PUSHDOWN_MAX", "4") or 4)
+
+# lean-профиль сканирования: только атрибуты, которые читает _scan_window (см. KASPI_SPARSE_FIELDS);
+# город ищется по корням CITY_KEYS — глубокий поиск по остальным атрибутам тут не работает
+SCAN_LEAN_FIELDS = list(dict.fromkeys([
+    "code", "number", "orderNumber", "state", "creationDate", "date", SCAN_FIELD,
+    *DATE_FIELD_OPTIONS, "plannedShipmentDate", "shipmentDate",
+    *(k.split(".")[0] for k in AMOUNT_FIELDS),
+    *(k.split(".")[0] for k in CITY_KEYS),
+]))
+
+MIGRATIONS_RETRY_SEC = float(os.getenv("MIGRATIONS_RETRY_SEC", "5") or 5)
+
+_startup.mark("import")
 
 # ---------- FastAPI ----------
-app = FastAPI(title="Kaspi Orders Analytics")
+async def _migrate_until_ready(app: FastAPI) -> None:
+    # БД была недоступна при старте: повторяем в фоне с экспоненциальной паузой
+    delay = MIGRATIONS_RETRY_SEC
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            app.state.schema = await asyncio.to_thread(run_migrations)
+            return
+        except Exception as e:
+            app.state.schema = {"error": f"{type(e).__name__}: {e}"}
+            delay = min(delay * 2, 300.0)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    retry: Optional[asyncio.Task] = None
+    with _startup.step("storage"):
+        init_products_storage()
+    # схема БД приводится к migrations/ один раз, а не в каждом запросе;
+    # недоступная БД не роняет процесс — /meta и статика работают, миграции догонят
+    try:
+        with _startup.step("migrations"):
+            app.state.schema = await asyncio.to_thread(run_migrations)
+    except Exception as e:
+        app.state.schema = {"error": f"{type(e).__name__}: {e}"}
+        retry = asyncio.create_task(_migrate_until_ready(app))
+    # пул процессов прогревается в фоне и не задерживает готовность к первому запросу
+    pool_warmup = asyncio.create_task(asyncio.to_thread(cpu_pool.start)) if cpu_pool.enabled() else None
+    with _startup.step("state"):
+        backend = get_state_backend()
+        app.state.state_backend = backend.name
+        try:
+            backend.purge_expired()
+        except Exception:
+            pass
+    if warmup.WARMUP_ENABLED:
+        warmup.scheduler = warmup.Scheduler(_warm_tenant, _warmup_tenants, _warmup_tenant, _warm_cycle)
+        warmup.scheduler.start()
+    app.state.startup = _startup.finish()
+    yield
+    if warmup.scheduler is not None:
+        await warmup.scheduler.stop()
+        warmup.scheduler = None
+    if retry is not None:
+        retry.cancel()
+    if pool_warmup is not None:
+        await asyncio.gather(pool_warmup, return_exceptions=True)
+    cpu_pool.shutdown()
+    client.close()
+
+app = FastAPI(title="Kaspi Orders Analytics", lifespan=lifespan)
 
 origins = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()]
 if origins:
@@ -77,14 +198,48 @@ if origins:
         allow_credentials=False,
     )
 
+# профиль запроса — внутри мидлвары токена: ей нужен tenant_id для проверки админа
+app.middleware("http")(profiling.profiling_middleware)
 # кладём токен в request.state
 app.middleware("http")(attach_kaspi_token_middleware)
+# латентность по маршрутам — внешний слой, учитывает и резолв токена
+app.middleware("http")(metrics.http_metrics_middleware)
+
+@app.exception_handler(cpu_pool.CpuPoolBusy)
+async def _cpu_pool_busy(_request, exc: cpu_pool.CpuPoolBusy):
+    # back-pressure: пул занят — просим клиента повторить, а не копим очередь
+    return JSONResponse({"detail": str(exc)}, status_code=503, headers={"Retry-After": "5"})
+
+@app.exception_handler(kaspi_transport.KaspiUnavailable)
+async def _kaspi_unavailable(_request, exc: kaspi_transport.KaspiUnavailable):
+    # circuit breaker открыт — не ждём таймаутов Kaspi, сразу отвечаем 503
+    return JSONResponse({"detail": str(exc)}, status_code=503,
+                        headers={"Retry-After": str(max(1, int(exc.retry_after)))})
+
+@app.exception_handler(scan_checkpoint.ScanIncomplete)
+async def _scan_incomplete(_request, exc: scan_checkpoint.ScanIncomplete):
+    # прочитанные окна сохранены — повтор с resume=<token> дочитает только недостающие
+    if exc.retry_after is not None:
+        return JSONResponse(exc.as_dict(), status_code=503,
+                            headers={"Retry-After": str(max(1, int(exc.retry_after)))})
+    return JSONResponse(exc.as_dict(), status_code=502)
+
+@metrics.on_scrape
+def _cpu_pool_metrics() -> None:
+    st = cpu_pool.stats()
+    metrics.CPU_POOL_SIZE.set(st["size"] if st["started"] else 0)
+    metrics.CPU_POOL_PENDING.set(st["pending"])
 
 # tenant-aware клиент для /orders
 client = TenantKaspiClient(base_url=KASPI_BASE_URL)
 
-# кэш для entries (пока не используем активно, но оставим)
-orders_cache = TTLCache(maxsize=512, ttl=CACHE_TTL)
+# кэш для entries (пока не используем активно, но оставим); общий для всех воркеров
+order_items_cache = Namespace("order_items", ttl=ENRICH_CACHE_TTL)
+
+# одновременные одинаковые вычисления в процессе — одно на всех (app/services/single_flight.py)
+_collect_flight = single_flight.Group("collect_range")
+_window_flight = single_flight.Group("scan_window")
+_enrich_flight = single_flight.Group("enrich")
 
 # /ui статика (best-effort)
 _ui_candidates = ("app/static", "app/ui", "static", "ui")
@@ -98,6 +253,7 @@ app.include_router(get_profit_fifo_router(), prefix="/profit")
 app.include_router(bridge_router, prefix="/profit")
 app.include_router(auth_router)
 app.include_router(settings_api.router, prefix="/settings", tags=["settings"])
+app.include_router(profiles_router)
 
 # ---------- helpers ----------
 RU_STATUS_MAP = {
@@ -116,13 +272,6 @@ RU_STATUS_MAP = {
     "ОТМЕНЕН": "CANCELED",
 }
 
-def _bd_delta(hhmm: str) -> timedelta:
-    try:
-        h, m = hhmm.split(":")
-        return timedelta(hours=int(h), minutes=int(m))
-    except Exception:
-        return timedelta(0)
-
 def norm_state(s: str) -> str:
     return (s or "").strip().upper()
 
@@ -247,12 +396,6 @@ def extract_ms(attrs: dict, field: str) -> Optional[int]:
         except Exception:
             return None
 
-def bucket_date(dt_local: datetime, use_bd: bool, bd_start: str) -> str:
-    if use_bd:
-        shift = timedelta(hours=24) - _bd_delta(bd_start)
-        return (dt_local + shift).date().isoformat()
-    return dt_local.date().isoformat()
-
 def _guess_number(attrs: dict, fallback_id: str) -> str:
     for k in ("number", "code", "orderNumber"):
         v = attrs.get(k)
@@ -282,40 +425,6 @@ def _async_client(scale: float = 1.0):
         limits=HTTPX_LIMITS,
     )
 
-# ---------- «умный» операционный день ----------
-_DELIVERED_STATES = {"KASPI_DELIVERY", "DELIVERED", "ARCHIVE", "ARCHIVED"}
-
-def _smart_operational_day(attrs: dict, state: str, tzinfo: pytz.BaseTzInfo,
-                           store_accept_until: str, business_day_start: str) -> Tuple[str, str]:
-    ms_creation = extract_ms(attrs, "creationDate")
-    ms_planned  = extract_ms(attrs, "plannedShipmentDate")
-    ms_ship     = extract_ms(attrs, "shipmentDate")
-
-    dt_creation = datetime.fromtimestamp(ms_creation/1000, tz=pytz.UTC).astimezone(tzinfo) if ms_creation else None
-    dt_planned  = datetime.fromtimestamp(ms_planned/1000,  tz=pytz.UTC).astimezone(tzinfo) if ms_planned  else None
-    dt_ship     = datetime.fromtimestamp(ms_ship/1000,     tz=pytz.UTC).astimezone(tzinfo) if ms_ship     else None
-
-    # доставленные — считаем по бизнес-дню (20:00→20:00)
-    if state in _DELIVERED_STATES:
-        base = dt_ship or dt_planned or dt_creation or datetime.now(tzinfo)
-        shift = timedelta(hours=24) - _bd_delta(business_day_start)
-        return (base + shift).date().isoformat(), "delivered_business_day"
-
-    # если есть план — берём плановую дату (дата без времени)
-    if dt_planned:
-        return dt_planned.date().isoformat(), "planned"
-
-    # приём до HH:MM — после cut-off переносим на завтра
-    cutoff_h, cutoff_m = map(int, store_accept_until.split(":"))
-    cutoff = time(cutoff_h, cutoff_m, 0)
-    if dt_creation:
-        if dt_creation.time() <= cutoff:
-            return dt_creation.date().isoformat(), "created_before_cutoff"
-        else:
-            return (dt_creation + timedelta(days=1)).date().isoformat(), "created_after_cutoff_next_day"
-
-    return datetime.now(tzinfo).date().isoformat(), "fallback_now"
-
 # ---------- обогащение позиций ----------
 async def _first_item_details(order_id: str, timeout_scale: float = 1.0) -> Optional[Dict[str, object]]:
     token = get_current_kaspi_token()
@@ -329,62 +438,92 @@ async def _first_item_details(order_id: str, timeout_scale: float = 1.0) -> Opti
         "User-Agent": "leo-analytics/1.0",
     }
 
-    async with _async_client(scale=timeout_scale) as cli:
-        # 1) быстрый путь — /orderentries
-        try:
-            r = await cli.get("/orderentries",
-                              params={"filter[order.id]": order_id, "page[size]": "200"},
-                              headers=headers)
-            r.raise_for_status()
-            j = r.json()
-            data = (j.get("data") or [])
-            if data:
-                attrs_e = data[0].get("attributes", {}) or {}
-                title = ""
-                for key in ("offerName","title","name","productName","shortName"):
-                    v = attrs_e.get(key)
-                    if isinstance(v, str) and v.strip():
-                        title = v.strip(); break
-                sku = ""
-                for key in ("sku","code","productCode"):
-                    v = attrs_e.get(key)
-                    if isinstance(v, str) and v.strip():
-                        sku = v.strip(); break
-                off = attrs_e.get("offer") or {}
-                if isinstance(off, dict) and off.get("code"):
-                    sku = off["code"]
-                return {"sku": sku, "title": title}
-        except Exception:
-            pass
+    with profiling.span("first_item_details", order_id=order_id):
+        async with _async_client(scale=timeout_scale) as cli:
+            # 1) быстрый путь — /orderentries
+            try:
+                r = await kaspi_transport.request(cli, "GET", "/orderentries", token=token,
+                                                  endpoint="/orderentries",
+                                                  params={"filter[order.id]": order_id, "page[size]": "200"},
+                                                  headers=headers)
+                r.raise_for_status()
+                j = kaspi_transport.json_of(r)
+                data = (j.get("data") or [])
+                if data:
+                    attrs_e = data[0].get("attributes", {}) or {}
+                    title = ""
+                    for key in ("offerName","title","name","productName","shortName"):
+                        v = attrs_e.get(key)
+                        if isinstance(v, str) and v.strip():
+                            title = v.strip(); break
+                    sku = ""
+                    for key in ("sku","code","productCode"):
+                        v = attrs_e.get(key)
+                        if isinstance(v, str) and v.strip():
+                            sku = v.strip(); break
+                    off = attrs_e.get("offer") or {}
+                    if isinstance(off, dict) and off.get("code"):
+                        sku = off["code"]
+                    return {"sku": sku, "title": title}
+            except kaspi_transport.KaspiUnavailable:
+                metrics.ENRICH_ERRORS.inc(endpoint="/orderentries", error="breaker_open")
+                return None
+            except (httpx.HTTPError, ValueError) as e:
+                metrics.ENRICH_ERRORS.inc(endpoint="/orderentries", error=type(e).__name__)
+
+            # 2) запасной путь — /orders/{id}/entries
+            try:
+                r = await kaspi_transport.request(cli, "GET", f"/orders/{order_id}/entries", token=token,
+                                                  endpoint="/orders/{id}/entries",
+                                                  params={"page[size]": "200"},
+                                                  headers=headers)
+                r.raise_for_status()
+                j = kaspi_transport.json_of(r)
+                data = j.get("data") or []
+                if data:
+                    attrs_e = data[0].get("attributes", {}) or {}
+                    title = ""
+                    for key in ("offerName","title","name","productName","shortName"):
+                        v = attrs_e.get(key)
+                        if isinstance(v, str) and v.strip():
+                            title = v.strip(); break
+                    sku = ""
+                    off = attrs_e.get("offer") or {}
+                    if isinstance(off, dict) and off.get("code"):
+                        sku = off["code"]
+                    for key in ("sku","code","productCode"):
+                        v = attrs_e.get(key)
+                        if isinstance(v, str) and v.strip():
+                            sku = v.strip(); break
+                    return {"sku": sku, "title": title}
+            except kaspi_transport.KaspiUnavailable:
+                metrics.ENRICH_ERRORS.inc(endpoint="/orders/{id}/entries", error="breaker_open")
+            except (httpx.HTTPError, ValueError) as e:
+                metrics.ENRICH_ERRORS.inc(endpoint="/orders/{id}/entries", error=type(e).__name__)
 
-        # 2) запасной путь — /orders/{id}/entries
-        try:
-            r = await cli.get(f"/orders/{order_id}/entries",
-                              params={"page[size]": "200"},
-                              headers=headers)
-            r.raise_for_status()
-            j = r.json()
-            data = j.get("data") or []
-            if data:
-                attrs_e = data[0].get("attributes", {}) or {}
-                title = ""
-                for key in ("offerName","title","name","productName","shortName"):
-                    v = attrs_e.get(key)
-                    if isinstance(v, str) and v.strip():
-                        title = v.strip(); break
-                sku = ""
-                off = attrs_e.get("offer") or {}
-                if isinstance(off, dict) and off.get("code"):
-                    sku = off["code"]
-                for key in ("sku","code","productCode"):
-                    v = attrs_e.get(key)
-                    if isinstance(v, str) and v.strip():
-                        sku = v.strip(); break
-                return {"sku": sku, "title": title}
-        except Exception:
-            pass
+        return None
 
-    return None
+async def _item_details_cached(order_id: str, timeout_scale: float = 1.0) -> Optional[Dict[str, object]]:
+    """_first_item_details через кэш order_items (ключ — магазин Kaspi + id заказа)."""
+    key = f"{kaspi_transport.tenant_key(get_current_kaspi_token())}:{order_id}"
+    try:
+        hit = await order_items_cache.aget(key)
+    except Exception:
+        hit = None
+    if hit is not None:
+        return hit
+
+    async def fetch() -> Optional[Dict[str, object]]:
+        extra = await _first_item_details(order_id, timeout_scale=timeout_scale)
+        if extra:
+            try:
+                await order_items_cache.aset(key, extra)
+            except Exception:
+                pass
+        return extra
+
+    # тот же заказ уже обогащается для другого запроса — ждём его ответ
+    return await _enrich_flight.run(key, fetch)
 
 # ---------- модели ----------
 class DayPoint(BaseModel):
@@ -407,6 +546,14 @@ class AnalyticsResponse(BaseModel):
     prev_days: List[DayPoint] = []
     cities: List[CityCount] = []
     state_breakdown: Dict[str, int] = {}
+    complete: bool = True
+    missing_windows: List[Dict[str, str]] = []
+    resume_token: Optional[str] = None
+    deadline_exceeded: bool = False
+    days_covered: Optional[List[str]] = None
+    granularity: str = "day"
+    heatmap: Optional[Dict[str, object]] = None
+    debug: Optional[Dict[str, object]] = None
 
 # ---------- META ----------
 @app.get("/auth/meta", tags=["auth"])
@@ -419,6 +566,7 @@ def auth_meta():
 
 @app.get("/meta")
 async def meta():
+    schema = getattr(app.state, "schema", None) or {}
     return {
         "shop": SHOP_NAME,
         "partner_id": PARTNER_ID,
@@ -427,6 +575,7 @@ async def meta():
         "amount_fields": AMOUNT_FIELDS,
         "divisor": AMOUNT_DIVISOR,
         "chunk_days": CHUNK_DAYS,
+        "scan_target_pages": scan_plan.SCAN_TARGET_PAGES,
         "date_field_default": DATE_FIELD_DEFAULT,
         "date_field_options": DATE_FIELD_OPTIONS,
         "city_keys": CITY_KEYS,
@@ -435,8 +584,21 @@ async def meta():
         "store_accept_until": STORE_ACCEPT_UNTIL,
         "scan_field": SCAN_FIELD,
         "scan_margin_days": SCAN_MARGIN_DAYS,
+        "schema_version": schema.get("version"),
+        "state_backend": getattr(app.state, "state_backend", None),
     }
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(request: Request):
+    if not metrics.check_token(request):
+        raise HTTPException(status_code=401, detail="unauthorized")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/meta/startup")
+async def meta_startup():
+    schema = getattr(app.state, "schema", None) or {}
+    return {**(getattr(app.state, "startup", None) or _startup.as_dict()), "schema": schema}
+
 # ---------- утилиты состояний ----------
 def _normalize_states_inc(states_inc: set[str] | None, expand_archive: bool = False) -> set[str]:
     if not states_inc:
@@ -447,123 +609,430 @@ def _normalize_states_inc(states_inc: set[str] | None, expand_archive: bool = Fa
     return out
 
 # ---------- ядро сбора ----------
-def _collect_range(
-    start_dt: datetime, end_dt: datetime, tz: str, date_field: str,
-    states_inc: Optional[set], states_ex: set,
-    assign_mode: str, store_accept_until: str, business_day_start: str,
-) -> tuple[list[DayPoint], Dict[str, int], int, float, Dict[str, int], List[Dict[str, object]]]:
-
-    tzinfo = tzinfo_of(tz)
-
-    # широкое окно сканирования: чтобы не потерять «переехавшие» заказы
-    scan_start = start_dt - timedelta(days=SCAN_MARGIN_DAYS)
-    scan_end   = end_dt   + timedelta(days=SCAN_MARGIN_DAYS)
-
+# Две фазы: сканирование (I/O, поток) собирает колоночный батч заказов, агрегация
+# (CPU, app.services.aggregation) считает дни/города/статусы — на больших батчах в cpu_pool.
+def _scan_window(
+    field: str, start_ms: int, end_ms: int, date_field: str,
+    states_inc: set, states_ex: set,
+    state: Optional[str] = None,
+) -> tuple[Dict[str, list], Dict[str, int], Dict[str, float]]:
+    """
+    Один кусок плана: колоночный батч, заказов по UTC-суткам поля field (до фильтра статусов) и stats.
+    state — подскан одного статуса (filter[orders][state]); счётчики по суткам тогда неполные.
+    То же окно, которое уже читает другой запрос тенанта, не запрашивается повторно.
+    """
+    k = single_flight.key(kaspi_transport.tenant_key(get_current_kaspi_token()),
+                          field, start_ms, end_ms, date_field, states_inc, states_ex, state)
+    return _window_flight.run_sync(
+        k, lambda: _fetch_window(field, start_ms, end_ms, date_field, states_inc, states_ex, state))
+
+def _fetch_window(
+    field: str, start_ms: int, end_ms: int, date_field: str,
+    states_inc: set, states_ex: set,
+    state: Optional[str] = None,
+) -> tuple[Dict[str, list], Dict[str, int], Dict[str, float]]:
+    batch = new_batch()
     seen_ids: set[str] = set()
-    day_counts: Dict[str, int]    = {}
-    day_amounts: Dict[str, float] = {}
-    city_counts: Dict[str, int]   = {}
-    state_counts: Dict[str, int]  = {}
-
-    total_orders = 0
-    total_amount = 0.0
-    flat_out: List[Dict[str, object]] = []
-
-    states_inc = _normalize_states_inc(states_inc, expand_archive=True)
-
-    want_start_day = start_dt.astimezone(tzinfo).date().isoformat()
-    want_end_day   = end_dt.astimezone(tzinfo).date().isoformat()
-
-    if client is None:
-        raise HTTPException(status_code=500, detail="Kaspi client not configured")
+    day_counts: Dict[str, int] = {}
+    stats: Dict[str, float] = {}
 
-    for s, e in iter_chunks(scan_start, scan_end, CHUNK_DAYS):
+    with profiling.span("scan.window", field=field, start_ms=start_ms, end_ms=end_ms, state=state or ""):
         try:
-            for order in client.iter_orders(start=s, end=e, filter_field=SCAN_FIELD):
+            for order in client.iter_orders(start=start_ms, end=end_ms, filter_field=field, stats=stats,
+                                            profile="lean", fields=SCAN_LEAN_FIELDS, state=state):
                 oid = str(order.get("id"))
                 if oid in seen_ids:
                     continue
+                seen_ids.add(oid)
 
                 attrs = order.get("attributes", {}) or {}
 
+                ms_scan = extract_ms(attrs, field)
+                if ms_scan is not None:
+                    day = scan_plan.day_of(ms_scan)
+                    day_counts[day] = day_counts.get(day, 0) + 1
+
                 st = norm_state(str(attrs.get("state", "")))
                 if states_inc and st not in states_inc:
                     continue
                 if st in states_ex:
                     continue
 
-                # время приёма: всегда creationDate (даже если SCAN_FIELD иной)
+                # время приёма: всегда creationDate (даже если скан по другому полю)
                 ms_accept = extract_ms(attrs, "creationDate")
                 if ms_accept is None:
                     continue
-                dt_accept  = datetime.fromtimestamp(ms_accept / 1000, tz=pytz.UTC).astimezone(tzinfo)
-                day_accept = dt_accept.date().isoformat()
 
+                batch["id"].append(oid)
+                batch["number"].append(_guess_number(attrs, oid))
+                batch["state"].append(st)
+                batch["ms_creation"].append(ms_accept)
                 # поворотное поле (из UI) — для business/диагностики
-                ms_pivot = extract_ms(attrs, date_field) or ms_accept
-                dt_pivot = datetime.fromtimestamp(ms_pivot / 1000, tz=pytz.UTC).astimezone(tzinfo)
-
-                # определяем день принадлежности
-                if assign_mode == "smart":
-                    op_day, reason = _smart_operational_day(attrs, st, tzinfo, store_accept_until, business_day_start)
-                    if not (want_start_day <= op_day <= want_end_day):
-                        continue
-                elif assign_mode == "business":
-                    op_day, reason = bucket_date(dt_pivot, use_bd=True, bd_start=business_day_start), "business"
-                    if not (want_start_day <= op_day <= want_end_day):
-                        continue
-                else:
-                    # raw: точная фильтрация по времени приёма
-                    if not (start_dt <= dt_accept <= end_dt):
-                        continue
-                    op_day, reason = day_accept, "raw"
-
-                amt  = extract_amount(attrs)
-                city = extract_city(attrs)
-
-                day_counts[op_day]  = day_counts.get(op_day, 0) + 1
-                day_amounts[op_day] = day_amounts.get(op_day, 0.0) + amt
-                if city:
-                    city_counts[city] = city_counts.get(city, 0) + 1
-                state_counts[st] = state_counts.get(st, 0) + 1
-
-                total_orders += 1
-                total_amount += amt
-
-                flat_out.append({
-                    "id": oid,
-                    "number": _guess_number(attrs, oid),
-                    "state": st,
-                    "date": dt_accept.isoformat(),       # приём
-                    "date_ms": ms_accept,                # мс приёма
-                    "date_pivot": dt_pivot.isoformat(),  # поворотное поле
-                    "op_day": op_day,
-                    "op_reason": reason,
-                    "amount": round(amt, 2),
-                    "city": city,
-                })
-
-                seen_ids.add(oid)
+                batch["ms_pivot"].append(extract_ms(attrs, date_field) or ms_accept)
+                batch["ms_planned"].append(extract_ms(attrs, "plannedShipmentDate"))
+                batch["ms_ship"].append(extract_ms(attrs, "shipmentDate"))
+                batch["amount"].append(extract_amount(attrs))
+                batch["city"].append(extract_city(attrs))
 
         except HTTPStatusError as ee:
-            raise HTTPException(status_code=502, detail=f"Scan failed for field '{SCAN_FIELD}': {ee}")
+            raise HTTPException(status_code=502, detail=f"Scan failed for field '{field}': {ee}")
         except RequestError as e:
             raise HTTPException(status_code=502, detail=f"Network: {e}")
 
-    # ось дней
-    out_days: List[DayPoint] = []
-    cur = start_dt.astimezone(tzinfo).date()
-    end_d = end_dt.astimezone(tzinfo).date()
-    while cur <= end_d:
-        key = cur.isoformat()
-        out_days.append(DayPoint(x=key, count=day_counts.get(key, 0), amount=round(day_amounts.get(key, 0.0), 2)))
-        cur = cur + timedelta(days=1)
+    return batch, day_counts, stats
+
+def _scan_range(
+    scans: List[scan_fields.Scan], date_field: str,
+    states_inc: set, states_ex: set,
+    stats: Optional[Dict[str, float]] = None,
+) -> Dict[str, list]:
+    # сканы — от планировщика полей (app/services/scan_fields.py); окна каждого — по плотности
+    # заказов тенанта по этому полю (app/services/scan_plan.py), все окна читаются одним пулом
+    token = get_current_kaspi_token()
+    sess = scan_checkpoint.current()
+
+    # возобновление (resume=…): план окон и готовые окна прошлой попытки — по каждому скану
+    units: List[Dict[str, object]] = []
+    for sc in scans:
+        sig = scan_checkpoint.signature(token, sc.field, sc.start_ms, sc.end_ms, date_field, states_inc, states_ex)
+        windows, stored = scan_checkpoint.load(sess.token if sess else None, sig)
+        if windows is None:
+            windows = scan_plan.plan(sc.start_ms, sc.end_ms, scan_plan.load(token, sc.field), default_days=CHUNK_DAYS)
+        units.append({"scan": sc, "sig": sig, "windows": windows, "stored": stored,
+                      "results": [stored.get(i) for i in range(len(windows))]})
+
+    # включающий фильтр статусов — на стороне Kaspi: по подскану на статус в каждом окне;
+    # исключения (states_ex) и сверка статуса остаются в _scan_window
+    pushdown = sorted(states_inc) if SCAN_STATE_PUSHDOWN and 0 < len(states_inc) <= SCAN_STATE_PUSHDOWN_MAX else [None]
+    jobs = [(u, i, st) for u, unit in enumerate(units)
+            for i in range(len(unit["windows"])) if i not in unit["stored"]
+            for st in pushdown]
+    workers = scan_plan.parallelism(token, len(jobs))
+    deadline = sess.remaining() if sess is not None else None
+
+    parts: Dict[Tuple[int, int], List[tuple]] = {}
+    errors: Dict[Tuple[int, int], BaseException] = {}
+    late: set = set()     # окна, не дочитанные к дедлайну запроса
+    try:
+        if deadline is not None and deadline <= 0:
+            late = {(u, i) for u, i, _ in jobs}
+        elif workers <= 1 and deadline is None:
+            for u, i, st in jobs:
+                if (u, i) in errors:
+                    continue
+                try:
+                    parts.setdefault((u, i), []).append(
+                        _scan_window(units[u]["scan"].field, *units[u]["windows"][i], date_field, states_inc, states_ex, st))
+                except (HTTPException, RuntimeError) as exc:
+                    errors[(u, i)] = exc
+        else:
+            # у каждого потока своя копия контекста: токен тенанта, профиль запроса, сессия сканирования
+            pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scan")
+            try:
+                futures = [
+                    ((u, i), pool.submit(contextvars.copy_context().run, _scan_window,
+                                         units[u]["scan"].field, *units[u]["windows"][i],
+                                         date_field, states_inc, states_ex, st))
+                    for u, i, st in jobs
+                ]
+                for ui, fut in futures:
+                    try:
+                        parts.setdefault(ui, []).append(
+                            fut.result(timeout=None if sess is None else sess.remaining()))
+                    except FutureTimeout:
+                        late.add(ui)
+                    except (HTTPException, RuntimeError) as exc:
+                        errors.setdefault(ui, exc)
+            finally:
+                # к дедлайну не успели: очередь снимаем, начатые окна дочитываются без нас —
+                # их подхватит фоновый пересчёт (single-flight окна) или следующий запрос
+                pool.shutdown(wait=not late, cancel_futures=bool(late))
+        for (u, i), window_parts in parts.items():
+            if (u, i) not in errors and (u, i) not in late:
+                units[u]["results"][i] = _merge_parts(window_parts)
+    finally:
+        # плотность учится только на полных сканах: подсканы статусов видят часть заказов
+        if pushdown == [None]:
+            for unit in units:
+                sc = unit["scan"]
+                _learn_density(token, sc.field, unit["windows"], unit["results"], sc.start_ms, sc.end_ms)
+
+    if errors or late:
+        # готовые окна не теряем: сохраняем под токеном сессии (или новым) и отдаём его клиенту
+        scan_checkpoint.SCAN_WINDOWS_FAILED.inc(len(errors))
+        resume = (sess.token if sess else None) or scan_checkpoint.new_token()
+        if sess is not None:
+            sess.token = resume
+        for unit in units:
+            scan_checkpoint.save(resume, unit["sig"], unit["windows"], unit["results"], unit["stored"])
+        missing = [units[u]["windows"][i] for u, i in sorted(set(errors) | late)]
+        retry_after: Optional[float] = None
+        if errors:
+            first = errors[min(errors)]
+            error = first.detail if isinstance(first, HTTPException) else str(first)
+            retry_after = getattr(first, "retry_after", None)
+        else:
+            error = "deadline exceeded"
+        # дедлайн — всегда частичный ответ; ошибки окон — только с partial
+        if sess is None or not (sess.partial or late):
+            raise scan_checkpoint.ScanIncomplete(
+                resume, missing, error,
+                retry_after=retry_after,
+            )
+        sess.missing.extend(missing)
+        sess.error = sess.error or error
+        sess.deadline_hit = sess.deadline_hit or bool(late)
+    else:
+        for unit in units:
+            if unit["stored"]:
+                scan_checkpoint.discard(sess.token, unit["sig"], unit["stored"])
+
+    batch = new_batch()
+    seen_ids: set[str] = set()
+    for unit in units:
+        for w, res in enumerate(unit["results"]):
+            if res is None:
+                continue
+            part, _, part_stats = res
+            for i, oid in enumerate(part["id"]):
+                if oid in seen_ids:
+                    continue
+                seen_ids.add(oid)
+                for col, values in part.items():
+                    batch[col].append(values[i])
+            if stats is not None and w not in unit["stored"]:
+                stats["pages"] = stats.get("pages", 0) + part_stats.get("pages", 0)
+                stats["fetch_s"] = stats.get("fetch_s", 0.0) + part_stats.get("fetch_s", 0.0)
+    # лаги дат отгрузки относительно приёма — для следующих планов (кандидат "lag")
+    scan_fields.observe_lags(token, batch, date_field)
+    if stats is not None:
+        stats["windows"] = sum(len(unit["windows"]) for unit in units)
+        stats["windows_resumed"] = sum(len(unit["stored"]) for unit in units)
+        stats["state_subscans"] = len(pushdown) if pushdown != [None] else 0
+    return batch
+
+def _merge_parts(parts: List[tuple]) -> tuple[Dict[str, list], Dict[str, int], Dict[str, float]]:
+    """Подсканы статусов одного окна → один результат окна (дубли id снимает _scan_range)."""
+    if len(parts) == 1:
+        return parts[0]
+    batch = new_batch()
+    day_counts: Dict[str, int] = {}
+    stats: Dict[str, float] = {}
+    for part, part_days, part_stats in parts:
+        for col, values in part.items():
+            batch[col].extend(values)
+        for day, n in part_days.items():
+            day_counts[day] = day_counts.get(day, 0) + n
+        for k, v in part_stats.items():
+            stats[k] = stats.get(k, 0) + v
+    return batch, day_counts, stats
+
+def _learn_density(token: Optional[str], field: str, windows: List[Tuple[int, int]], results: List[Optional[tuple]],
+                   start_ms: int, end_ms: int) -> None:
+    # точный счёт — только по суткам, целиком покрытым прочитанными кусками; остальное — оценка по pageCount
+    counts: Dict[str, int] = {}
+    estimates: Dict[str, float] = {}
+    done = all(r is not None for r in results)
+    for (s, e), res in zip(windows, results):
+        if res is None:
+            continue
+        _, day_counts, part_stats = res
+        for day, n in day_counts.items():
+            counts[day] = counts.get(day, 0) + n
+        if "page_count" in part_stats:
+            estimates.update(scan_plan.estimates_from_page_count((s, e), int(part_stats["page_count"])))
+    exact = scan_plan.full_days(counts, start_ms, end_ms) if done else {}
+    scan_plan.observe(token, field, day_counts=exact, estimates=estimates)
+
+async def _collect_range(
+    start_dt: datetime, end_dt: datetime, tz: str, date_field: str,
+    states_inc: Optional[set], states_ex: set,
+    assign_mode: str, store_accept_until: str, business_day_start: str,
+    hours: bool = False, heatmap: bool = False,
+) -> tuple[list[DayPoint], Dict[str, int], int, float, Dict[str, int], List[Dict[str, object]], Dict[str, object]]:
+    """
+    Сбор периода; одинаковые одновременные сборы тенанта (операторы одного магазина, текущий
+    период в analytics и ids) выполняются один раз. Результат общий — rows не менять на месте.
+    Последний элемент — {"hours", "heatmap"} того же прохода агрегации (если запрошены).
+    """
+    sess = scan_checkpoint.current()
+    resume, partial, deadline = (sess.token, sess.partial, sess.deadline) if sess is not None else (None, False, None)
+    # дедлайн — в ключе целиком: иначе присоединившийся получил бы результат, обрезанный по чужому
+    # сроку (раньше или позже своего). Запросы с дедлайном общий сбор поэтому не делят, но чтение
+    # Kaspi у них всё равно общее — single-flight окон в _scan_window, где каждый ждёт до своего срока
+    k = single_flight.key(
+        kaspi_transport.tenant_key(get_current_kaspi_token()),
+        round(start_dt.timestamp() * 1000), round(end_dt.timestamp() * 1000), tz, date_field,
+        states_inc or set(), states_ex, assign_mode, store_accept_until, business_day_start, resume, partial,
+        deadline, hours, heatmap,
+    )
+
+    async def collect():
+        # своя сессия сканирования у общего вычисления: недочитанные окна и планы — каждому ожидающему
+        inner = scan_checkpoint.begin(resume, partial, deadline)
+        res = await _collect_range_once(start_dt, end_dt, tz, date_field, states_inc, states_ex,
+                                        assign_mode, store_accept_until, business_day_start,
+                                        hours=hours, heatmap=heatmap)
+        return res, inner
+
+    res, inner = await _collect_flight.run(k, collect)
+    if sess is not None:
+        sess.plans.extend(inner.plans)
+        sess.missing.extend(inner.missing)
+        sess.token = inner.token or sess.token
+        sess.error = sess.error or inner.error
+        sess.deadline_hit = sess.deadline_hit or inner.deadline_hit
+    return res
+
+async def _collect_range_once(
+    start_dt: datetime, end_dt: datetime, tz: str, date_field: str,
+    states_inc: Optional[set], states_ex: set,
+    assign_mode: str, store_accept_until: str, business_day_start: str,
+    hours: bool = False, heatmap: bool = False,
+) -> tuple[list[DayPoint], Dict[str, int], int, float, Dict[str, int], List[Dict[str, object]], Dict[str, object]]:
+
+    with profiling.span("collect_range", assign_mode=assign_mode):
+        tzinfo = tzinfo_of(tz)
+
+        states_inc = _normalize_states_inc(states_inc, expand_archive=True)
+
+        if client is None:
+            raise HTTPException(status_code=500, detail="Kaspi client not configured")
+
+        # какие поля и интервалы читать, чтобы покрыть операционные дни режима
+        start_ms = round(start_dt.timestamp() * 1000)
+        end_ms = round(end_dt.timestamp() * 1000)
+        start_day = start_dt.astimezone(tzinfo).date().isoformat()
+        end_day = end_dt.astimezone(tzinfo).date().isoformat()
+        plan = await asyncio.to_thread(
+            scan_fields.plan,
+            assign_mode, start_ms=start_ms, end_ms=end_ms, start_day=start_day, end_day=end_day, tz=tz,
+            date_field=date_field, store_accept_until=store_accept_until, business_day_start=business_day_start,
+            token=get_current_kaspi_token(), margin_days=SCAN_MARGIN_DAYS, base_field=SCAN_FIELD,
+        )
+        sess = scan_checkpoint.current()
+        if sess is not None:
+            sess.plans.append(plan.as_dict())
+
+        # fetch — ожидание Kaspi (+ разбор JSON), normalize — остаток сканирования (колоночный батч)
+        scan_stats: Dict[str, float] = {}
+        t_scan = _perf()
+        with profiling.span("collect_range.scan"):
+            batch = await asyncio.to_thread(_scan_range, plan.scans, date_field, states_inc, states_ex, scan_stats)
+        scan_s = _perf() - t_scan
+        fetch_s = scan_stats.get("fetch_s", 0.0)
+        metrics.COLLECT_PHASE.observe(fetch_s, phase="fetch")
+        metrics.COLLECT_PHASE.observe(max(0.0, scan_s - fetch_s), phase="normalize")
+        metrics.KASPI_SCAN_PAGES.observe(scan_stats.get("pages", 0))
+        metrics.COLLECT_ORDERS.inc(len(batch["id"]))
+
+        t_agg = _perf()
+        with profiling.span("collect_range.aggregate", orders=len(batch["id"])):
+            agg = await cpu_pool.run(
+                aggregate_orders, batch,
+                tz=tz,
+                start_ms=start_ms,
+                end_ms=end_ms,
+                start_day=start_day,
+                end_day=end_day,
+                assign_mode=assign_mode,
+                store_accept_until=store_accept_until,
+                business_day_start=business_day_start,
+                hours=hours,
+                heatmap=heatmap,
+                inline=len(batch["id"]) < cpu_pool.CPU_POOL_MIN_ROWS,
+            )
+        metrics.COLLECT_PHASE.observe(_perf() - t_agg, phase="aggregate")
+
+        out_days = [DayPoint(**d) for d in agg["days"]]
+        extra = {k: agg[k] for k in ("hours", "heatmap") if k in agg}
+        return out_days, agg["cities"], agg["total_orders"], agg["total_amount"], agg["states"], agg["rows"], extra
+
+async def _rollup_range(
+    start_dt: datetime, end_dt: datetime, tz: str, date_field: str,
+    states_inc: Optional[set], states_ex: set,
+    assign_mode: str, store_accept_until: str, business_day_start: str,
+) -> tuple[list[DayPoint], Dict[str, int], int, float, Dict[str, int]]:
+    """
+    Как _collect_range (без rows), но из daily_order_rollup: из Kaspi досканируются
+    только отсутствующие и устаревшие горячие дни (без фильтра статусов — он применяется при чтении).
+    """
+    with profiling.span("rollup_range", assign_mode=assign_mode):
+        tzinfo = tzinfo_of(tz)
+        start_day = start_dt.astimezone(tzinfo).date().isoformat()
+        end_day = end_dt.astimezone(tzinfo).date().isoformat()
+        tenant = kaspi_transport.tenant_key(get_current_kaspi_token())
+        var = rollup.variant(assign_mode, tz=tz, date_field=date_field,
+                             store_accept_until=store_accept_until, business_day_start=business_day_start)
+
+        built = await asyncio.to_thread(rollup.built, tenant, assign_mode, var, start_day, end_day)
+        days = rollup.day_range(start_day, end_day)
+        stale = rollup.stale_days(days, built)
+        rollup.ROLLUP_DAYS.inc(len(days) - len(stale), result="hit")
+        rollup.ROLLUP_DAYS.inc(len(stale), result="rebuilt")
+
+        today = datetime.now(tzinfo).date()
+        sess = scan_checkpoint.current()
+        partial_days: set = set()
+        partial_rows: List[rollup.Row] = []
+        for run_start, run_end in rollup.runs(stale):
+            r_start = parse_date_local(run_start, tz)
+            r_end = parse_date_local(run_end, tz) + timedelta(days=1) - timedelta(milliseconds=1)
+            missing_before = len(sess.missing) if sess else 0
+            *_, rows, _ = await _collect_range(
+                r_start, r_end, tz, date_field, None, set(),
+                assign_mode=assign_mode,
+                store_accept_until=store_accept_until,
+                business_day_start=business_day_start,
+            )
+            run_days = rollup.day_range(run_start, run_end)
+            if sess is not None and len(sess.missing) > missing_before:
+                # partial: недочитанный отрезок в роллапы не пишем — отвечаем тем, что прочитано
+                partial_days.update(run_days)
+                partial_rows.extend(r for r in rollup.group_rows(rows) if r[0] in partial_days)
+                continue
+            await asyncio.to_thread(rollup.replace, tenant, assign_mode, var,
+                                    run_days, rollup.group_rows(rows), today)
+
+        rows = await asyncio.to_thread(rollup.read, tenant, assign_mode, var, start_day, end_day)
+        if partial_days:
+            rows = [r for r in rows if r[0] not in partial_days] + partial_rows
+        agg = summarize_rollup(rows, start_day=start_day, end_day=end_day,
+                               states_inc=_normalize_states_inc(states_inc, expand_archive=True),
+                               states_ex=states_ex)
+        out_days = [DayPoint(**d) for d in agg["days"]]
+        return out_days, agg["cities"], agg["total_orders"], agg["total_amount"], agg["states"]
+
+async def _analytics_range(
+    start_dt: datetime, end_dt: datetime, tz: str, date_field: str,
+    states_inc: Optional[set], states_ex: set,
+    assign_mode: str, store_accept_until: str, business_day_start: str,
+    use_rollup: bool = True,
+    hours: bool = False, heatmap: bool = False,
+) -> tuple[list[DayPoint], Dict[str, int], int, float, Dict[str, int], Dict[str, object]]:
+    kw = dict(assign_mode=assign_mode, store_accept_until=store_accept_until, business_day_start=business_day_start)
+    # в роллапах только дни: часы и теплокарта считаются по сырым заказам
+    if use_rollup and rollup.ROLLUP_ENABLED and not (hours or heatmap):
+        try:
+            return (*await _rollup_range(start_dt, end_dt, tz, date_field, states_inc, states_ex, **kw), {})
+        except rollup.STORAGE_ERRORS:
+            # БД роллапов недоступна — считаем по сырым заказам, как раньше
+            pass
+    days, cities, tot, tot_amt, st_counts, _, extra = await _collect_range(
+        start_dt, end_dt, tz, date_field, states_inc, states_ex, hours=hours, heatmap=heatmap, **kw)
+    return days, cities, tot, tot_amt, st_counts, extra
 
-    return out_days, city_counts, total_orders, round(total_amount, 2), state_counts, flat_out
+def _prev_range(start_dt: datetime, end_dt: datetime) -> tuple[datetime, datetime]:
+    """Предыдущий период той же длины, вплотную к началу текущего."""
+    span_days = (end_dt.date() - start_dt.date()).days + 1
+    prev_end   = start_dt - timedelta(milliseconds=1)
+    prev_start = prev_end - timedelta(days=span_days) + timedelta(milliseconds=1)
+    return prev_start, prev_end
 
 # ---------- публичные эндпойнты: аналитика ----------
 @app.get("/orders/analytics", response_model=AnalyticsResponse)
 async def analytics(
+    response: Response,
     start: str = Query(...),
     end: str = Query(...),
     tz: str = Query(DEFAULT_TZ),
@@ -578,9 +1047,37 @@ async def analytics(
     business_day_start: Optional[str] = Query(None),
     assign_mode: str = Query("smart", pattern="^(smart|business|raw)$"),
     store_accept_until: Optional[str] = Query(None),
+    resume: Optional[str] = Query(None, description="resume_token из ответа о незавершённом сканировании"),
+    partial: bool = Query(False, description="отдать прочитанное, если часть окон Kaspi не ответила"),
+    debug: bool = Query(False, description="вернуть план сканирования (поля, интервалы, оценки)"),
+    fresh: bool = Query(False, description="строгая свежесть: не отдавать ответ из кэша"),
+    deadline: Optional[float] = Query(None, ge=0, description="секунд на ответ (REQUEST_DEADLINE): к сроку — прочитанное с complete=false, остальное дочитывается в кэш"),
+    granularity: str = Query("day", pattern="^(hour|day|week|month)$",
+                             description="шаг точек days/prev_days: hour (YYYY-MM-DDTHH) | day | week (понедельник) | month (YYYY-MM)"),
+    heatmap: Optional[str] = Query(None, pattern="^dow_hour$", description="теплокарта день недели × час за период"),
 ):
-    tzinfo = tzinfo_of(tz)
+    served = await _analytics_served(
+        start, end, tz, date_field, states, exclude_states,
+        with_prev=with_prev, exclude_canceled=exclude_canceled, start_time=start_time, end_time=end_time,
+        business_day_start=business_day_start, assign_mode=assign_mode, store_accept_until=store_accept_until,
+        resume=resume, partial=partial, debug=debug, fresh=fresh, deadline=deadline,
+        granularity=granularity, heatmap=heatmap,
+    )
+    response.headers.update(served.headers())
+    return served.data
 
+async def _analytics_served(
+    start: str, end: str, tz: str, date_field: str,
+    states: Optional[List[str]], exclude_states: Optional[List[str]], *,
+    with_prev: bool = True, exclude_canceled: bool = True,
+    start_time: Optional[str] = None, end_time: Optional[str] = None,
+    business_day_start: Optional[str] = None, assign_mode: str = "smart",
+    store_accept_until: Optional[str] = None, resume: Optional[str] = None,
+    partial: bool = False, debug: bool = False, fresh: bool = False, deadline: Optional[float] = None,
+    granularity: str = "day", heatmap: Optional[str] = None,
+) -> result_cache.Served:
+    """/orders/analytics через кэш результатов — общий путь эндпоинта и прогрева (те же ключи)."""
+    tzinfo = tzinfo_of(tz)
     eff_bds = business_day_start or BUSINESS_DAY_START
 
     start_dt = parse_date_local(start, tz)
@@ -602,39 +1099,233 @@ async def analytics(
     if exclude_canceled:
         exc |= {"CANCELED"}
 
-    days, cities_dict, tot, tot_amt, st_counts, _ = _collect_range(
-        start_dt, end_dt, tz, date_field, inc, exc,
-        assign_mode=assign_mode,
-        store_accept_until=(store_accept_until or STORE_ACCEPT_UNTIL),
-        business_day_start=eff_bds,
-    )
-
-    cities_list = [{"city": c, "count": n} for c, n in sorted(cities_dict.items(), key=lambda x: -x[1])]
-
-    prev_days: List[DayPoint] = []
-    if with_prev:
-        span_days = (end_dt.date() - start_dt.date()).days + 1
-        prev_end   = start_dt - timedelta(milliseconds=1)
-        prev_start = prev_end - timedelta(days=span_days) + timedelta(milliseconds=1)
-        prev_days, _, _, _, _, _ = _collect_range(
-            prev_start, prev_end, tz, date_field, inc, exc,
+    # роллапы — только для целых дней; времярез raw считается по сырым заказам
+    use_rollup = not (assign_mode == "raw" and (start_time or end_time))
+    accept_until = store_accept_until or STORE_ACCEPT_UNTIL
+    # часы и теплокарта — в том же проходе агрегации, что и дни; недели и месяцы — из дней
+    hours = granularity == "hour"
+    with_heatmap = heatmap == "dow_hour"
+
+    def _points(days: List[DayPoint], extra: Dict[str, object]) -> List[Dict[str, object]]:
+        if hours:
+            return extra["hours"]
+        return regroup_days([d.model_dump() for d in days], granularity)
+
+    async def compute(deadline: Optional[float] = None, resume_token: Optional[str] = None) -> Dict[str, object]:
+        scan = scan_checkpoint.begin(resume_token or resume, partial, deadline)
+        days, cities_dict, tot, tot_amt, st_counts, extra = await _analytics_range(
+            start_dt, end_dt, tz, date_field, inc, exc,
             assign_mode=assign_mode,
-            store_accept_until=(store_accept_until or STORE_ACCEPT_UNTIL),
+            store_accept_until=accept_until,
             business_day_start=eff_bds,
+            use_rollup=use_rollup,
+            hours=hours,
+            heatmap=with_heatmap,
         )
 
+        cities_list = [{"city": c, "count": n} for c, n in sorted(cities_dict.items(), key=lambda x: -x[1])]
+
+        prev_points: List[Dict[str, object]] = []
+        if with_prev:
+            prev_start, prev_end = _prev_range(start_dt, end_dt)
+            prev_days, _, _, _, _, prev_extra = await _analytics_range(
+                prev_start, prev_end, tz, date_field, inc, exc,
+                assign_mode=assign_mode,
+                store_accept_until=accept_until,
+                business_day_start=eff_bds,
+                use_rollup=use_rollup,
+                hours=hours,
+            )
+            prev_points = _points(prev_days, prev_extra)
+
+        return jsonable_encoder({
+            "range": {"start": start_dt.astimezone(tzinfo).date().isoformat(),
+                      "end":   end_dt.astimezone(tzinfo).date().isoformat()},
+            "timezone": tz,
+            "currency": CURRENCY,
+            "date_field": date_field,
+            "total_orders": tot,
+            "total_amount": tot_amt,
+            "days": _points(days, extra),
+            "prev_days": prev_points,
+            "cities": cities_list,
+            "state_breakdown": st_counts,
+            **scan.summary(),
+            "days_covered": None if scan.complete else scan_checkpoint.days_covered(
+                scan.missing, start_dt.astimezone(tzinfo).date().isoformat(),
+                end_dt.astimezone(tzinfo).date().isoformat(), tz),
+            "granularity": granularity,
+            "heatmap": extra.get("heatmap"),
+            "debug": {"scan_plans": scan.plans} if debug else None,
+        })
+
+    # повторный просмотр — из кэша сразу (с фоновым пересчётом устаревшего); resume — всегда расчёт
+    key = single_flight.key(
+        kaspi_transport.tenant_key(get_current_kaspi_token()), "analytics",
+        round(start_dt.timestamp() * 1000), round(end_dt.timestamp() * 1000), tz, date_field,
+        inc or set(), exc, with_prev, assign_mode, accept_until, eff_bds, use_rollup, partial, debug,
+        granularity, heatmap,
+    )
+    return await result_cache.serve("analytics", key, compute, fresh=fresh,
+                                    deadline=scan_checkpoint.deadline_at(deadline))
+
+# ---------- аналитика: пакет периодов (виджеты дашборда) ----------
+class RangeSpec(BaseModel):
+    id: Optional[str] = None
+    start: str
+    end: str
+    assign_mode: str = Field("smart", pattern="^(smart|business|raw)$")
+    states: Optional[List[str]] = None
+    exclude_states: Optional[List[str]] = None
+    exclude_canceled: bool = True
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    with_prev: bool = False
+    store_accept_until: Optional[str] = None
+    business_day_start: Optional[str] = None
+
+class AnalyticsBatchRequest(BaseModel):
+    specs: List[RangeSpec]
+    tz: str = DEFAULT_TZ
+    date_field: str = DATE_FIELD_DEFAULT
+    resume: Optional[str] = None
+    partial: bool = False
+    deadline: Optional[float] = Field(None, ge=0)
+    granularity: str = Field("day", pattern="^(hour|day|week|month)$")
+    heatmap: Optional[str] = Field(None, pattern="^dow_hour$")
+    debug: bool = False
+
+class AnalyticsBatchItem(BaseModel):
+    id: Optional[str] = None
+    range: Dict[str, str]
+    assign_mode: str
+    total_orders: int
+    total_amount: float
+    days: List[DayPoint]
+    prev_days: List[DayPoint] = []
+    cities: List[CityCount] = []
+    state_breakdown: Dict[str, int] = {}
+    days_covered: Optional[List[str]] = None
+    heatmap: Optional[Dict[str, object]] = None
+
+class AnalyticsBatchResponse(BaseModel):
+    timezone: str
+    currency: str
+    date_field: str
+    granularity: str = "day"
+    results: List[AnalyticsBatchItem]
+    complete: bool = True
+    missing_windows: List[Dict[str, str]] = []
+    resume_token: Optional[str] = None
+    deadline_exceeded: bool = False
+    debug: Optional[Dict[str, object]] = None
+
+@app.post("/orders/analytics/batch", response_model=AnalyticsBatchResponse)
+async def analytics_batch(req: AnalyticsBatchRequest):
+    """
+    Несколько периодов («сегодня / неделя / месяц», основной и предыдущий) за одно сканирование:
+    планы всех периодов объединяются по полям (scan_fields.union), заказы читаются один раз
+    без фильтра статусов, а каждый период со своими статусами и режимом дня считается в одном
+    проходе по батчу (aggregation.aggregate_specs). Роллапы здесь не используются.
+    """
+    if not req.specs:
+        raise HTTPException(status_code=400, detail="specs is empty")
+    if len(req.specs) > ANALYTICS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"too many specs (max {ANALYTICS_BATCH_MAX})")
+    if client is None:
+        raise HTTPException(status_code=500, detail="Kaspi client not configured")
+
+    tz = req.tz
+    tzinfo = tzinfo_of(tz)
+    token = get_current_kaspi_token()
+    scan = scan_checkpoint.begin(req.resume, req.partial, scan_checkpoint.deadline_at(req.deadline))
+
+    # по периоду на spec и ещё один на его предыдущий период (with_prev) — в порядке specs
+    periods: List[Dict[str, object]] = []
+    scans: List[scan_fields.Scan] = []
+    for n, sp in enumerate(req.specs):
+        eff_bds = sp.business_day_start or BUSINESS_DAY_START
+        accept_until = sp.store_accept_until or STORE_ACCEPT_UNTIL
+        start_dt = parse_date_local(sp.start, tz)
+        end_dt   = parse_date_local(sp.end, tz) + timedelta(days=1) - timedelta(milliseconds=1)
+        if sp.assign_mode == "raw":
+            if sp.start_time:
+                start_dt = apply_hhmm(start_dt, sp.start_time)
+            if sp.end_time:
+                end_dt = apply_hhmm(parse_date_local(sp.end, tz), sp.end_time)
+        if end_dt < start_dt:
+            raise HTTPException(status_code=400, detail=f"specs[{n}]: end < start")
+
+        inc = _normalize_states_inc(parse_states_csv(_states_to_csv(sp.states)), expand_archive=True)
+        exc = parse_states_csv(_states_to_csv(sp.exclude_states)) or set()
+        if sp.exclude_canceled:
+            exc |= {"CANCELED"}
+
+        ranges = [(start_dt, end_dt)] + ([_prev_range(start_dt, end_dt)] if sp.with_prev else [])
+        for r_start, r_end in ranges:
+            start_ms, end_ms = round(r_start.timestamp() * 1000), round(r_end.timestamp() * 1000)
+            start_day = r_start.astimezone(tzinfo).date().isoformat()
+            end_day = r_end.astimezone(tzinfo).date().isoformat()
+            plan = await asyncio.to_thread(
+                scan_fields.plan,
+                sp.assign_mode, start_ms=start_ms, end_ms=end_ms, start_day=start_day, end_day=end_day, tz=tz,
+                date_field=req.date_field, store_accept_until=accept_until, business_day_start=eff_bds,
+                token=token, margin_days=SCAN_MARGIN_DAYS, base_field=SCAN_FIELD,
+            )
+            scan.plans.append(plan.as_dict())
+            scans.extend(plan.scans)
+            periods.append({
+                "start_ms": start_ms, "end_ms": end_ms, "start_day": start_day, "end_day": end_day,
+                "assign_mode": sp.assign_mode, "store_accept_until": accept_until, "business_day_start": eff_bds,
+                "states_inc": sorted(inc), "states_ex": sorted(exc),
+            })
+
+    union = scan_fields.union(scans)
+    scan_stats: Dict[str, float] = {}
+    with profiling.span("analytics_batch.scan", periods=len(periods), scans=len(union)):
+        batch = await asyncio.to_thread(_scan_range, union, req.date_field, set(), set(), scan_stats)
+    metrics.KASPI_SCAN_PAGES.observe(scan_stats.get("pages", 0))
+    metrics.COLLECT_ORDERS.inc(len(batch["id"]))
+
+    t_agg = _perf()
+    with profiling.span("analytics_batch.aggregate", orders=len(batch["id"]), periods=len(periods)):
+        aggs = await cpu_pool.run(aggregate_specs, batch, tz=tz, specs=periods,
+                                  hours=req.granularity == "hour", heatmap=req.heatmap == "dow_hour",
+                                  inline=len(batch["id"]) < cpu_pool.CPU_POOL_MIN_ROWS)
+    metrics.COLLECT_PHASE.observe(_perf() - t_agg, phase="aggregate")
+
+    def _points(agg: Dict[str, object]) -> List[Dict[str, object]]:
+        return agg["hours"] if req.granularity == "hour" else regroup_days(agg["days"], req.granularity)
+
+    results: List[Dict[str, object]] = []
+    it = iter(zip(periods, aggs))
+    for sp in req.specs:
+        period, agg = next(it)
+        prev = next(it)[1] if sp.with_prev else None
+        results.append({
+            "id": sp.id,
+            "range": {"start": period["start_day"], "end": period["end_day"]},
+            "assign_mode": sp.assign_mode,
+            "total_orders": agg["total_orders"],
+            "total_amount": agg["total_amount"],
+            "days": _points(agg),
+            "prev_days": _points(prev) if prev else [],
+            "cities": [{"city": c, "count": k} for c, k in sorted(agg["cities"].items(), key=lambda x: -x[1])],
+            "state_breakdown": agg["states"],
+            "days_covered": None if scan.complete else scan_checkpoint.days_covered(
+                scan.missing, period["start_day"], period["end_day"], tz),
+            "heatmap": agg.get("heatmap"),
+        })
+
     return {
-        "range": {"start": start_dt.astimezone(tzinfo).date().isoformat(),
-                  "end":   end_dt.astimezone(tzinfo).date().isoformat()},
         "timezone": tz,
         "currency": CURRENCY,
-        "date_field": date_field,
-        "total_orders": tot,
-        "total_amount": tot_amt,
-        "days": days,
-        "prev_days": prev_days,
-        "cities": cities_list,
-        "state_breakdown": st_counts,
+        "date_field": req.date_field,
+        "granularity": req.granularity,
+        "results": results,
+        **scan.summary(),
+        "debug": {"scan_plans": scan.plans, "union": [s.as_dict() for s in union],
+                  "pages": scan_stats.get("pages", 0)} if req.debug else None,
     }
 
 # ---------- /orders/ids CORE ----------
@@ -667,10 +1358,13 @@ async def _list_ids_core(
     assign_mode: str, store_accept_until: Optional[str],
     exclude_canceled: bool = True,
     start_time: Optional[str] = None, end_time: Optional[str] = None,
-    progress_cb: Optional[Callable[[str, int, int, str], None]] = None,
+    progress_cb: Optional[Callable[[str, int, int, str], Awaitable[None]]] = None,
+    resume: Optional[str] = None, partial: bool = False, debug: bool = False,
+    deadline: Optional[float] = None,
 ) -> Dict[str, object]:
 
     tzinfo = tzinfo_of(tz)
+    scan = scan_checkpoint.begin(resume, partial, deadline)
     eff_bds = business_day_start or BUSINESS_DAY_START
 
     start_dt = parse_date_local(start, tz)
@@ -689,12 +1383,14 @@ async def _list_ids_core(
     if exclude_canceled:
         exc |= {"CANCELED"}
 
-    _, _, _, _, _, out = _collect_range(
+    _, _, _, _, _, rows, _ = await _collect_range(
         start_dt, end_dt, tz, date_field, inc, exc,
         assign_mode=assign_mode,
         store_accept_until=(store_accept_until or STORE_ACCEPT_UNTIL),
         business_day_start=eff_bds,
     )
+    # строки общие с другими запросами (single-flight): сортируем и обогащаем копии
+    out = [dict(it) for it in rows]
 
     # сортировка и обрезка
     out.sort(key=lambda it: (str(it["op_day"]), str(it["date"])), reverse=(order == "desc"))
@@ -726,6 +1422,7 @@ async def _list_ids_core(
             })
 
     # обогащение
+    enrich_pending = 0
     if with_items and out and enrich_scope != "none":
         enrich_day  = bucket_date(end_dt.astimezone(tzinfo), use_bd=True, bd_start=eff_bds)
         targets     = _select_targets(out, enrich_day, enrich_scope, limit)
@@ -733,21 +1430,38 @@ async def _list_ids_core(
 
         sem = asyncio.Semaphore(max(1, ENRICH_CONCURRENCY))
         done = 0
-        if progress_cb: progress_cb("enrich", done, total_t, "enrich start")
+        if progress_cb: await progress_cb("enrich", done, total_t, "enrich start")
 
         async def enrich(it):
             nonlocal done
-            async with sem:
-                extra = await _first_item_details(str(it["id"]), timeout_scale=1.0 + (0.5 if total_t >= 400 else 0.0))
-                if extra:
-                    it["sku"]   = extra.get("sku")
-                    it["title"] = extra.get("title")
-                done += 1
-                if progress_cb:
-                    progress_cb("enrich", done, total_t, f"enrich {done}/{total_t}")
-                await asyncio.sleep(0.02)
-
-        await asyncio.gather(*(enrich(it) for it in targets))
+            metrics.ENRICH_QUEUE.inc()
+            queued = True
+            try:
+                async with sem:
+                    metrics.ENRICH_QUEUE.dec()
+                    queued = False
+                    metrics.ENRICH_INFLIGHT.inc()
+                    try:
+                        extra = await _item_details_cached(str(it["id"]), timeout_scale=1.0 + (0.5 if total_t >= 400 else 0.0))
+                    finally:
+                        metrics.ENRICH_INFLIGHT.dec()
+                    if extra:
+                        it["sku"]   = extra.get("sku")
+                        it["title"] = extra.get("title")
+                    done += 1
+                    if progress_cb:
+                        await progress_cb("enrich", done, total_t, f"enrich {done}/{total_t}")
+                    await asyncio.sleep(0.02)
+            finally:
+                if queued:
+                    metrics.ENRICH_QUEUE.dec()
+
+        try:
+            # к дедлайну отдаём то, что успели; начатые запросы позиций дописывают кэш order_items
+            await asyncio.wait_for(asyncio.gather(*(enrich(it) for it in targets)), timeout=scan.remaining())
+        except asyncio.TimeoutError:
+            scan.deadline_hit = True
+            enrich_pending = total_t - done
 
     period_total_amount = round(sum(float(it.get("amount", 0) or 0) for it in out), 2)
     period_total_count  = len(out)
@@ -758,11 +1472,18 @@ async def _list_ids_core(
         "period_total_count": period_total_count,
         "period_total_amount": period_total_amount,
         "currency": CURRENCY,
+        **scan.summary(),
+        **({} if scan.complete else {"days_covered": scan_checkpoint.days_covered(
+            scan.missing, start_dt.astimezone(tzinfo).date().isoformat(),
+            end_dt.astimezone(tzinfo).date().isoformat(), tz)}),
+        **({"enrich_pending": enrich_pending} if enrich_pending else {}),
+        **({"debug": {"scan_plans": scan.plans}} if debug else {}),
     }
 
 # ---------- /orders/ids ----------
 @app.get("/orders/ids")
 async def list_ids(
+    response: Response,
     start: str = Query(...),
     end: str = Query(...),
     tz: str = Query(DEFAULT_TZ),
@@ -781,16 +1502,58 @@ async def list_ids(
     exclude_canceled: bool = Query(True),
     start_time: Optional[str] = Query(None),
     end_time: Optional[str] = Query(None),
+    resume: Optional[str] = Query(None, description="resume_token из ответа о незавершённом сканировании"),
+    partial: bool = Query(False, description="отдать прочитанное, если часть окон Kaspi не ответила"),
+    debug: bool = Query(False, description="вернуть план сканирования (поля, интервалы, оценки)"),
+    fresh: bool = Query(False, description="строгая свежесть: не отдавать ответ из кэша"),
+    deadline: Optional[float] = Query(None, ge=0, description="секунд на ответ (REQUEST_DEADLINE): к сроку — прочитанное с complete=false, остальное дочитывается в кэш"),
 ):
-    return await _list_ids_core(
-        start, end, tz, date_field,
-        _states_to_csv(states), _states_to_csv(exclude_states),
-        use_bd, business_day_start, limit, order, grouped,
-        with_items, enrich_scope, assign_mode, store_accept_until,
-        exclude_canceled=exclude_canceled,
-        start_time=start_time, end_time=end_time,
-        progress_cb=None
+    served = await _ids_served(
+        start, end, tz, date_field, states, exclude_states,
+        use_bd=use_bd, business_day_start=business_day_start, limit=limit, order=order, grouped=grouped,
+        with_items=with_items, enrich_scope=enrich_scope, assign_mode=assign_mode,
+        store_accept_until=store_accept_until, exclude_canceled=exclude_canceled,
+        start_time=start_time, end_time=end_time, resume=resume, partial=partial, debug=debug,
+        fresh=fresh, deadline=deadline,
     )
+    # данные уже прошли jsonable_encoder в compute (или пришли из кэша как JSON) —
+    # без второго прохода FastAPI по 10k+ строкам
+    return JSONResponse(served.data, headers=served.headers())
+
+async def _ids_served(
+    start: str, end: str, tz: str, date_field: str,
+    states: Optional[List[str]], exclude_states: Optional[List[str]], *,
+    use_bd: Optional[bool] = None, business_day_start: Optional[str] = None,
+    limit: int = 0, order: str = "asc", grouped: int = 1, with_items: int = 1,
+    enrich_scope: str = "last_day", assign_mode: str = "smart",
+    store_accept_until: Optional[str] = None, exclude_canceled: bool = True,
+    start_time: Optional[str] = None, end_time: Optional[str] = None,
+    resume: Optional[str] = None, partial: bool = False, debug: bool = False,
+    fresh: bool = False, deadline: Optional[float] = None,
+) -> result_cache.Served:
+    """/orders/ids через кэш результатов — общий путь эндпоинта и прогрева (те же ключи)."""
+    states_csv, exclude_csv = _states_to_csv(states), _states_to_csv(exclude_states)
+
+    async def compute(deadline: Optional[float] = None, resume_token: Optional[str] = None) -> Dict[str, object]:
+        return jsonable_encoder(await _list_ids_core(
+            start, end, tz, date_field,
+            states_csv, exclude_csv,
+            use_bd, business_day_start, limit, order, grouped,
+            with_items, enrich_scope, assign_mode, store_accept_until,
+            exclude_canceled=exclude_canceled,
+            start_time=start_time, end_time=end_time,
+            progress_cb=None, resume=resume_token or resume, partial=partial, debug=debug, deadline=deadline,
+        ))
+
+    key = single_flight.key(
+        kaspi_transport.tenant_key(get_current_kaspi_token()), "ids",
+        start, end, tz, date_field, parse_states_csv(states_csv) or set(), parse_states_csv(exclude_csv) or set(),
+        business_day_start or BUSINESS_DAY_START, limit, order, grouped, with_items, enrich_scope, assign_mode,
+        store_accept_until or STORE_ACCEPT_UNTIL, exclude_canceled,
+        (start_time, end_time) if assign_mode == "raw" else None, partial, debug,
+    )
+    return await result_cache.serve("ids", key, compute, fresh=fresh,
+                                    deadline=scan_checkpoint.deadline_at(deadline))
 
 # ---------- CSV ----------
 @app.get("/orders/ids.csv", response_class=PlainTextResponse)
@@ -809,6 +1572,8 @@ async def list_ids_csv(
     exclude_canceled: bool = Query(True),
     start_time: Optional[str] = Query(None),
     end_time: Optional[str] = Query(None),
+    resume: Optional[str] = Query(None, description="resume_token из ответа о незавершённом сканировании"),
+    partial: bool = Query(False, description="отдать прочитанное, если часть окон Kaspi не ответила"),
 ):
     data = await _list_ids_core(
         start, end, tz, date_field,
@@ -819,39 +1584,50 @@ async def list_ids_csv(
         assign_mode=assign_mode, store_accept_until=store_accept_until,
         exclude_canceled=exclude_canceled,
         start_time=start_time, end_time=end_time,
-        progress_cb=None
+        progress_cb=None, resume=resume, partial=partial,
     )
-    return "\n".join([str(it["number"]) for it in data["items"]])
+    body = "\n".join([str(it["number"]) for it in data["items"]])
+    if not data["complete"]:
+        # partial: в тексте места для списка окон нет — токен и число недочитанных окон в заголовках
+        return PlainTextResponse(body, headers={"X-Resume-Token": str(data["resume_token"]),
+                                                "X-Missing-Windows": str(len(data["missing_windows"]))})
+    return body
 
 # ---------- Async + jobs ----------
-Jobs: Dict[str, Dict[str, object]] = {}
+# состояние задач живёт в общем бэкенде: статус/результат/отмена видны из любого воркера
+Jobs = Namespace("jobs", ttl=JOB_TTL)
 
-def _new_job() -> str:
+async def _new_job() -> str:
     job_id = uuid.uuid4().hex
-    Jobs[job_id] = {
+    await Jobs.aset(job_id, {
         "status": "queued", "phase": "scan", "progress": 0.0, "message": "",
         "created": datetime.utcnow().isoformat()+"Z", "updated": datetime.utcnow().isoformat()+"Z",
         "total": 0, "done": 0, "result": None, "cancel": False,
-    }
+    })
     return job_id
 
-def _job_update(job_id: str, **patch):
-    st = Jobs.get(job_id)
-    if not st: return
-    st.update(patch); st["updated"] = datetime.utcnow().isoformat()+"Z"
+async def _job_update(job_id: str, **patch):
+    patch["updated"] = datetime.utcnow().isoformat()+"Z"
+    await Jobs.aupdate(job_id, **patch)
+
+def _job_update_sync(job_id: str, **patch):
+    # из потоков (прогресс bridge_ingest в asyncio.to_thread)
+    patch["updated"] = datetime.utcnow().isoformat()+"Z"
+    Jobs.update(job_id, **patch)
 
 def _job_progress_cb(job_id: Optional[str]):
     if not job_id: return None
-    def cb(phase: str, done: int, total: int, extra_msg: str = ""):
-        if job_id not in Jobs: return
-        if Jobs[job_id].get("cancel"): return
+    async def cb(phase: str, done: int, total: int, extra_msg: str = ""):
+        st = await Jobs.aget(job_id)
+        if not st: return
+        if st.get("cancel"): return
         prog = 0.0
         if total > 0:
             if phase == "scan":
                 prog = min(0.6, 0.6 * (done / total))
             else:
                 prog = 0.6 + min(0.4, 0.4 * (done / total))
-        _job_update(job_id, phase=phase, progress=prog, done=done, total=total, message=extra_msg or Jobs[job_id].get("message",""))
+        await _job_update(job_id, phase=phase, progress=prog, done=done, total=total, message=extra_msg or st.get("message",""))
     return cb
 
 @app.post("/orders/ids.async")
@@ -874,11 +1650,16 @@ async def list_ids_async(
     exclude_canceled: bool = Query(True),
     start_time: Optional[str] = Query(None),
     end_time: Optional[str] = Query(None),
+    resume: Optional[str] = Query(None, description="resume_token из ответа о незавершённом сканировании"),
+    partial: bool = Query(False, description="отдать прочитанное, если часть окон Kaspi не ответила"),
+    debug: bool = Query(False, description="вернуть план сканирования (поля, интервалы, оценки)"),
 ):
-    job_id = _new_job()
+    job_id = await _new_job()
     async def worker():
+        status = "error"
+        metrics.JOBS_ACTIVE.inc(kind="orders_ids")
         try:
-            _job_update(job_id, status="running", message="started")
+            await _job_update(job_id, status="running", message="started")
             res = await _list_ids_core(
                 start, end, tz, date_field,
                 _states_to_csv(states), _states_to_csv(exclude_states),
@@ -886,20 +1667,119 @@ async def list_ids_async(
                 with_items, enrich_scope, assign_mode, store_accept_until,
                 exclude_canceled=exclude_canceled,
                 start_time=start_time, end_time=end_time,
-                progress_cb=_job_progress_cb(job_id)
+                progress_cb=_job_progress_cb(job_id), resume=resume, partial=partial, debug=debug,
+            )
+            if ((await Jobs.aget(job_id)) or {}).get("cancel"):
+                status = "canceled"
+                await _job_update(job_id, status="canceled", message="canceled by user", result=None)
+            else:
+                status = "done"
+                await _job_update(job_id, status="done", progress=1.0, message="done", result=res)
+        except scan_checkpoint.ScanIncomplete as e:
+            # повтор задачи с resume=<token> продолжит с недочитанных окон
+            await _job_update(job_id, status="error", message=str(e), result=e.as_dict())
+        except Exception as e:
+            await _job_update(job_id, status="error", message=str(e))
+        finally:
+            metrics.JOBS_ACTIVE.dec(kind="orders_ids")
+            metrics.JOBS_FINISHED.inc(kind="orders_ids", status=status)
+    asyncio.create_task(worker())
+    return {"job_id": job_id}
+
+@app.post("/profit/bridge/ingest.async")
+async def bridge_ingest_async(
+    start: str = Query(...),
+    end: str = Query(...),
+    tz: str = Query(DEFAULT_TZ),
+    exclude_states: Optional[List[str]] = Query(["CANCELED"]),
+    restart: bool = Query(False, description="игнорировать чекпойнт прошлой загрузки"),
+):
+    """Заказы периода со всеми позициями — из Kaspi прямо в bridge_lines (фоновая задача)."""
+    if not get_current_kaspi_token():
+        raise HTTPException(status_code=401, detail="kaspi token is not set")
+    start_dt = parse_date_local(start, tz)
+    end_dt   = parse_date_local(end, tz) + timedelta(days=1) - timedelta(milliseconds=1)
+    if end_dt < start_dt:
+        raise HTTPException(status_code=400, detail="end < start")
+    exc = sorted(parse_states_csv(_states_to_csv(exclude_states)) or set())
+    job_id = await _new_job()
+    await _job_update(job_id, phase="ingest")
+
+    async def worker():
+        status = "error"
+        metrics.JOBS_ACTIVE.inc(kind="bridge_ingest")
+        try:
+            await _job_update(job_id, status="running", message="started")
+
+            def progress(done: int, total: int, totals: Dict[str, int]):
+                _job_update_sync(job_id, phase="ingest", progress=(done / total) if total else 1.0,
+                            done=done, total=total, message=f"windows {done}/{total}, lines {totals['lines']}")
+
+            res = await asyncio.to_thread(
+                bridge_ingest.run, client, get_current_kaspi_token(),
+                int(start_dt.timestamp() * 1000), int(end_dt.timestamp() * 1000),
+                exclude_states=exc, restart=restart, progress=progress,
+                cancelled=lambda: bool((Jobs.get(job_id) or {}).get("cancel")),
+            )
+            if not res["complete"]:
+                status = "canceled"
+                await _job_update(job_id, status="canceled", message="canceled by user; resumable", result=res)
+            else:
+                status = "done"
+                await _job_update(job_id, status="done", progress=1.0, message="done", result=res)
+        except Exception as e:
+            # готовые окна остались в чекпойнте: повторный запуск продолжит с места сбоя
+            await _job_update(job_id, status="error", message=str(e))
+        finally:
+            metrics.JOBS_ACTIVE.dec(kind="bridge_ingest")
+            metrics.JOBS_FINISHED.inc(kind="bridge_ingest", status=status)
+    asyncio.create_task(worker())
+    return {"job_id": job_id}
+
+@app.post("/profit/bridge/sync.async")
+async def bridge_sync_async(
+    exclude_states: Optional[List[str]] = Query(["CANCELED"]),
+):
+    """Дельта-синхронизация bridge_lines: новые заказы с прошлого раза + только незавершённые (фоновая задача)."""
+    if not get_current_kaspi_token():
+        raise HTTPException(status_code=401, detail="kaspi token is not set")
+    exc = sorted(parse_states_csv(_states_to_csv(exclude_states)) or set())
+    job_id = await _new_job()
+    await _job_update(job_id, phase="sync")
+
+    async def worker():
+        status = "error"
+        metrics.JOBS_ACTIVE.inc(kind="bridge_sync")
+        try:
+            await _job_update(job_id, status="running", message="started")
+
+            def progress(done: int, total: int, totals: Dict[str, int]):
+                _job_update_sync(job_id, phase="sync", progress=(done / total) if total else 1.0,
+                            done=done, total=total, message=f"steps {done}/{total}, lines {totals['lines']}")
+
+            res = await asyncio.to_thread(
+                bridge_ingest.sync, client, get_current_kaspi_token(),
+                exclude_states=exc, progress=progress,
+                cancelled=lambda: bool((Jobs.get(job_id) or {}).get("cancel")),
             )
-            if Jobs.get(job_id, {}).get("cancel"):
-                _job_update(job_id, status="canceled", message="canceled by user", result=None)
+            if not res["complete"]:
+                status = "canceled"
+                await _job_update(job_id, status="canceled", message="canceled by user", result=res)
             else:
-                _job_update(job_id, status="done", progress=1.0, message="done", result=res)
+                status = "done"
+                await _job_update(job_id, status="done", progress=1.0, message="done", result=res)
         except Exception as e:
-            _job_update(job_id, status="error", message=str(e))
+            # курсор не сдвинут: следующая синхронизация перечитает то же окно
+            await _job_update(job_id, status="error", message=str(e))
+        finally:
+            metrics.JOBS_ACTIVE.dec(kind="bridge_sync")
+            metrics.JOBS_FINISHED.inc(kind="bridge_sync", status=status)
     asyncio.create_task(worker())
     return {"job_id": job_id}
 
 @app.get("/jobs/{job_id}")
 async def job_status(job_id: str):
-    st = Jobs.get(job_id)
+    st = await Jobs.aget(job_id)
     if not st: raise HTTPException(status_code=404, detail="job not found")
     payload = {k: v for k, v in st.items() if k != "result"}
     if st.get("status") == "done": payload["result_ready"] = True
@@ -907,18 +1787,69 @@ async def job_status(job_id: str):
 
 @app.get("/jobs/{job_id}/result")
 async def job_result(job_id: str):
-    st = Jobs.get(job_id)
+    st = await Jobs.aget(job_id)
     if not st: raise HTTPException(status_code=404, detail="job not found")
     if st.get("status") != "done": raise HTTPException(status_code=409, detail="job not finished")
     return JSONResponse(st.get("result") or {})
 
 @app.delete("/jobs/{job_id}")
 async def job_cancel(job_id: str):
-    st = Jobs.get(job_id)
-    if not st: raise HTTPException(status_code=404, detail="job not found")
-    st["cancel"] = True
+    if await Jobs.aupdate(job_id, cancel=True) is None:
+        raise HTTPException(status_code=404, detail="job not found")
     return {"ok": True}
 
+# ---------- прогрев дашборда ----------
+async def _warm_tenant(cfg: warmup.TenantWarmup, reason: str) -> Dict[str, object]:
+    """
+    Типовые запросы дашборда от имени тенанта: то, что оператор откроет первым. Аналитика и
+    /orders/ids идут через кэш результатов с параметрами дашборда (fresh — пересчёт с записью),
+    так что первый запрос оператора попадает в тот же ключ.
+    """
+    tok = kaspi_token_ctx.set(cfg.token)
+    try:
+        tzinfo = tzinfo_of(cfg.tz)
+        op_day = _date.fromisoformat(
+            bucket_date(datetime.now(tzinfo), use_bd=True, bd_start=cfg.business_day_start))
+        kw = dict(assign_mode="smart", store_accept_until=cfg.store_accept_until,
+                  business_day_start=cfg.business_day_start, fresh=True)
+        out: Dict[str, object] = {"op_day": op_day.isoformat()}
+
+        for name in cfg.ranges:
+            start = (op_day - timedelta(days=warmup.RANGES[name] - 1)).isoformat()
+            served = await _analytics_served(start, op_day.isoformat(), cfg.tz, DATE_FIELD_DEFAULT,
+                                             None, ["CANCELED"], **kw)
+            out[name] = served.data.get("total_orders")
+
+        if cfg.ids:
+            served = await _ids_served(op_day.isoformat(), op_day.isoformat(), cfg.tz, DATE_FIELD_DEFAULT,
+                                       None, None, **kw)
+            out["ids"] = served.data.get("period_total_count")
+
+        if cfg.bridge:
+            # новые заказы с прошлой синхронизации и сменившие статус незавершённые
+            res = await asyncio.to_thread(bridge_ingest.sync, client, cfg.token, exclude_states=["CANCELED"])
+            out["bridge"] = {"lines": res["lines"], "changed": res["changed"], "live": res["live_orders"]}
+        return out
+    finally:
+        kaspi_token_ctx.reset(tok)
+
+async def _warm_cycle(ran: List[warmup.TenantWarmup]) -> Optional[Dict[str, object]]:
+    """После прогрева тенантов цикла: очередь FIFO общая — разбирается один раз за цикл."""
+    if not any(t.fifo for t in ran) or not profit_fifo.enabled():
+        return None
+    # только SKU, изменившиеся с прошлого разбора очереди
+    res = await asyncio.to_thread(profit_fifo.process_queue)
+    return {"skus": res["skus"], "inserted": res["inserted"], "gaps": len(res["gaps"])}
+
+def _warmup_tenants() -> List[warmup.TenantWarmup]:
+    return warmup.load_tenants(default_tz=DEFAULT_TZ, default_bds=BUSINESS_DAY_START,
+                               default_cutoff=STORE_ACCEPT_UNTIL)
+
+def _warmup_tenant(tenant_id: str) -> Optional[warmup.TenantWarmup]:
+    found = warmup.load_tenants(default_tz=DEFAULT_TZ, default_bds=BUSINESS_DAY_START,
+                                default_cutoff=STORE_ACCEPT_UNTIL, only=tenant_id, include_disabled=True)
+    return found[0] if found else None
+
 # ---------- ROOT ----------
 @app.get("/", include_in_schema=False)
 async def root():
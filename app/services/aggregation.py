@@ -0,0 +1,336 @@
+# app/services/aggregation.py
+"""
+Агрегация заказов без I/O: назначение операционного дня, счётчики по дням/городам/статусам
+и плоский список строк для /orders/ids.
+
+Вход — колоночный батч (dict колонок одинаковой длины, см. COLUMNS), который собирает
+фаза сканирования в main._collect_range.
+
+Кроме дней тот же проход по желанию считает часы и теплокарту день недели × час
+(HourBuckets): час заказа — местный час приёма (в business — поля date_field), а день —
+его операционный день, поэтому часы суммируются ровно в дни. В business ось часов дня
+начинается с границы бизнес-дня (20:00 … 19:00), в raw и smart — с полуночи: smart кладёт
+в бизнес-день только доставленные, остальные — в плановый/календарный день. Недели и месяцы — перегруппировка дней
+(regroup_days), доступна и для роллапов. Модуль намеренно лёгкий (stdlib + pytz):
+он импортируется в процессах cpu_pool, и всё, что сюда передаётся, должно пикклиться.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytz
+
+COLUMNS = (
+    "id", "number", "state",
+    "ms_creation", "ms_pivot", "ms_planned", "ms_ship",
+    "amount", "city",
+)
+
+DELIVERED_STATES = {"KASPI_DELIVERY", "DELIVERED", "ARCHIVE", "ARCHIVED"}
+GRANULARITIES = ("hour", "day", "week", "month")
+DOW = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def new_batch() -> Dict[str, list]:
+    return {c: [] for c in COLUMNS}
+
+
+def bd_delta(hhmm: str) -> timedelta:
+    try:
+        h, m = hhmm.split(":")
+        return timedelta(hours=int(h), minutes=int(m))
+    except Exception:
+        return timedelta(0)
+
+
+def bucket_date(dt_local: datetime, use_bd: bool, bd_start: str) -> str:
+    if use_bd:
+        shift = timedelta(hours=24) - bd_delta(bd_start)
+        return (dt_local + shift).date().isoformat()
+    return dt_local.date().isoformat()
+
+
+def _local(ms: Optional[int], tzinfo: pytz.BaseTzInfo) -> Optional[datetime]:
+    return datetime.fromtimestamp(ms / 1000, tz=pytz.UTC).astimezone(tzinfo) if ms else None
+
+
+def operational_day(ms_creation: Optional[int], ms_planned: Optional[int], ms_ship: Optional[int],
+                    state: str, tzinfo: pytz.BaseTzInfo,
+                    store_accept_until: str, business_day_start: str) -> Tuple[str, str]:
+    # в местное время переводим только ту метку, по которой решается день (горячий цикл агрегации)
+    # доставленные — считаем по бизнес-дню (20:00→20:00)
+    if state in DELIVERED_STATES:
+        base = _local(ms_ship or ms_planned or ms_creation, tzinfo) or datetime.now(tzinfo)
+        shift = timedelta(hours=24) - bd_delta(business_day_start)
+        return (base + shift).date().isoformat(), "delivered_business_day"
+
+    # если есть план — берём плановую дату (дата без времени)
+    if ms_planned:
+        return _local(ms_planned, tzinfo).date().isoformat(), "planned"
+
+    # приём до HH:MM — после cut-off переносим на завтра
+    cutoff_h, cutoff_m = map(int, store_accept_until.split(":"))
+    cutoff = time(cutoff_h, cutoff_m, 0)
+    dt_creation = _local(ms_creation, tzinfo)
+    if dt_creation:
+        if dt_creation.time() <= cutoff:
+            return dt_creation.date().isoformat(), "created_before_cutoff"
+        else:
+            return (dt_creation + timedelta(days=1)).date().isoformat(), "created_after_cutoff_next_day"
+
+    return datetime.now(tzinfo).date().isoformat(), "fallback_now"
+
+
+def assign_day(assign_mode: str, st: str, ms_accept: int, ms_planned: Optional[int], ms_ship: Optional[int],
+               dt_accept: datetime, dt_pivot: datetime, tzinfo: pytz.BaseTzInfo,
+               store_accept_until: str, business_day_start: str) -> Tuple[str, str]:
+    """(операционный день, причина) заказа в режиме assign_mode."""
+    if assign_mode == "smart":
+        return operational_day(ms_accept, ms_planned, ms_ship, st, tzinfo, store_accept_until, business_day_start)
+    if assign_mode == "business":
+        return bucket_date(dt_pivot, use_bd=True, bd_start=business_day_start), "business"
+    return dt_accept.date().isoformat(), "raw"
+
+
+def _day_axis(start_day: str, end_day: str, counts: Dict[str, int], amounts: Dict[str, float]) -> List[Dict[str, object]]:
+    days: List[Dict[str, object]] = []
+    cur = datetime.fromisoformat(start_day).date()
+    end_d = datetime.fromisoformat(end_day).date()
+    while cur <= end_d:
+        key = cur.isoformat()
+        days.append({"x": key, "count": counts.get(key, 0), "amount": round(amounts.get(key, 0.0), 2)})
+        cur = cur + timedelta(days=1)
+    return days
+
+
+def first_hour(assign_mode: str, business_day_start: str) -> int:
+    """С какого часа начинается ось часов дня: граница бизнес-дня (business) или 0 (raw, smart)."""
+    if assign_mode != "business":
+        return 0
+    return int(bd_delta(business_day_start).total_seconds() // 3600) % 24
+
+
+def regroup_days(days: List[Dict[str, Any]], granularity: str) -> List[Dict[str, Any]]:
+    """Точки по дням → по неделям (x — понедельник) или месяцам (x — YYYY-MM); day/hour — как есть."""
+    if granularity not in ("week", "month"):
+        return days
+    out: Dict[str, Dict[str, Any]] = {}
+    for d in days:
+        day = date.fromisoformat(str(d["x"]))
+        x = (day - timedelta(days=day.weekday())).isoformat() if granularity == "week" else str(d["x"])[:7]
+        cur = out.setdefault(x, {"x": x, "count": 0, "amount": 0.0})
+        cur["count"] += int(d["count"])
+        cur["amount"] += float(d.get("amount") or 0.0)
+    for cur in out.values():
+        cur["amount"] = round(cur["amount"], 2)
+    return list(out.values())
+
+
+class HourBuckets:
+    """Заказы по (операционный день, час) и по (день недели, час) — для granularity=hour и heatmap."""
+
+    def __init__(self, hours: bool, heatmap: bool) -> None:
+        self.hours = hours
+        self.heatmap = heatmap
+        self.counts: Dict[Tuple[str, int], int] = {}
+        self.amounts: Dict[Tuple[str, int], float] = {}
+        self.hm_counts = [[0] * 24 for _ in DOW]
+        self.hm_amounts = [[0.0] * 24 for _ in DOW]
+
+    def add(self, op_day: str, hour: int, amt: float) -> None:
+        if self.hours:
+            k = (op_day, hour)
+            self.counts[k] = self.counts.get(k, 0) + 1
+            self.amounts[k] = self.amounts.get(k, 0.0) + amt
+        if self.heatmap:
+            dow = date.fromisoformat(op_day).weekday()
+            self.hm_counts[dow][hour] += 1
+            self.hm_amounts[dow][hour] += amt
+
+    def result(self, start_day: str, end_day: str, first: int) -> Dict[str, Any]:
+        order = [(first + i) % 24 for i in range(24)]
+        out: Dict[str, Any] = {}
+        if self.hours:
+            points: List[Dict[str, object]] = []
+            cur, end_d = date.fromisoformat(start_day), date.fromisoformat(end_day)
+            while cur <= end_d:
+                day = cur.isoformat()
+                for h in order:
+                    points.append({"x": f"{day}T{h:02d}", "count": self.counts.get((day, h), 0),
+                                   "amount": round(self.amounts.get((day, h), 0.0), 2)})
+                cur += timedelta(days=1)
+            out["hours"] = points
+        if self.heatmap:
+            out["heatmap"] = {
+                "kind": "dow_hour",
+                "dow": list(DOW),
+                "hours": order,
+                "counts": [[row[h] for h in order] for row in self.hm_counts],
+                "amounts": [[round(row[h], 2) for h in order] for row in self.hm_amounts],
+            }
+        return out
+
+
+def aggregate_orders(
+    batch: Dict[str, list], *,
+    tz: str, start_ms: int, end_ms: int, start_day: str, end_day: str,
+    assign_mode: str, store_accept_until: str, business_day_start: str,
+    hours: bool = False, heatmap: bool = False,
+) -> Dict[str, Any]:
+    """
+    Агрегирует батч за период [start_ms; end_ms] (локальные дни start_day..end_day).
+    Возвращает {days, cities, states, total_orders, total_amount, rows}, с hours/heatmap —
+    ещё "hours" (точки по часам) и "heatmap" (день недели × час).
+    """
+    tzinfo = pytz.timezone(tz)
+    by_hour = HourBuckets(hours, heatmap) if hours or heatmap else None
+
+    day_counts: Dict[str, int]    = {}
+    day_amounts: Dict[str, float] = {}
+    city_counts: Dict[str, int]   = {}
+    state_counts: Dict[str, int]  = {}
+    total_orders = 0
+    total_amount = 0.0
+    rows: List[Dict[str, object]] = []
+
+    for oid, number, st, ms_accept, ms_pivot, ms_planned, ms_ship, amt, city in zip(
+        *(batch[c] for c in COLUMNS)
+    ):
+        dt_accept = datetime.fromtimestamp(ms_accept / 1000, tz=pytz.UTC).astimezone(tzinfo)
+        dt_pivot  = datetime.fromtimestamp(ms_pivot / 1000, tz=pytz.UTC).astimezone(tzinfo)
+
+        # определяем день принадлежности; raw — точная фильтрация по времени приёма
+        if assign_mode == "raw" and not (start_ms <= ms_accept <= end_ms):
+            continue
+        op_day, reason = assign_day(assign_mode, st, ms_accept, ms_planned, ms_ship, dt_accept, dt_pivot,
+                                    tzinfo, store_accept_until, business_day_start)
+        if not (start_day <= op_day <= end_day):
+            continue
+
+        day_counts[op_day]  = day_counts.get(op_day, 0) + 1
+        day_amounts[op_day] = day_amounts.get(op_day, 0.0) + amt
+        if city:
+            city_counts[city] = city_counts.get(city, 0) + 1
+        state_counts[st] = state_counts.get(st, 0) + 1
+
+        total_orders += 1
+        total_amount += amt
+        if by_hour is not None:
+            by_hour.add(op_day, (dt_pivot if assign_mode == "business" else dt_accept).hour, amt)
+
+        rows.append({
+            "id": oid,
+            "number": number,
+            "state": st,
+            "date": dt_accept.isoformat(),       # приём
+            "date_ms": ms_accept,                # мс приёма
+            "date_pivot": dt_pivot.isoformat(),  # поворотное поле
+            "op_day": op_day,
+            "op_reason": reason,
+            "amount": round(amt, 2),
+            "city": city,
+        })
+
+    return {
+        "days": _day_axis(start_day, end_day, day_counts, day_amounts),
+        "cities": city_counts,
+        "states": state_counts,
+        "total_orders": total_orders,
+        "total_amount": round(total_amount, 2),
+        "rows": rows,
+        **(by_hour.result(start_day, end_day, first_hour(assign_mode, business_day_start)) if by_hour else {}),
+    }
+
+
+def aggregate_specs(batch: Dict[str, list], *, tz: str, specs: List[Dict[str, Any]],
+                    hours: bool = False, heatmap: bool = False) -> List[Dict[str, Any]]:
+    """
+    Несколько периодов за один проход по батчу (POST /orders/analytics/batch).
+    spec — start_ms, end_ms, start_day, end_day, assign_mode, store_accept_until,
+    business_day_start, states_inc (список; пустой — все), states_ex.
+    На каждый spec — {days, cities, states, total_orders, total_amount} (и hours/heatmap), как у
+    aggregate_orders.
+    День заказа считается один раз на набор (режим, cut-off, граница дня).
+    """
+    tzinfo = pytz.timezone(tz)
+    acc = [{"days": {}, "amounts": {}, "cities": {}, "states": {}, "total": 0, "amount": 0.0,
+            "by_hour": HourBuckets(hours, heatmap) if hours or heatmap else None} for _ in specs]
+    filters = [(set(sp.get("states_inc") or ()), set(sp.get("states_ex") or ())) for sp in specs]
+
+    for oid, number, st, ms_accept, ms_pivot, ms_planned, ms_ship, amt, city in zip(
+        *(batch[c] for c in COLUMNS)
+    ):
+        dt_accept = datetime.fromtimestamp(ms_accept / 1000, tz=pytz.UTC).astimezone(tzinfo)
+        dt_pivot  = datetime.fromtimestamp(ms_pivot / 1000, tz=pytz.UTC).astimezone(tzinfo)
+        assigned: Dict[Tuple[str, str, str], str] = {}
+        for sp, (inc, exc), a in zip(specs, filters, acc):
+            if (inc and st not in inc) or st in exc:
+                continue
+            if sp["assign_mode"] == "raw" and not (sp["start_ms"] <= ms_accept <= sp["end_ms"]):
+                continue
+            mode, cutoff, bds = sp["assign_mode"], sp["store_accept_until"], sp["business_day_start"]
+            op_day = assigned.get((mode, cutoff, bds))
+            if op_day is None:
+                op_day = assigned[(mode, cutoff, bds)] = assign_day(
+                    mode, st, ms_accept, ms_planned, ms_ship, dt_accept, dt_pivot, tzinfo, cutoff, bds)[0]
+            if not (sp["start_day"] <= op_day <= sp["end_day"]):
+                continue
+            a["days"][op_day] = a["days"].get(op_day, 0) + 1
+            a["amounts"][op_day] = a["amounts"].get(op_day, 0.0) + amt
+            if city:
+                a["cities"][city] = a["cities"].get(city, 0) + 1
+            a["states"][st] = a["states"].get(st, 0) + 1
+            a["total"] += 1
+            a["amount"] += amt
+            if a["by_hour"] is not None:
+                a["by_hour"].add(op_day, (dt_pivot if mode == "business" else dt_accept).hour, amt)
+
+    return [{
+        "days": _day_axis(sp["start_day"], sp["end_day"], a["days"], a["amounts"]),
+        "cities": a["cities"],
+        "states": a["states"],
+        "total_orders": a["total"],
+        "total_amount": round(a["amount"], 2),
+        **(a["by_hour"].result(sp["start_day"], sp["end_day"], first_hour(sp["assign_mode"], sp["business_day_start"]))
+           if a["by_hour"] is not None else {}),
+    } for sp, a in zip(specs, acc)]
+
+
+def summarize_rollup(
+    rows: List[Tuple[str, str, str, int, float]], *,
+    start_day: str, end_day: str, states_inc: Optional[set], states_ex: set,
+) -> Dict[str, Any]:
+    """
+    То же, что aggregate_orders (без rows), но из строк дневного роллапа
+    (day, state, city, orders, amount) — см. app/services/rollup.py.
+    """
+    day_counts: Dict[str, int]    = {}
+    day_amounts: Dict[str, float] = {}
+    city_counts: Dict[str, int]   = {}
+    state_counts: Dict[str, int]  = {}
+    total_orders = 0
+    total_amount = 0.0
+
+    for day, st, city, n, amt in rows:
+        if not (start_day <= day <= end_day):
+            continue
+        if states_inc and st not in states_inc:
+            continue
+        if st in states_ex:
+            continue
+        day_counts[day]  = day_counts.get(day, 0) + n
+        day_amounts[day] = day_amounts.get(day, 0.0) + amt
+        if city:
+            city_counts[city] = city_counts.get(city, 0) + n
+        state_counts[st] = state_counts.get(st, 0) + n
+        total_orders += n
+        total_amount += amt
+
+    return {
+        "days": _day_axis(start_day, end_day, day_counts, day_amounts),
+        "cities": city_counts,
+        "states": state_counts,
+        "total_orders": total_orders,
+        "total_amount": round(total_amount, 2),
+    }
@@ -0,0 +1,301 @@
+# app/services/bridge_ingest.py
+"""
+Загрузка строк заказов из Kaspi прямо в bridge_lines — без браузера.
+
+Раньше страница тянула /orders/ids с обогащением, перекладывала позиции в JS и слала их
+обратно в /profit/bridge/sync-by-ids: каждая строка трижды шла по сети, а из заказа
+попадала только первая позиция (_first_item_details). Здесь окно сканируется профилем
+full (include=entries), и все позиции заказа (quantity, basePrice, totalPrice, offer.code)
+пишутся пачками по BRIDGE_INGEST_BATCH строк через bridge_v2.upsert_lines — изменившиеся
+SKU заодно встают в очередь FIFO.
+
+Окна — как у сканирования аналитики (scan_plan.plan по плотности тенанта). План и номера
+готовых окон хранятся в общем состоянии (Namespace "bridge_ingest"), поэтому упавшая или
+отменённая загрузка с теми же параметрами продолжается с первого незаконченного окна.
+
+sync — дельта-синхронизация вместо повторной загрузки последних дней целиком. Заказы в
+конечных статусах (TERMINAL_STATES, DELIVERED старше BRIDGE_SYNC_DELIVERED_GRACE_DAYS)
+уже не меняются и больше не перечитываются. За один проход читаются:
+  окно новых заказов — от курсора прошлой синхронизации (минус BRIDGE_SYNC_OVERLAP_MIN)
+  до сейчас, целиком;
+  «живые» заказы из bridge_lines (не старше BRIDGE_SYNC_LIVE_DAYS) — сканами с
+  filter[orders][state] по каждому их текущему статусу, т. е. страниц ∝ числу живых заказов;
+  живые заказы, не найденные в своих статусах (сменили статус), — по коду заказа.
+Заказ, ушедший в исключённый статус (CANCELED), удаляется из bridge_lines — его SKU
+встают в очередь FIFO. Курсор — в Namespace "bridge_sync".
+"""
+from __future__ import annotations
+
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.services import kaspi_transport, metrics, profiling, scan_fields, scan_plan
+from app.services.state import Namespace
+
+BRIDGE_INGEST_BATCH = int(os.getenv("BRIDGE_INGEST_BATCH", "500") or 500)
+BRIDGE_INGEST_FIELD = "creationDate"   # bridge_lines.date_utc_ms — дата создания заказа
+CHUNK_DAYS = int(os.getenv("CHUNK_DAYS", "7") or 7)
+
+INGEST_LINES = metrics.counter("bridge_ingest_lines_total", "Order lines written to bridge_lines by server ingestion",
+                               ("changed",))
+
+BRIDGE_SYNC_OVERLAP_MIN = int(os.getenv("BRIDGE_SYNC_OVERLAP_MIN", "60") or 60)
+BRIDGE_SYNC_BOOTSTRAP_DAYS = int(os.getenv("BRIDGE_SYNC_BOOTSTRAP_DAYS", "3") or 3)
+BRIDGE_SYNC_LIVE_DAYS = int(os.getenv("BRIDGE_SYNC_LIVE_DAYS", "60") or 60)
+BRIDGE_SYNC_DELIVERED_GRACE_DAYS = int(os.getenv("BRIDGE_SYNC_DELIVERED_GRACE_DAYS", "14") or 14)
+
+# статусы, из которых заказ уже не выходит
+TERMINAL_STATES = ("ARCHIVE", "ARCHIVED", "RETURNED", "CANCELED")
+DAY_MS = 86_400_000
+
+_checkpoints = Namespace("bridge_ingest", ttl=7 * 86400)
+_cursors = Namespace("bridge_sync", ttl=90 * 86400)
+
+ProgressFn = Callable[[int, int, Dict[str, int]], None]
+
+
+def _first_str(d: Dict[str, Any], keys) -> Optional[str]:
+    for k in keys:
+        v = d.get(k)
+        if isinstance(v, str) and v.strip():
+            return v.strip()
+    return None
+
+
+def order_lines(order: Dict[str, Any], entries: List[Dict[str, Any]], *,
+                canon_sku: Callable[[Optional[str]], Optional[str]]) -> List[Dict[str, Any]]:
+    """Заказ JSON:API + его позиции → строки bridge_lines (line_index — порядок позиций)."""
+    attrs = order.get("attributes") or {}
+    oid = str(order.get("id") or "").strip()
+    if not oid:
+        return []
+    created = attrs.get("creationDate")
+    base = {
+        "order_id": oid,
+        "order_code": str(attrs.get("code") or "").strip() or None,
+        "state": str(attrs.get("state") or "").strip() or None,
+        "date_utc_ms": int(created) if isinstance(created, (int, float)) else None,
+    }
+    ordered = sorted(entries, key=lambda e: ((e.get("attributes") or {}).get("entryNumber") or 0))
+    out: List[Dict[str, Any]] = []
+    for idx, e in enumerate(ordered):
+        ea = e.get("attributes") or {}
+        offer = ea.get("offer") if isinstance(ea.get("offer"), dict) else {}
+        try:
+            qty = int(ea.get("quantity") or 1)
+        except (TypeError, ValueError):
+            qty = 1
+        total = float(ea.get("totalPrice") or 0.0)
+        unit = float(ea.get("basePrice") or 0.0) or (total / max(1, qty))
+        if not total:
+            total = unit * qty
+        out.append({
+            **base,
+            "sku": canon_sku(_first_str(offer, ("code",)) or _first_str(ea, ("sku", "code", "productCode"))),
+            "title": _first_str(ea, ("offerName", "title", "name", "productName")) or _first_str(offer, ("name",)),
+            "qty": qty,
+            "unit_price": unit,
+            "total_price": total,
+            "line_index": idx,
+        })
+    return out
+
+
+def checkpoint_key(token: Optional[str], start_ms: int, end_ms: int, exclude_states: List[str]) -> str:
+    return f"{kaspi_transport.tenant_key(token)}:{start_ms}:{end_ms}:{','.join(sorted(exclude_states))}"
+
+
+class _Writer:
+    """Заказы с позициями → пачки upsert в bridge_lines; заказы в исключённых статусах — удаление."""
+
+    def __init__(self, exclude_states: Iterable[str], totals: Dict[str, int]) -> None:
+        from app.api import bridge_v2
+        self._bridge = bridge_v2
+        self.skip = {s.upper() for s in exclude_states}
+        self.totals = totals
+        self.seen: Set[str] = set()
+        self.rows: List[Dict[str, Any]] = []
+        self.drop: Set[str] = set()
+
+    def add(self, order: Dict[str, Any], entries: List[Dict[str, Any]]) -> None:
+        oid = str(order.get("id"))
+        if oid in self.seen:
+            return
+        self.seen.add(oid)
+        if str((order.get("attributes") or {}).get("state") or "").upper() in self.skip:
+            self.drop.add(oid)
+            return
+        self.totals["orders"] += 1
+        lines = order_lines(order, entries, canon_sku=self._bridge._canon_sku)
+        if not lines:
+            self.totals["no_entries"] += 1
+        self.rows.extend(lines)
+        if len(self.rows) >= BRIDGE_INGEST_BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows and not self.drop:
+            return
+        with self._bridge.db() as con:
+            res = self._bridge.upsert_lines(con, self.rows)
+            gone = self._bridge.delete_orders(con, self.drop)
+        self.totals["lines"] += res["written"]
+        self.totals["changed"] += res["changed"]
+        self.totals["removed"] = self.totals.get("removed", 0) + gone["deleted"]
+        self.totals["fifo_queued"] += res["fifo_queued"] + gone["fifo_queued"]
+        INGEST_LINES.inc(res["changed"], changed="yes")
+        INGEST_LINES.inc(res["written"] - res["changed"], changed="no")
+        self.rows, self.drop = [], set()
+
+
+def run(client: Any, token: Optional[str], start_ms: int, end_ms: int, *,
+        exclude_states: List[str], restart: bool = False,
+        progress: Optional[ProgressFn] = None,
+        cancelled: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """
+    Синхронно (в потоке): окно за окном читает заказы с позициями и пишет их в bridge_lines.
+    Каждое окно — свои транзакции; после окна оно отмечается готовым в чекпойнте.
+    """
+    key = checkpoint_key(token, start_ms, end_ms, exclude_states)
+    cp = None if restart else _checkpoints.get(key)
+    if not cp:
+        windows = scan_plan.plan(start_ms, end_ms, scan_plan.load(token, BRIDGE_INGEST_FIELD), CHUNK_DAYS)
+        cp = {"windows": [list(w) for w in windows], "done": [],
+              "totals": {"orders": 0, "lines": 0, "changed": 0, "fifo_queued": 0, "no_entries": 0}}
+        _checkpoints.set(key, cp)
+    windows = [tuple(w) for w in cp["windows"]]
+    done = set(cp["done"])
+    totals: Dict[str, int] = dict(cp["totals"])
+    resumed = len(done)
+
+    if progress:
+        progress(len(done), len(windows), totals)
+    for i, (s, e) in enumerate(windows):
+        if i in done:
+            continue
+        if cancelled and cancelled():
+            break
+        with profiling.span("bridge_ingest.window", start_ms=s, end_ms=e):
+            writer = _Writer(exclude_states, totals)
+            for order, entries in client.iter_orders_with_entries(start=s, end=e, filter_field=BRIDGE_INGEST_FIELD):
+                writer.add(order, entries)
+            writer.flush()
+        done.add(i)
+        _checkpoints.set(key, {"windows": cp["windows"], "done": sorted(done), "totals": totals})
+        if progress:
+            progress(len(done), len(windows), totals)
+
+    complete = len(done) == len(windows)
+    if complete:
+        # следующая загрузка того же периода — снова с нуля: статусы заказов меняются
+        _checkpoints.delete(key)
+    return {**totals, "windows": len(windows), "windows_done": len(done),
+            "resumed_from": resumed, "complete": complete}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# дельта-синхронизация
+# ──────────────────────────────────────────────────────────────────────────────
+def _iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+def live_orders(now_ms: int, before_ms: int) -> Dict[str, Tuple[Optional[str], str, int]]:
+    """Незамороженные заказы bridge_lines, созданные до before_ms: {order_id: (code, state, date_utc_ms)}."""
+    from sqlalchemy import bindparam
+    from app.api import bridge_v2
+    sql = bridge_v2.text("""
+        SELECT order_id, MAX(order_code) AS code, MAX(state) AS state, MIN(date_utc_ms) AS date_ms
+          FROM bridge_lines
+         WHERE date_utc_ms >= :since AND date_utc_ms < :before
+           AND state IS NOT NULL AND state NOT IN :terminal
+           AND NOT (state = 'DELIVERED' AND date_utc_ms < :grace)
+      GROUP BY order_id
+    """).bindparams(bindparam("terminal", expanding=True))
+    with bridge_v2.db() as con:
+        rows = con.execute(sql, {
+            "since": now_ms - BRIDGE_SYNC_LIVE_DAYS * DAY_MS,
+            "before": before_ms,
+            "terminal": list(TERMINAL_STATES),
+            "grace": now_ms - BRIDGE_SYNC_DELIVERED_GRACE_DAYS * DAY_MS,
+        }).mappings().all()
+    return {str(r["order_id"]): (r["code"], str(r["state"]).upper(), int(r["date_ms"])) for r in rows}
+
+
+def sync(client: Any, token: Optional[str], *, exclude_states: List[str],
+         now_ms: Optional[int] = None,
+         progress: Optional[ProgressFn] = None,
+         cancelled: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """Синхронно (в потоке): новые заказы с курсора + перечитка только живых заказов."""
+    now_ms = now_ms or int(time.time() * 1000)
+    key = kaspi_transport.tenant_key(token)
+    cursor = (_cursors.get(key) or {}).get("cursor_ms")
+    new_start = (cursor if cursor is not None else now_ms - BRIDGE_SYNC_BOOTSTRAP_DAYS * DAY_MS) \
+        - BRIDGE_SYNC_OVERLAP_MIN * 60_000
+    # заказы, созданные после new_start, прочитает окно новых — их не перечитываем отдельно
+    live = live_orders(now_ms, new_start)
+    live_states = sorted({st for _, st, _ in live.values()})
+    windows = scan_plan.plan(new_start, now_ms, scan_plan.load(token, BRIDGE_INGEST_FIELD), CHUNK_DAYS)
+
+    totals: Dict[str, int] = {"orders": 0, "lines": 0, "changed": 0, "fifo_queued": 0, "no_entries": 0, "removed": 0}
+    writer = _Writer(exclude_states, totals)
+    steps = len(windows) + len(live_states) + 1
+    done = 0
+
+    def step() -> bool:
+        nonlocal done
+        done += 1
+        if progress:
+            progress(done, steps, totals)
+        return bool(cancelled and cancelled())
+
+    stopped = False
+    with profiling.span("bridge_sync.new", start_ms=new_start, end_ms=now_ms):
+        for s, e in windows:
+            for order, entries in client.iter_orders_with_entries(start=s, end=e, filter_field=BRIDGE_INGEST_FIELD):
+                writer.add(order, entries)
+            writer.flush()
+            if step():
+                stopped = True
+                break
+
+    # живые заказы — по их статусам; нашедшиеся в другом живом статусе тоже попадут в выборку
+    if live and not stopped:
+        lo = min(d for _, _, d in live.values())
+        with profiling.span("bridge_sync.live", orders=len(live), states=len(live_states)):
+            for st in live_states:
+                for order, entries in client.iter_orders_with_entries(
+                        start=lo, end=new_start - 1, filter_field=BRIDGE_INGEST_FIELD, state=st):
+                    writer.add(order, entries)
+                writer.flush()
+                if step():
+                    stopped = True
+                    break
+
+    # не нашлись в своих статусах — сменили статус (чаще всего на конечный): по коду заказа
+    moved = {oid: (code, d) for oid, (code, _, d) in live.items() if oid not in writer.seen and code}
+    if moved and not stopped:
+        # запрос на заказ дороже сплошного скана, если сменивших статус больше, чем в нём страниц
+        lo = min(d for _, d in moved.values())
+        pages = scan_fields.estimate([scan_fields.Scan(BRIDGE_INGEST_FIELD, lo, new_start - 1)], token) \
+            / scan_plan.PAGE_SIZE
+        with profiling.span("bridge_sync.moved", orders=len(moved), est_pages=round(pages, 1)):
+            if len(moved) > pages:
+                for s, e in scan_plan.plan(lo, new_start - 1, scan_plan.load(token, BRIDGE_INGEST_FIELD), CHUNK_DAYS):
+                    for order, entries in client.iter_orders_with_entries(start=s, end=e,
+                                                                          filter_field=BRIDGE_INGEST_FIELD):
+                        if str(order.get("id")) in moved:
+                            writer.add(order, entries)
+                    writer.flush()
+            else:
+                for order, entries in client.iter_orders_by_code([c for c, _ in moved.values()]):
+                    writer.add(order, entries)
+                writer.flush()
+    if not stopped:
+        step()
+        _cursors.set(key, {"cursor_ms": now_ms, "synced_at": _iso(now_ms)})
+
+    return {**totals, "complete": not stopped, "new_window": {"start": _iso(new_start), "end": _iso(now_ms)},
+            "windows": len(windows), "live_orders": len(live), "live_states": live_states, "moved": len(moved)}
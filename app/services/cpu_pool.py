@@ -0,0 +1,151 @@
+# app/services/cpu_pool.py
+"""
+Пул процессов для CPU-тяжёлых стадий (агрегация заказов, разбор Excel/XML, план FIFO).
+
+Чистый Python держит GIL: пока один тенант агрегирует год заказов или грузит большой
+Excel, event loop и слоты threadpool стоят для всех остальных. Поэтому такие стадии
+выполняются в ProcessPoolExecutor над сериализуемыми входами (колоночные батчи,
+сырые байты файла, списки строк).
+
+  CPU_POOL_SIZE          — число процессов на uvicorn-воркер; по умолчанию
+                           min(4, cpu_count // WEB_CONCURRENCY - 1): одно ядро остаётся
+                           event loop'у воркера, всего процессов WEB_CONCURRENCY × (1 + CPU_POOL_SIZE)
+                           не больше числа ядер. 0 — без пула (на одном ядре пул дал бы только IPC);
+  CPU_POOL_MAX_PENDING   — сколько задач может стоять в пуле одновременно (back-pressure;
+                           отдельно для async-вызовов и для потоков);
+  CPU_POOL_QUEUE_TIMEOUT — сколько ждать свободного места, сек; дальше CpuPoolBusy (→ 503);
+  CPU_POOL_MIN_ROWS      — батчи меньше этого размера выгоднее считать inline (IPC дороже).
+
+Пул создаётся только в lifespan (start в потоке) и сразу «прогревается» (импорт модулей-
+исполнителей). Пока он не готов или выключен, run выполняет задачу в потоке
+(asyncio.to_thread), а не в event loop.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import multiprocessing as mp
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+from weakref import WeakKeyDictionary
+
+T = TypeVar("T")
+
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1") or 1))
+_DEFAULT_SIZE = min(4, max(0, (os.cpu_count() or 1) // WEB_CONCURRENCY - 1))
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE", str(_DEFAULT_SIZE)) or 0)
+CPU_POOL_MAX_PENDING = int(os.getenv("CPU_POOL_MAX_PENDING", str(max(1, CPU_POOL_SIZE) * 4)) or 4)
+CPU_POOL_QUEUE_TIMEOUT = float(os.getenv("CPU_POOL_QUEUE_TIMEOUT", "10") or 10)
+CPU_POOL_MIN_ROWS = int(os.getenv("CPU_POOL_MIN_ROWS", "2000") or 2000)
+CPU_POOL_START_METHOD = os.getenv("CPU_POOL_START_METHOD", "spawn")
+
+# модули, которые воркер импортирует при прогреве
+_WARM_MODULES = ("app.services.aggregation", "app.services.fifo", "app.api.products",
+                 "openpyxl", "openpyxl.reader.excel")  # openpyxl — если установлен
+
+
+class CpuPoolBusy(RuntimeError):
+    """Очередь пула заполнена дольше CPU_POOL_QUEUE_TIMEOUT."""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(1, CPU_POOL_MAX_PENDING))        # run_sync (потоки)
+_async_slots: "WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = WeakKeyDictionary()
+
+
+def _warm(_: int = 0) -> int:
+    import importlib
+    for name in _WARM_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+    return os.getpid()
+
+
+def enabled() -> bool:
+    return CPU_POOL_SIZE > 0
+
+
+def start() -> Optional[ProcessPoolExecutor]:
+    """Создаёт пул и прогревает все воркеры (вызывается из lifespan)."""
+    global _pool
+    if not enabled():
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=CPU_POOL_SIZE,
+                mp_context=mp.get_context(CPU_POOL_START_METHOD),
+            )
+            list(_pool.map(_warm, range(CPU_POOL_SIZE)))
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _loop_slots(loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+    # asyncio.Semaphore привязан к loop (у TestClient и воркеров — свой)
+    sem = _async_slots.get(loop)
+    if sem is None:
+        sem = _async_slots[loop] = asyncio.Semaphore(max(1, CPU_POOL_MAX_PENDING))
+    return sem
+
+
+def stats() -> Dict[str, Any]:
+    free = getattr(_slots, "_value", CPU_POOL_MAX_PENDING)
+    pending = max(0, CPU_POOL_MAX_PENDING - free)
+    for sem in list(_async_slots.values()):
+        pending += max(0, CPU_POOL_MAX_PENDING - getattr(sem, "_value", CPU_POOL_MAX_PENDING))
+    return {
+        "size": CPU_POOL_SIZE,
+        "started": _pool is not None,
+        "max_pending": CPU_POOL_MAX_PENDING,
+        "pending": pending,
+    }
+
+
+async def run(fn: Callable[..., T], *args: Any, inline: bool = False, **kwargs: Any) -> T:
+    """
+    Выполнить fn в пуле из async-кода. inline=True — в текущем потоке (мелкие входы);
+    пул выключен или ещё прогревается — в потоке, чтобы не держать event loop.
+    """
+    call = functools.partial(fn, *args, **kwargs)
+    if inline:
+        return call()
+    pool = _pool
+    if pool is None:
+        return await asyncio.to_thread(call)
+    loop = asyncio.get_running_loop()
+    sem = _loop_slots(loop)
+    try:
+        await asyncio.wait_for(sem.acquire(), CPU_POOL_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise CpuPoolBusy("CPU pool is saturated, retry later") from None
+    try:
+        return await loop.run_in_executor(pool, call)
+    finally:
+        sem.release()
+
+
+def run_sync(fn: Callable[..., T], *args: Any, inline: bool = False, **kwargs: Any) -> T:
+    """То же для sync-кода (def-эндпоинты, потоки): блокирует вызывающий поток, не event loop."""
+    call = functools.partial(fn, *args, **kwargs)
+    pool = _pool
+    if inline or pool is None:
+        return call()
+    if not _slots.acquire(timeout=CPU_POOL_QUEUE_TIMEOUT):
+        raise CpuPoolBusy("CPU pool is saturated, retry later")
+    try:
+        return pool.submit(call).result()
+    finally:
+        _slots.release()
@@ -0,0 +1,123 @@
+# app/services/fifo.py
+"""
+Чистый расчёт FIFO-распределения продаж по партиям (без БД).
+
+profit_fifo заранее выбирает всё нужное (продажи, партии по SKU, уже распределённое
+количество, комиссии категорий), отдаёт это сюда — при больших rebuild'ах в процесс
+cpu_pool — и затем одним executemany пишет полученные строки в profit_fifo_ledger.
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Tuple
+
+
+def allocate_fifo(
+    sales: List[Dict[str, Any]],
+    batches_by_sku: Dict[str, List[Dict[str, Any]]],
+    allocated: Dict[Tuple[str, int], int],
+    category_pct: Dict[str, float],
+) -> Dict[str, Any]:
+    """
+    sales          — строки продаж в порядке (date_utc_ms, order_code, line_index);
+    batches_by_sku — партии SKU в порядке (date, id) с qty / qty_sold / unit_cost / commission_pct;
+    allocated      — уже распределённое количество по (order_code, line_index);
+    category_pct   — суммарная комиссия категории SKU (для партий без commission_pct).
+
+    Возвращает {rows, touched_batches, gaps, sum_cost, sum_commission, sum_profit}; rows —
+    готовые кортежи для INSERT в profit_fifo_ledger (порядок колонок — LEDGER_COLUMNS).
+    """
+    rows: List[tuple] = []
+    touched: set = set()
+    gaps: List[Dict[str, Any]] = []
+    sum_cost = 0.0
+    sum_comm = 0.0
+    sum_profit = 0.0
+    # партия может встретиться в нескольких строках одного прогона
+    local_usage: Dict[int, int] = {}
+
+    for s in sales:
+        sku = (s.get("sku") or "").strip()
+        if not sku:
+            continue
+        line_index = int(s.get("line_index") or 0)
+        order_code = (s.get("order_code") or "").strip()
+        if not order_code:
+            continue
+
+        qty_total = int(s.get("qty") or 1)
+        if qty_total <= 0:
+            continue
+
+        need = qty_total - int(allocated.get((order_code, line_index), 0))
+        if need <= 0:
+            continue
+
+        unit_price = float(s.get("unit_price") or 0.0)
+        line_total = float(s.get("total_price") or 0.0)
+        revenue_per_piece = (line_total / max(1, qty_total)) if line_total > 0 else unit_price
+
+        for b in batches_by_sku.get(sku, ()):
+            if need <= 0:
+                break
+            bid = int(b["id"])
+            batch_qty = int(b.get("qty") or 0)
+            batch_sold = int(b.get("qty_sold") or 0)
+            used_here = int(local_usage.get(bid, 0))
+            free = max(0, batch_qty - batch_sold - used_here)
+            if free <= 0:
+                continue
+
+            take = min(free, need)
+            if take <= 0:
+                continue
+
+            commission_pct = b.get("commission_pct")
+            if commission_pct is None:
+                commission_pct = category_pct.get(sku, 0.0)
+            commission_pct = float(commission_pct or 0.0)
+
+            unit_cost = float(b.get("unit_cost") or 0.0)
+            part_revenue = revenue_per_piece * take
+            cost_amount = unit_cost * take
+            commission_amount = part_revenue * (commission_pct / 100.0)
+            profit_amount = part_revenue - commission_amount - cost_amount
+
+            rows.append((
+                s.get("order_id"), order_code, s.get("date_utc_ms"), sku, line_index,
+                take, unit_price, (revenue_per_piece * take),
+                bid, b.get("date"), unit_cost,
+                commission_pct, commission_amount, cost_amount, profit_amount,
+            ))
+
+            local_usage[bid] = used_here + take
+            touched.add(bid)
+
+            sum_cost += cost_amount
+            sum_comm += commission_amount
+            sum_profit += profit_amount
+            need -= take
+
+        if need > 0:
+            gaps.append({
+                "order_code": order_code,
+                "line_index": line_index,
+                "sku": sku,
+                "not_covered_qty": need
+            })
+
+    return {
+        "rows": rows,
+        "touched_batches": sorted(touched),
+        "gaps": gaps,
+        "sum_cost": round(sum_cost, 2),
+        "sum_commission": round(sum_comm, 2),
+        "sum_profit": round(sum_profit, 2),
+    }
+
+
+LEDGER_COLUMNS = (
+    "order_id", "order_code", "date_utc_ms", "sku", "line_index",
+    "qty", "unit_price", "total_price",
+    "batch_id", "batch_date", "unit_cost",
+    "commission_pct", "commission_amount", "cost_amount", "profit_amount",
+)
@@ -0,0 +1,68 @@
+# app/services/fifo_queue.py
+"""
+Очередь SKU для инкрементального FIFO.
+
+Склад больше не поддерживается пересчётом периода (fifo/apply по датам, повторный apply
+по дырам, recount-sold по всему журналу). Изменения сами ставят затронутые SKU в
+таблицу fifo_queue — одна строка на SKU, повторное событие только сдвигает since назад:
+
+  since_ms    — новая/изменившаяся строка bridge_lines (sync-by-ids): дата продажи;
+  since_batch — добавленная, изменённая или удалённая партия: её дата.
+
+Разбирает очередь profit_fifo.process_queue (журнал FIFO есть только в PostgreSQL): по
+каждому SKU журнал переигрывается с первой затронутой продажи, qty_sold меняется на
+разницу. Работа пропорциональна изменениям, а не истории.
+
+enqueue принимает и соединение SQLAlchemy (bridge_v2, products на PG), и sqlite3. На SQLite
+журнала FIFO нет и разбирать очередь некому, поэтому там enqueue ничего не пишет и
+возвращает 0 — иначе таблица только росла бы.
+"""
+from __future__ import annotations
+
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+Event = Tuple[str, Optional[int], Optional[str]]  # sku, since_ms, since_batch (YYYY-MM-DD)
+
+_PG_SQL = """
+    INSERT INTO fifo_queue(sku, since_ms, since_batch, queued_at)
+    VALUES (:sku, :since_ms, CAST(:since_batch AS date), now())
+    ON CONFLICT (sku) DO UPDATE SET
+        since_ms    = LEAST(fifo_queue.since_ms, excluded.since_ms),
+        since_batch = LEAST(fifo_queue.since_batch, excluded.since_batch)
+"""
+
+
+def merge(events: Iterable[Event]) -> List[Dict[str, Any]]:
+    """События → по одной записи на SKU с самыми ранними since."""
+    acc: Dict[str, Dict[str, Any]] = {}
+    for sku, since_ms, since_batch in events:
+        sku = (sku or "").strip()
+        if not sku:
+            continue
+        cur = acc.setdefault(sku, {"sku": sku, "since_ms": None, "since_batch": None})
+        if since_ms is not None:
+            cur["since_ms"] = since_ms if cur["since_ms"] is None else min(cur["since_ms"], since_ms)
+        if since_batch:
+            since_batch = str(since_batch)[:10]
+            cur["since_batch"] = since_batch if cur["since_batch"] is None else min(cur["since_batch"], since_batch)
+    return [v for v in acc.values() if v["since_ms"] is not None or v["since_batch"] is not None]
+
+
+def enqueue(con: Any, events: Iterable[Event]) -> int:
+    """Ставит SKU в очередь в транзакции вызывающего. Возвращает число SKU (на SQLite — 0)."""
+    if not drained(con):
+        return 0
+    rows = merge(events)
+    if not rows:
+        return 0
+    from sqlalchemy import text
+    con.execute(text(_PG_SQL), rows)
+    return len(rows)
+
+
+def drained(con: Any) -> bool:
+    """Есть ли кому разбирать очередь для этого соединения: только PostgreSQL (см. profit_fifo)."""
+    if isinstance(con, sqlite3.Connection):
+        return False
+    return con.dialect.name.startswith("postgres")
@@ -322,7 +322,6 @@ def kaspi_sync_run(*, mode: str = "merge", price_only: bool = False, hard_delete
     - возвращаем статистику.
     """
     api = _db_tools()
-    api._ensure_schema()
 
     client = KaspiClient()
     offers = client.load_offers()
@@ -0,0 +1,457 @@
+# app/services/kaspi_transport.py
+"""
+Общий транспорт для всех вызовов Kaspi API (tenant-клиент /orders, обогащение,
+app/kaspi_client, debug_sku): одинаковые правила повторов и ограничения нагрузки.
+
+На каждый Kaspi-токен (тенанта) — своё состояние:
+  token bucket       — не больше KASPI_RPS запросов/сек в среднем, всплеск до KASPI_BURST;
+  AIMD-конкурентность — число одновременных запросов растёт на ~1 за «окно» успешных ответов
+                        и делится пополам на 429 (не чаще раза в секунду), в пределах
+                        [1; KASPI_CONCURRENCY_MAX]; текущий лимит — concurrency(token);
+  circuit breaker    — после KASPI_BREAKER_THRESHOLD подряд ошибок 5xx/сети запросы
+                        KASPI_BREAKER_COOLDOWN сек сразу падают KaspiUnavailable (→ 503),
+                        затем один пробный запрос решает, закрывать ли его.
+
+Повторяются только 429, 5xx (500/502/503/504) и сетевые ошибки — не больше KASPI_RETRY_MAX
+раз; пауза — Retry-After, если Kaspi его прислал, иначе экспонента с полным jitter.
+Остальные 4xx возвращаются вызывающему как есть (raise_for_status — на его стороне).
+
+json_of(resp) — разбор тела через orjson, если установлен.
+iter_pages_sync — постраничное чтение JSON:API: как только первая страница сообщила
+meta.pageCount, остальные запрашиваются параллельно (через тот же лимитер) и отдаются по порядку.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+import httpx
+
+from app.services import metrics
+
+try:  # orjson заметно быстрее разбирает большие страницы /orders; без него — stdlib json
+    import orjson as _orjson
+except ImportError:  # pragma: no cover
+    _orjson = None
+
+KASPI_RPS = float(os.getenv("KASPI_RPS", "20") or 20)
+KASPI_BURST = float(os.getenv("KASPI_BURST", "40") or 40)
+KASPI_CONCURRENCY_START = int(os.getenv("KASPI_CONCURRENCY_START", "4") or 4)
+KASPI_CONCURRENCY_MAX = int(os.getenv("KASPI_CONCURRENCY_MAX", "16") or 16)
+KASPI_RETRY_MAX = int(os.getenv("KASPI_RETRY_MAX", "4") or 0)
+KASPI_RETRY_BASE = float(os.getenv("KASPI_RETRY_BASE", "0.5") or 0.5)
+KASPI_RETRY_MAX_WAIT = float(os.getenv("KASPI_RETRY_MAX_WAIT", "60") or 60)
+KASPI_BREAKER_THRESHOLD = int(os.getenv("KASPI_BREAKER_THRESHOLD", "5") or 5)
+KASPI_BREAKER_COOLDOWN = float(os.getenv("KASPI_BREAKER_COOLDOWN", "30") or 30)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+KASPI_BREAKER_REJECTS = metrics.counter(
+    "kaspi_breaker_rejected_total", "Kaspi calls rejected by an open circuit breaker", ("tenant",))
+KASPI_CONCURRENCY = metrics.gauge(
+    "kaspi_concurrency_limit", "Current AIMD concurrency limit per Kaspi token", ("tenant",))
+KASPI_BREAKER_OPEN = metrics.gauge(
+    "kaspi_breaker_open", "1 while the Kaspi circuit breaker is open", ("tenant",))
+KASPI_BYTES = metrics.counter(
+    "kaspi_response_bytes_total", "Bytes of Kaspi response bodies", ("endpoint",))
+
+
+class KaspiUnavailable(RuntimeError):
+    """Circuit breaker открыт: Kaspi недавно стабильно отвечал ошибками."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Kaspi API is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# примитивы
+# ──────────────────────────────────────────────────────────────────────────────
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = max(0.001, rate)
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Забирает токен (уходя в минус при нехватке) и возвращает, сколько ждать перед запросом."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            self._tokens -= 1.0
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class AimdLimiter:
+    # лимитер общий для потоков (сканирование) и корутин (обогащение), возможно из разных
+    # event loop'ов: потоки ждут threading.Condition, корутины — asyncio.Condition своего loop,
+    # которую release будит через call_soon_threadsafe (только loop'ы, где кто-то ждёт)
+    def __init__(self, start: int, maximum: int) -> None:
+        self.maximum = max(1, maximum)
+        self.limit = float(min(max(1, start), self.maximum))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async: Dict[asyncio.AbstractEventLoop, list] = {}   # loop → [asyncio.Condition, ждущих]
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait(0.05)
+            self.in_flight += 1
+
+    async def acquire_async(self) -> None:
+        if self.try_acquire():
+            return
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            entry = self._async.get(loop)
+            if entry is None:
+                entry = self._async[loop] = [asyncio.Condition(), 0]
+            entry[1] += 1
+        cond = entry[0]
+        try:
+            async with cond:
+                # между неудачной попыткой и wait() нет await: release, случившийся после
+                # попытки, разбудит нас — его notify ждёт освобождения cond
+                while not self.try_acquire():
+                    await cond.wait()
+        finally:
+            with self._cond:
+                entry[1] -= 1
+                if entry[1] <= 0 and self._async.get(loop) is entry:
+                    del self._async[loop]
+
+    def release(self, outcome: str) -> None:
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            if outcome == "ok":
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            elif outcome == "throttled":
+                now = time.monotonic()
+                if now - self._last_decrease >= 1.0:
+                    self.limit = max(1.0, self.limit / 2.0)
+                    self._last_decrease = now
+            self._cond.notify_all()
+            waiting = [(loop, entry[0]) for loop, entry in self._async.items()]
+        for loop, cond in waiting:
+            try:
+                loop.call_soon_threadsafe(_wake_async, loop, cond)
+            except RuntimeError:
+                pass   # loop уже закрыт
+
+
+def _wake_async(loop: asyncio.AbstractEventLoop, cond: asyncio.Condition) -> None:
+    async def notify() -> None:
+        async with cond:
+            cond.notify_all()
+    loop.create_task(notify())
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self) -> None:
+        """Пропускает запрос или бросает KaspiUnavailable; после cooldown — один пробный."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            left = self.opened_at + self.cooldown - time.monotonic()
+            if left <= 0 and not self._probing:
+                self._probing = True
+                return
+            raise KaspiUnavailable(max(left, 1.0))
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class _Limits:
+    def __init__(self) -> None:
+        self.bucket = TokenBucket(KASPI_RPS, KASPI_BURST)
+        self.aimd = AimdLimiter(KASPI_CONCURRENCY_START, KASPI_CONCURRENCY_MAX)
+        self.breaker = CircuitBreaker(KASPI_BREAKER_THRESHOLD, KASPI_BREAKER_COOLDOWN)
+
+
+_limits: Dict[str, _Limits] = {}
+_limits_lock = threading.Lock()
+
+
+def tenant_key(token: Optional[str]) -> str:
+    # в метрики и логи — не сам токен, а короткий хэш
+    return hashlib.sha1((token or "").encode()).hexdigest()[:10] if token else "-"
+
+
+def _limits_for(token: Optional[str]) -> tuple[str, _Limits]:
+    key = tenant_key(token)
+    lim = _limits.get(key)
+    if lim is None:
+        with _limits_lock:
+            lim = _limits.setdefault(key, _Limits())
+    return key, lim
+
+
+def concurrency(token: Optional[str]) -> int:
+    """Текущий AIMD-лимит параллельных запросов для токена."""
+    return int(_limits_for(token)[1].aimd.limit)
+
+
+@metrics.on_scrape
+def _limits_metrics() -> None:
+    for key, lim in list(_limits.items()):
+        KASPI_CONCURRENCY.set(lim.aimd.limit, tenant=key)
+        KASPI_BREAKER_OPEN.set(1 if lim.breaker.is_open() else 0, tenant=key)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# повторы
+# ──────────────────────────────────────────────────────────────────────────────
+_SUBRESOURCES = {"entries", "product", "merchantproduct", "masterproduct", "orderentries"}
+
+
+def endpoint_of(url: Any) -> str:
+    """Лейбл для метрик: /orders, /orders/{id}/entries, /orderentries — без id и базового пути."""
+    segs = [s for s in httpx.URL(str(url)).path.split("/") if s]
+    for i, s in enumerate(segs):
+        if s.lower() in ("orders", "orderentries", "offers", "products"):
+            segs = segs[i:]
+            break
+    out = [segs[0]] if segs else []
+    out += [s if s.lower() in _SUBRESOURCES else "{id}" for s in segs[1:]]
+    return "/" + "/".join(out)
+
+
+def _retry_after(resp: httpx.Response) -> Optional[float]:
+    raw = (resp.headers.get("Retry-After") or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int) -> float:
+    # full jitter: равномерно в [0; base * 2^attempt]
+    return random.uniform(0.0, min(KASPI_RETRY_MAX_WAIT, KASPI_RETRY_BASE * (2 ** attempt)))
+
+
+def _delay_for(resp: Optional[httpx.Response], attempt: int) -> float:
+    ra = _retry_after(resp) if resp is not None else None
+    if ra is None:
+        return _backoff(attempt)
+    # Retry-After + немного jitter, чтобы параллельные запросы не вернулись одновременно
+    return min(KASPI_RETRY_MAX_WAIT, ra + random.uniform(0.0, min(1.0, ra * 0.1 + 0.05)))
+
+
+def _classify(lim: _Limits, resp: Optional[httpx.Response]) -> str:
+    if resp is None or resp.status_code >= 500:
+        lim.breaker.failure()
+        return "error"
+    # 429 — Kaspi жив, просто просит сбавить темп: breaker закрывается, AIMD уменьшает лимит
+    lim.breaker.success()
+    return "throttled" if resp.status_code == 429 else "ok"
+
+
+def request_sync(client: httpx.Client, method: str, url: Any, *, token: Optional[str],
+                 endpoint: Optional[str] = None, **kwargs: Any) -> httpx.Response:
+    """Запрос через общий лимитер с повторами (для sync-кода в потоках)."""
+    key, lim = _limits_for(token)
+    ep = endpoint or endpoint_of(url)
+    attempt = 0
+    while True:
+        try:
+            lim.breaker.check()
+        except KaspiUnavailable:
+            KASPI_BREAKER_REJECTS.inc(tenant=key)
+            raise
+        wait = lim.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        lim.aimd.acquire()
+        resp: Optional[httpx.Response] = None
+        t = time.perf_counter()
+        try:
+            resp = client.request(method, url, **kwargs)
+        except httpx.RequestError as e:
+            metrics.observe_kaspi(ep, type(e).__name__, time.perf_counter() - t)
+            lim.aimd.release(_classify(lim, None))
+            if attempt >= KASPI_RETRY_MAX:
+                raise
+        except BaseException:
+            lim.aimd.release("cancelled")
+            raise
+        else:
+            metrics.observe_kaspi(ep, resp.status_code, time.perf_counter() - t)
+            KASPI_BYTES.inc(len(resp.content), endpoint=ep)
+            lim.aimd.release(_classify(lim, resp))
+        if resp is not None and (resp.status_code not in RETRY_STATUSES or attempt >= KASPI_RETRY_MAX):
+            return resp
+        delay = _delay_for(resp, attempt)
+        if resp is not None:
+            resp.close()
+        metrics.KASPI_RETRIES.inc(endpoint=ep)
+        attempt += 1
+        time.sleep(delay)
+
+
+async def request(client: httpx.AsyncClient, method: str, url: Any, *, token: Optional[str],
+                  endpoint: Optional[str] = None, **kwargs: Any) -> httpx.Response:
+    """То же для async-кода."""
+    key, lim = _limits_for(token)
+    ep = endpoint or endpoint_of(url)
+    attempt = 0
+    while True:
+        try:
+            lim.breaker.check()
+        except KaspiUnavailable:
+            KASPI_BREAKER_REJECTS.inc(tenant=key)
+            raise
+        wait = lim.bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await lim.aimd.acquire_async()
+        resp: Optional[httpx.Response] = None
+        t = time.perf_counter()
+        try:
+            resp = await client.request(method, url, **kwargs)
+        except httpx.RequestError as e:
+            metrics.observe_kaspi(ep, type(e).__name__, time.perf_counter() - t)
+            lim.aimd.release(_classify(lim, None))
+            if attempt >= KASPI_RETRY_MAX:
+                raise
+        except BaseException:
+            lim.aimd.release("cancelled")
+            raise
+        else:
+            metrics.observe_kaspi(ep, resp.status_code, time.perf_counter() - t)
+            KASPI_BYTES.inc(len(resp.content), endpoint=ep)
+            lim.aimd.release(_classify(lim, resp))
+        if resp is not None and (resp.status_code not in RETRY_STATUSES or attempt >= KASPI_RETRY_MAX):
+            return resp
+        delay = _delay_for(resp, attempt)
+        if resp is not None:
+            await resp.aclose()
+        metrics.KASPI_RETRIES.inc(endpoint=ep)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# постраничное чтение
+# ──────────────────────────────────────────────────────────────────────────────
+def json_of(resp: httpx.Response) -> Any:
+    """resp.json(), но через orjson, если он установлен."""
+    if _orjson is None:
+        return resp.json()
+    return _orjson.loads(resp.content)
+
+
+def iter_pages_sync(client: httpx.Client, url: Any, *, token: Optional[str], params: Dict[str, Any],
+                    endpoint: Optional[str] = None, headers: Optional[Dict[str, str]] = None,
+                    page_param: str = "page[number]",
+                    decode: Optional[Callable[[httpx.Response], Dict[str, Any]]] = None,
+                    stats: Optional[Dict[str, float]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Страницы JSON:API по порядку. Первая отдаётся сразу; если в ней есть meta.pageCount,
+    следующие запрашиваются параллельно (не больше KASPI_CONCURRENCY_MAX потоков, реальную
+    параллельность держит AIMD-лимитер) с окном упреждения, иначе — по links.next.
+    Ошибочный статус — httpx.HTTPStatusError. stats: pages, page_count, fetch_s (ожидание страниц).
+    """
+    ep = endpoint or endpoint_of(url)
+    decode = decode or json_of
+
+    def fetch(u: Any, p: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        r = request_sync(client, "GET", u, token=token, endpoint=ep, params=p, headers=headers)
+        r.raise_for_status()
+        return decode(r)
+
+    def account(t: float) -> None:
+        if stats is not None:
+            stats["pages"] = stats.get("pages", 0) + 1
+            stats["fetch_s"] = stats.get("fetch_s", 0.0) + (time.perf_counter() - t)
+
+    t = time.perf_counter()
+    page = fetch(url, params)
+    account(t)
+    page_count = (page.get("meta") or {}).get("pageCount")
+    if stats is not None and isinstance(page_count, int):
+        stats.setdefault("page_count", page_count)
+    yield page
+
+    first = int(params.get(page_param) or 0)
+    if isinstance(page_count, int) and page_count > 1:
+        rest = iter(range(first + 1, first + page_count))
+        workers = min(page_count - 1, KASPI_CONCURRENCY_MAX)
+        pending: Deque[Any] = deque()
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kaspi-page")
+
+        def submit_next() -> None:
+            n = next(rest, None)
+            if n is not None:
+                # своя копия контекста: профиль запроса видит и эти вызовы
+                pending.append(pool.submit(contextvars.copy_context().run, fetch, url, {**params, page_param: n}))
+
+        try:
+            for _ in range(workers * 2):
+                submit_next()
+            while pending:
+                fut = pending.popleft()
+                t = time.perf_counter()
+                page = fut.result()
+                account(t)
+                submit_next()
+                yield page
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # без pageCount — как раньше по links.next; с ним — добираем страницы, появившиеся за время чтения
+    nxt = (page.get("links") or {}).get("next")
+    while nxt and (page.get("data") or []):
+        t = time.perf_counter()
+        page = fetch(nxt, None)
+        account(t)
+        yield page
+        nxt = (page.get("links") or {}).get("next")
@@ -0,0 +1,432 @@
+# app/services/metrics.py
+"""
+Метрики в текстовом формате Prometheus (GET /metrics) без внешних зависимостей.
+
+На горячем пути — только инкремент числа в dict под коротким lock'ом; текст собирается
+лишь при скрейпе, а значения «сколько сейчас» (jobs, cpu_pool, очередь обогащения)
+снимаются callback'ами в момент скрейпа. METRICS_ENABLED=false отключает запись целиком.
+
+Что пишется:
+  http_request_duration_seconds{method,route,status}     — по шаблону маршрута, не по URL;
+  kaspi_requests_total / kaspi_request_duration_seconds  — вызовы Kaspi по endpoint/status;
+  kaspi_retries_total{endpoint}, kaspi_scan_pages        — повторы и страниц на одно сканирование;
+  collect_phase_seconds{phase}                           — fetch / normalize / aggregate в _collect_range;
+  db_query_duration_seconds{module,op}                   — запросы products / bridge_v2 / profit_fifo / tenant / state;
+  state_get_total{ns,result}                             — попадания в кэши и jobs (hit/miss);
+  jobs_*, enrich_*, cpu_pool_*                           — размеры очередей.
+
+Метрики процесса: при нескольких воркерах Prometheus собирает их с каждого (или через
+общий лейбл instance) — счётчики между процессами здесь не складываются.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.services import profiling
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip() or None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+PAGE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Labels:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _fmt_labels(self, key: Labels, extra: str = "") -> str:
+        parts = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *a: Any, **kw: Any) -> None:
+        super().__init__(*a, **kw)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{self._fmt_labels(k)} {_num(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *a: Any, **kw: Any) -> None:
+        super().__init__(*a, **kw)
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{self._fmt_labels(k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [count по каждому bucket (не накопительно)..., +Inf, sum]
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        idx = len(self.buckets)
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                idx = i
+                break
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            row[idx] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        out: List[str] = []
+        for key, row in items:
+            acc = 0.0
+            for b, c in zip(self.buckets, row):
+                acc += c
+                le = 'le="%s"' % _num(b)
+                out.append(f"{self.name}_bucket{self._fmt_labels(key, le)} {_num(acc)}")
+            acc += row[len(self.buckets)]
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{self._fmt_labels(key, le)} {_num(acc)}")
+            out.append(f"{self.name}_count{self._fmt_labels(key)} {_num(acc)}")
+            out.append(f"{self.name}_sum{self._fmt_labels(key)} {_num(row[-1])}")
+        return out
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v: float) -> str:
+    if v == int(v) and abs(v) < 1e15:
+        return str(int(v))
+    return repr(float(v))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# реестр
+# ──────────────────────────────────────────────────────────────────────────────
+_registry: List[_Metric] = []
+_collectors: List[Callable[[], None]] = []
+
+
+def _register(m: _Metric) -> Any:
+    _registry.append(m)
+    return m
+
+
+def counter(name: str, doc: str, labelnames: Iterable[str] = ()) -> Counter:
+    return _register(Counter(name, doc, labelnames))
+
+
+def gauge(name: str, doc: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return _register(Gauge(name, doc, labelnames))
+
+
+def histogram(name: str, doc: str, labelnames: Iterable[str] = (),
+              buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, doc, labelnames, buckets))
+
+
+def on_scrape(fn: Callable[[], None]) -> Callable[[], None]:
+    """Регистрирует callback, который обновляет gauge'и непосредственно перед скрейпом."""
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> str:
+    for fn in list(_collectors):
+        try:
+            fn()
+        except Exception:
+            pass
+    lines: List[str] = []
+    for m in _registry:
+        lines.append(f"# HELP {m.name} {m.doc}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# метрики приложения
+# ──────────────────────────────────────────────────────────────────────────────
+HTTP_LATENCY = histogram("http_request_duration_seconds", "HTTP request latency by route template",
+                         ("method", "route", "status"))
+HTTP_INFLIGHT = gauge("http_requests_in_flight", "HTTP requests being processed")
+
+KASPI_REQUESTS = counter("kaspi_requests_total", "Kaspi API calls by endpoint and status", ("endpoint", "status"))
+KASPI_LATENCY = histogram("kaspi_request_duration_seconds", "Kaspi API call latency", ("endpoint",))
+KASPI_RETRIES = counter("kaspi_retries_total", "Kaspi API calls repeated after an error", ("endpoint",))
+KASPI_SCAN_PAGES = histogram("kaspi_scan_pages", "Kaspi /orders pages fetched per scan", (), PAGE_BUCKETS)
+
+COLLECT_PHASE = histogram("collect_phase_seconds", "_collect_range phase timings", ("phase",))
+COLLECT_ORDERS = counter("collect_orders_total", "Orders passed to aggregation")
+
+ENRICH_QUEUE = gauge("enrich_queue_depth", "Order enrichment requests waiting for a slot")
+ENRICH_INFLIGHT = gauge("enrich_in_flight", "Order enrichment requests in progress")
+ENRICH_ERRORS = counter("enrich_errors_total", "Order enrichment lookups that failed", ("endpoint", "error"))
+
+DB_LATENCY = histogram("db_query_duration_seconds", "DB query latency by module", ("module", "op"), DB_BUCKETS)
+DB_ERRORS = counter("db_query_errors_total", "DB queries that raised", ("module",))
+
+STATE_GETS = counter("state_get_total", "State/cache lookups by namespace and result", ("ns", "result"))
+
+JOBS_ACTIVE = gauge("jobs_active", "Background jobs running in this process", ("kind",))
+JOBS_FINISHED = counter("jobs_finished_total", "Background jobs finished", ("kind", "status"))
+
+CPU_POOL_SIZE = gauge("cpu_pool_size", "CPU pool processes")
+CPU_POOL_PENDING = gauge("cpu_pool_pending", "Tasks submitted to the CPU pool and not finished")
+
+PROCESS_UPTIME = gauge("process_uptime_seconds", "Seconds since the process imported metrics")
+_T0 = time.time()
+
+
+@on_scrape
+def _uptime() -> None:
+    PROCESS_UPTIME.set(time.time() - _T0)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# HTTP
+# ──────────────────────────────────────────────────────────────────────────────
+async def http_metrics_middleware(request, call_next):
+    """Латентность по шаблону маршрута (/jobs/{job_id}, а не /jobs/abc…): кардинальность ограничена."""
+    if not METRICS_ENABLED:
+        return await call_next(request)
+    t = time.perf_counter()
+    HTTP_INFLIGHT.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_INFLIGHT.dec()
+        route = request.scope.get("route")
+        HTTP_LATENCY.observe(
+            time.perf_counter() - t,
+            method=request.method,
+            route=getattr(route, "path", None) or "<unmatched>",
+            status=status,
+        )
+
+
+def check_token(request) -> bool:
+    """METRICS_TOKEN задан — скрейпер должен прислать Bearer или ?token=."""
+    if not METRICS_TOKEN:
+        return True
+    hdr = request.headers.get("authorization") or ""
+    sent = hdr.split(" ", 1)[1].strip() if hdr.lower().startswith("bearer ") else request.query_params.get("token")
+    return sent == METRICS_TOKEN
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Kaspi
+# ──────────────────────────────────────────────────────────────────────────────
+def observe_kaspi(endpoint: str, status: Any, seconds: float) -> None:
+    """status — HTTP-код или имя исключения (timeout, network…)."""
+    KASPI_REQUESTS.inc(endpoint=endpoint, status=status)
+    KASPI_LATENCY.observe(seconds, endpoint=endpoint)
+    if profiling.active():
+        now = time.perf_counter()
+        profiling.record(f"kaspi {endpoint}", now - seconds, now, status=str(status))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# DB: модуль-лейбл задаётся там, где создаётся соединение
+# ──────────────────────────────────────────────────────────────────────────────
+def _op(sql: Any) -> str:
+    s = str(sql).lstrip()[:16].split(None, 1)
+    return s[0].lower() if s else ""
+
+
+def _observe_db(module: str, sql: Any, t: float, ok: bool = True) -> None:
+    DB_LATENCY.observe(time.perf_counter() - t, module=module, op=_op(sql))
+    if not ok:
+        DB_ERRORS.inc(module=module)
+    # в профилируемом запросе каждый запрос к БД — отдельный span
+    profiling.record(f"db {module}", t, op=_op(sql), ok=ok)
+
+
+def instrument_engine(engine: Any, module: str) -> Any:
+    """SQLAlchemy Engine: время каждого cursor.execute через события движка."""
+    if not METRICS_ENABLED:
+        return engine
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_metrics_t", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stack = conn.info.get("_metrics_t")
+        if stack:
+            _observe_db(module, statement, stack.pop())
+
+    @event.listens_for(engine, "handle_error")
+    def _error(ctx):
+        stack = ctx.connection.info.get("_metrics_t") if ctx.connection is not None else None
+        if stack:
+            _observe_db(module, ctx.statement or "", stack.pop(), ok=False)
+
+    return engine
+
+
+_sqlite_factories: Dict[str, type] = {}
+_pg_cursors: Dict[str, type] = {}
+
+
+def sqlite_factory(module: str) -> type:
+    """Класс соединения для sqlite3.connect(..., factory=...) с замером запросов."""
+    import sqlite3
+    if not METRICS_ENABLED:
+        return sqlite3.Connection
+    cls = _sqlite_factories.get(module)
+    if cls is not None:
+        return cls
+
+    class _Cursor(sqlite3.Cursor):
+        def execute(self, sql, *args):
+            t = time.perf_counter()
+            ok = False
+            try:
+                res = super().execute(sql, *args)
+                ok = True
+                return res
+            finally:
+                _observe_db(module, sql, t, ok)
+
+        def executemany(self, sql, *args):
+            t = time.perf_counter()
+            ok = False
+            try:
+                res = super().executemany(sql, *args)
+                ok = True
+                return res
+            finally:
+                _observe_db(module, sql, t, ok)
+
+    class _Connection(sqlite3.Connection):
+        def cursor(self, factory=_Cursor):
+            return super().cursor(factory)
+
+        def execute(self, sql, *args):
+            return self.cursor().execute(sql, *args)
+
+        def executemany(self, sql, *args):
+            return self.cursor().executemany(sql, *args)
+
+    cls = _sqlite_factories[module] = _Connection
+    return cls
+
+
+def pg_cursor_factory(module: str) -> Optional[type]:
+    """cursor_factory для psycopg.connect(...) с замером запросов (None — метрики выключены)."""
+    if not METRICS_ENABLED:
+        return None
+    cls = _pg_cursors.get(module)
+    if cls is not None:
+        return cls
+    import psycopg
+
+    class _Cursor(psycopg.Cursor):
+        def execute(self, query, params=None, **kw):
+            t = time.perf_counter()
+            ok = False
+            try:
+                res = super().execute(query, params, **kw)
+                ok = True
+                return res
+            finally:
+                _observe_db(module, query, t, ok)
+
+        def executemany(self, query, params_seq, **kw):
+            t = time.perf_counter()
+            ok = False
+            try:
+                res = super().executemany(query, params_seq, **kw)
+                ok = True
+                return res
+            finally:
+                _observe_db(module, query, t, ok)
+
+    cls = _pg_cursors[module] = _Cursor
+    return cls
+
+
+def pg_connect_kwargs(module: str) -> Dict[str, Any]:
+    factory = pg_cursor_factory(module)
+    return {"cursor_factory": factory} if factory is not None else {}
@@ -0,0 +1,173 @@
+# app/services/migrations.py
+"""
+Версионированные миграции схемы.
+
+Источник истины — SQL-файлы в каталоге migrations/:
+  - migrations/*.sql         — PostgreSQL (DATABASE_URL задан);
+  - migrations/sqlite/*.sql  — локальный SQLite (DB_PATH), если PG не настроен.
+
+Файлы применяются по возрастанию имени, ровно один раз; версия = имя файла без .sql.
+Имя — YYYYMMDD_NN_описание с датой добавления (не будущей): иначе файл, добавленный
+позже, окажется раньше в порядке применения. Применённые версии пишутся в таблицу
+schema_migrations; переименованные версии переносятся в ней по RENAMED.
+
+migrations/20250822_add_store_settings.sql раньше применяли вручную — теперь его применяет
+раннер, как и остальные; файл идемпотентен (IF NOT EXISTS) и на базах, где он уже был. Запуск — один раз в lifespan
+приложения (или вручную: `python -m app.services.migrations`).
+
+Шаги данных (DATA_STEPS) выполняются сразу после SQL-файла своей версии в той же
+транзакции — для заполнения, SQL которого живёт в коде (сводка склада, sku_summary).
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from app.services import sku_summary
+
+MIGRATIONS_DIR = Path(os.getenv("MIGRATIONS_DIR") or Path(__file__).resolve().parents[2] / "migrations")
+SQLITE_MIGRATIONS_DIR = MIGRATIONS_DIR / "sqlite"
+
+# ключ pg_advisory_xact_lock: несколько воркеров не применяют миграции параллельно
+_PG_LOCK_KEY = 82_250_822
+
+
+def _backfill_sku_summary(execute: Callable[[str], Any], pg: bool) -> None:
+    execute(sku_summary.upsert_sql(pg=pg))
+
+
+# версия → шаг(execute, pg) после её SQL-файла
+DATA_STEPS: Dict[str, Callable[[Callable[[str], Any], bool], None]] = {
+    "20261018_01_core_schema": _backfill_sku_summary,
+}
+
+# старая версия → новая: базы, где файл применён под прежним именем, не применяют его снова
+RENAMED: Dict[str, str] = {
+    "20261018_core_schema": "20261018_01_core_schema",
+    "20261019_app_state": "20261018_02_app_state",
+    "20261020_daily_order_rollup": "20261018_03_daily_order_rollup",
+    "20261021_fifo_queue": "20261018_04_fifo_queue",
+}
+
+
+def _pg_url() -> str:
+    url = (os.getenv("DATABASE_URL") or "").strip()
+    if url.startswith("postgresql+"):
+        url = "postgresql://" + url.split("://", 1)[1]
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url.split("://", 1)[1]
+    return url
+
+
+def _sqlite_path() -> str:
+    from app.api.products import DB_PATH
+    return DB_PATH
+
+
+def _files(directory: Path) -> List[Path]:
+    if not directory.is_dir():
+        return []
+    return sorted(p for p in directory.glob("*.sql") if p.is_file())
+
+
+def _split_sqlite(script: str) -> List[str]:
+    out: List[str] = []
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            stmt = buf.strip()
+            if stmt and stmt != ";":
+                out.append(stmt)
+            buf = ""
+    if buf.strip():
+        out.append(buf.strip())
+    return out
+
+
+def _run_pg(url: str) -> Dict[str, Any]:
+    import psycopg
+
+    applied_now: List[str] = []
+    with psycopg.connect(url, autocommit=False) as con:
+        cur = con.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_PG_LOCK_KEY,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations(
+                version TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ DEFAULT now()
+            )
+        """)
+        for old, new in RENAMED.items():
+            cur.execute("UPDATE schema_migrations SET version = %s WHERE version = %s", (new, old))
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {r[0] for r in cur.fetchall()}
+        for path in _files(MIGRATIONS_DIR):
+            version = path.stem
+            if version in done:
+                continue
+            cur.execute(path.read_text(encoding="utf-8"))
+            if version in DATA_STEPS:
+                DATA_STEPS[version](cur.execute, True)
+            cur.execute("INSERT INTO schema_migrations(version) VALUES (%s)", (version,))
+            applied_now.append(version)
+            done.add(version)
+        con.commit()
+    return {"dialect": "postgresql", "applied": applied_now, "version": max(done) if done else None}
+
+
+def _run_sqlite(path: str) -> Dict[str, Any]:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    applied_now: List[str] = []
+    con = sqlite3.connect(path, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations(
+                version TEXT PRIMARY KEY,
+                applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        for old, new in RENAMED.items():
+            con.execute("UPDATE schema_migrations SET version = ? WHERE version = ?", (new, old))
+        done = {r[0] for r in con.execute("SELECT version FROM schema_migrations")}
+        for mig in _files(SQLITE_MIGRATIONS_DIR):
+            version = mig.stem
+            if version in done:
+                continue
+            for stmt in _split_sqlite(mig.read_text(encoding="utf-8")):
+                try:
+                    con.execute(stmt)
+                except sqlite3.OperationalError as e:
+                    # ADD COLUMN без IF NOT EXISTS: колонка уже есть — это норма
+                    if "duplicate column name" in str(e).lower():
+                        continue
+                    raise
+            if version in DATA_STEPS:
+                DATA_STEPS[version](con.execute, False)
+            con.execute("INSERT INTO schema_migrations(version) VALUES (?)", (version,))
+            applied_now.append(version)
+            done.add(version)
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    return {"dialect": "sqlite", "applied": applied_now, "version": max(done) if done else None}
+
+
+def run_migrations() -> Dict[str, Any]:
+    """Применяет недостающие миграции и возвращает {dialect, applied, version}."""
+    url = _pg_url()
+    if url:
+        return _run_pg(url)
+    return _run_sqlite(_sqlite_path())
+
+
+if __name__ == "__main__":  # pragma: no cover
+    print(run_migrations())
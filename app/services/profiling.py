@@ -0,0 +1,295 @@
+# app/services/profiling.py
+"""
+Профилирование отдельного запроса по запросу админа.
+
+Включается заголовком `X-Profile: 1` или параметром `?_profile=1`, только для админов:
+  PROFILING_ADMINS — CSV tenant_id / sub / email из Bearer JWT;
+  ADMIN_API_KEY    — либо заголовок X-Admin-Key с этим ключом.
+Без настроенных админов флаг молча игнорируется.
+
+Запрос оборачивается в pyinstrument (если установлен — HTML-отчёт) или в cProfile
+(текстовый отчёт по cumulative; видит только поток event loop — сканирование в
+asyncio.to_thread и cpu_pool в нём не видны, их покрывают span'ы). Поверх этого
+пишутся явные span'ы — `span("collect_range")` и т. п., вызовы Kaspi и каждый запрос
+к БД (через app.services.metrics) — в Chrome trace JSON, который открывается
+в speedscope / Perfetto и показывает разбивку по фазам.
+
+Профили лежат в PROFILE_DIR кольцевым буфером из PROFILE_KEEP последних;
+список — GET /debug/profiles. Вне профилируемого запроса span() — одна проверка ContextVar.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import contextvars
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from fastapi import HTTPException, Request
+
+PROFILING_ADMINS = {s.strip().lower() for s in (os.getenv("PROFILING_ADMINS") or "").split(",") if s.strip()}
+ADMIN_API_KEY = (os.getenv("ADMIN_API_KEY") or "").strip() or None
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "kaspi-profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50") or 50)
+PROFILE_TOP = 80  # строк в текстовом отчёте cProfile
+
+_current: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("request_profile", default=None)
+# cProfile/pyinstrument — один на поток; второй параллельный профиль пишет только span'ы
+_sampler_lock = threading.Lock()
+_dir_lock = threading.Lock()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# кто админ
+# ──────────────────────────────────────────────────────────────────────────────
+def _jwt_claims(request: Request) -> Dict[str, Any]:
+    raw = getattr(request.state, "supabase_token", "") or ""
+    try:
+        payload = raw.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload.encode()).decode())
+    except Exception:
+        return {}
+
+
+def is_admin(request: Request) -> bool:
+    if ADMIN_API_KEY and request.headers.get("X-Admin-Key") == ADMIN_API_KEY:
+        return True
+    if not PROFILING_ADMINS:
+        return False
+    claims = _jwt_claims(request)
+    ids = {getattr(request.state, "tenant_id", None), claims.get("sub"), claims.get("email")}
+    return any(str(x).lower() in PROFILING_ADMINS for x in ids if x)
+
+
+def require_admin(request: Request) -> bool:
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="admin only")
+    return True
+
+
+def requested(request: Request) -> bool:
+    flag = request.headers.get("X-Profile") or request.query_params.get("_profile") or ""
+    return flag.strip().lower() in ("1", "true", "yes", "on")
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# профиль запроса
+# ──────────────────────────────────────────────────────────────────────────────
+def _lane() -> int:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+class RequestProfile:
+    def __init__(self, request: Request) -> None:
+        self.id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        self.method = request.method
+        self.path = request.url.path
+        self.query = str(request.url.query)
+        self.tenant_id = getattr(request.state, "tenant_id", None)
+        self.spans: List[tuple] = []  # (name, lane, t_start, t_end, attrs)
+        self._t0 = time.perf_counter()
+        self._t1: Optional[float] = None
+        self._sampler: Any = None
+        self._kind = "spans"
+
+    # ---- сэмплер / cProfile ----
+    def start(self) -> None:
+        if not _sampler_lock.acquire(blocking=False):
+            return
+        try:
+            from pyinstrument import Profiler  # опциональная зависимость
+            self._sampler = Profiler(async_mode="enabled")
+            self._kind = "pyinstrument"
+        except ImportError:
+            import cProfile
+            self._sampler = cProfile.Profile()
+            self._kind = "cprofile"
+        try:
+            if self._kind == "pyinstrument":
+                self._sampler.start()
+            else:
+                self._sampler.enable()
+        except Exception:
+            self._sampler, self._kind = None, "spans"
+            _sampler_lock.release()
+
+    def stop(self) -> None:
+        self._t1 = time.perf_counter()
+        if self._sampler is None:
+            return
+        try:
+            if self._kind == "pyinstrument":
+                self._sampler.stop()
+            else:
+                self._sampler.disable()
+        finally:
+            _sampler_lock.release()
+
+    def add(self, name: str, t_start: float, t_end: float, attrs: Optional[Dict[str, Any]] = None) -> None:
+        self.spans.append((name, _lane(), t_start, t_end, attrs or {}))
+
+    # ---- сохранение ----
+    def _report(self) -> tuple[str, str]:
+        if self._kind == "pyinstrument":
+            return "html", self._sampler.output_html()
+        if self._kind == "cprofile":
+            import pstats
+            buf = io.StringIO()
+            pstats.Stats(self._sampler, stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            return "txt", buf.getvalue()
+        return "", ""
+
+    def _trace(self) -> Dict[str, Any]:
+        lanes: Dict[int, int] = {}
+        events: List[Dict[str, Any]] = []
+        for name, lane, ts, te, attrs in self.spans:
+            tid = lanes.setdefault(lane, len(lanes) + 1)
+            events.append({
+                "name": name, "ph": "X", "pid": 1, "tid": tid,
+                "ts": round((ts - self._t0) * 1e6, 1), "dur": round((te - ts) * 1e6, 1),
+                "args": attrs,
+            })
+        for lane, tid in lanes.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": f"lane {tid}"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def _phases(self) -> Dict[str, Dict[str, float]]:
+        out: Dict[str, Dict[str, float]] = {}
+        for name, _, ts, te, _ in self.spans:
+            row = out.setdefault(name, {"count": 0, "total_ms": 0.0})
+            row["count"] += 1
+            row["total_ms"] = round(row["total_ms"] + (te - ts) * 1000.0, 2)
+        return out
+
+    def save(self, status: int) -> str:
+        ext, report = self._report()
+        meta = {
+            "id": self.id,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "method": self.method,
+            "path": self.path,
+            "query": self.query,
+            "tenant_id": self.tenant_id,
+            "status": status,
+            "duration_ms": round(((self._t1 or time.perf_counter()) - self._t0) * 1000.0, 1),
+            "profiler": self._kind,
+            "report": ext or None,
+            "phases": self._phases(),
+        }
+        with _dir_lock:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            if ext:
+                (PROFILE_DIR / f"{self.id}.{ext}").write_text(report, encoding="utf-8")
+            (PROFILE_DIR / f"{self.id}.trace.json").write_text(json.dumps(self._trace()), encoding="utf-8")
+            (PROFILE_DIR / f"{self.id}.meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+            _prune()
+        return self.id
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# span'ы
+# ──────────────────────────────────────────────────────────────────────────────
+def active() -> bool:
+    return _current.get() is not None
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    prof = _current.get()
+    if prof is None:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        prof.add(name, t, time.perf_counter(), attrs)
+
+
+def detach() -> None:
+    """Фоновая работа, которая переживёт запрос, не пишет span'ы в его профиль."""
+    _current.set(None)
+
+
+def record(name: str, t_start: float, t_end: Optional[float] = None, **attrs: Any) -> None:
+    """Span, замеренный снаружи (например, запрос к БД в app.services.metrics)."""
+    prof = _current.get()
+    if prof is not None:
+        prof.add(name, t_start, t_end if t_end is not None else time.perf_counter(), attrs)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# middleware
+# ──────────────────────────────────────────────────────────────────────────────
+async def profiling_middleware(request: Request, call_next):
+    if not requested(request) or not is_admin(request):
+        return await call_next(request)
+    prof = RequestProfile(request)
+    token = _current.set(prof)
+    prof.start()
+    try:
+        response = await call_next(request)
+    finally:
+        prof.stop()
+        _current.reset(token)
+    pid = await asyncio.to_thread(prof.save, response.status_code)
+    response.headers["X-Profile-Id"] = pid
+    response.headers["X-Profile-Url"] = f"/debug/profiles/{pid}"
+    return response
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# кольцевой буфер на диске
+# ──────────────────────────────────────────────────────────────────────────────
+def _prune() -> None:
+    metas = sorted(PROFILE_DIR.glob("*.meta.json"))
+    for old in metas[:max(0, len(metas) - PROFILE_KEEP)]:
+        pid = old.name[:-len(".meta.json")]
+        for f in PROFILE_DIR.glob(f"{pid}.*"):
+            try:
+                f.unlink()
+            except OSError:
+                pass
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    if not PROFILE_DIR.is_dir():
+        return out
+    for f in sorted(PROFILE_DIR.glob("*.meta.json"), reverse=True):
+        try:
+            out.append(json.loads(f.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            continue
+    return out
+
+
+def profile_file(pid: str, kind: str) -> Optional[Path]:
+    """kind: report | trace | meta. pid проверяется — наружу только файлы из PROFILE_DIR."""
+    if not pid or "/" in pid or "\\" in pid or ".." in pid:
+        return None
+    if kind == "trace":
+        names = [f"{pid}.trace.json"]
+    elif kind == "meta":
+        names = [f"{pid}.meta.json"]
+    else:
+        names = [f"{pid}.html", f"{pid}.txt"]
+    for n in names:
+        p = PROFILE_DIR / n
+        if p.is_file():
+            return p
+    return None
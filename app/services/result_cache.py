@@ -0,0 +1,135 @@
+# app/services/result_cache.py
+"""
+Stale-while-revalidate для ответов дашборда (/orders/analytics, /orders/ids).
+
+Даже с кэшем первый запрос после истечения CACHE_TTL платил полным сканированием Kaspi.
+Теперь ответ хранится в общем состоянии (Namespace "orders_cache") дольше — CACHE_TTL +
+CACHE_STALE_MAX сек — с моментом расчёта:
+
+  возраст ≤ CACHE_TTL                 — ответ из кэша как есть ("fresh");
+  возраст ≤ CACHE_TTL+CACHE_STALE_MAX — ответ из кэша сразу ("stale") и фоновый пересчёт;
+  старше или нет в кэше               — расчёт в запросе ("miss").
+
+Фоновый пересчёт один на ключ: в процессе — single-flight, между воркерами — Namespace.add
+в "orders_cache_refresh". Его ошибка не трогает кэш: до конца CACHE_STALE_MAX отдаётся
+прежний ответ. fresh=1 в запросе (строгая свежесть) — всегда расчёт в запросе ("bypass"),
+результат обновляет кэш. Недочитанные (complete=false) и обрезанные дедлайном ответы не
+кэшируются.
+
+Расчёт с дедлайном (deadline=…) отдаёт то, что успел, а дочитывание сразу уходит в фон
+тем же путём, что и пересчёт устаревшего: без дедлайна, с resume_token частичного ответа
+(готовые окна берутся из чекпойнта, начатые — подхватываются single-flight окна). Следующий
+запрос получает полный ответ из кэша.
+
+Возраст ответа — заголовок X-Data-Age (сек), источник — X-Cache.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from app.services import metrics, profiling, single_flight
+from app.services.state import Namespace
+
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300") or 300)
+CACHE_STALE_MAX = int(os.getenv("CACHE_STALE_MAX", "3600") or 3600)
+CACHE_REFRESH_TIMEOUT = float(os.getenv("CACHE_REFRESH_TIMEOUT", "600") or 600)
+
+RESULT_CACHE = metrics.counter("result_cache_total", "Dashboard responses by cache outcome", ("endpoint", "result"))
+RESULT_REFRESH = metrics.counter("result_cache_refresh_total", "Background revalidations", ("endpoint", "status"))
+
+_cache = Namespace("orders_cache", ttl=CACHE_TTL + CACHE_STALE_MAX)
+_refresh_locks = Namespace("orders_cache_refresh", ttl=CACHE_REFRESH_TIMEOUT)
+_flight = single_flight.Group("result_cache")
+_background: Set[asyncio.Task] = set()   # держим ссылки, чтобы задачи не собрал GC
+
+# compute(deadline=…, resume_token=…): deadline — момент по time.monotonic() или None
+Compute = Callable[..., Awaitable[Dict[str, Any]]]
+Thunk = Callable[[], Awaitable[Dict[str, Any]]]
+
+
+@dataclass
+class Served:
+    data: Dict[str, Any]
+    age: float
+    result: str          # fresh | stale | miss | bypass
+
+    def headers(self) -> Dict[str, str]:
+        return {"X-Data-Age": str(int(self.age)), "X-Cache": self.result}
+
+
+def _cacheable(data: Dict[str, Any]) -> bool:
+    return bool(data.get("complete", True)) and not data.get("deadline_exceeded")
+
+
+async def _get(key: str) -> Optional[Dict[str, Any]]:
+    try:
+        return await _cache.aget(key)
+    except Exception:
+        return None
+
+
+async def _compute_and_store(key: str, compute: Thunk) -> Dict[str, Any]:
+    data = await compute()
+    if _cacheable(data):
+        try:
+            await _cache.aset(key, {"at": time.time(), "data": data})
+        except Exception:
+            # кэш — ускорение, а не источник данных
+            pass
+    return data
+
+
+async def _refresh(endpoint: str, key: str, compute: Thunk) -> None:
+    profiling.detach()
+    try:
+        await asyncio.wait_for(_flight.run(key, lambda: _compute_and_store(key, compute)), CACHE_REFRESH_TIMEOUT)
+        RESULT_REFRESH.inc(endpoint=endpoint, status="ok")
+    except Exception:
+        RESULT_REFRESH.inc(endpoint=endpoint, status="error")
+    finally:
+        try:
+            await _refresh_locks.adelete(key)
+        except Exception:
+            pass
+
+
+async def _revalidate(endpoint: str, key: str, compute: Thunk) -> None:
+    try:
+        if not await _refresh_locks.aadd(key, {"at": time.time()}):
+            return   # уже пересчитывается (этот или другой воркер)
+    except Exception:
+        return
+    # задача получает копию контекста запроса: токен тенанта остаётся тем же
+    task = asyncio.get_running_loop().create_task(_refresh(endpoint, key, compute))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def serve(endpoint: str, key: str, compute: Compute, *, fresh: bool = False,
+                deadline: Optional[float] = None) -> Served:
+    """Ответ по ключу (тенант + нормализованные параметры) с учётом CACHE_TTL / CACHE_STALE_MAX."""
+    if not fresh:
+        hit = await _get(key)
+        if hit is not None:
+            age = max(0.0, time.time() - float(hit.get("at") or 0))
+            if age <= CACHE_TTL:
+                RESULT_CACHE.inc(endpoint=endpoint, result="fresh")
+                return Served(hit["data"], age, "fresh")
+            if age <= CACHE_TTL + CACHE_STALE_MAX:
+                RESULT_CACHE.inc(endpoint=endpoint, result="stale")
+                await _revalidate(endpoint, key, partial(compute, deadline=None, resume_token=None))
+                return Served(hit["data"], age, "stale")
+    result = "bypass" if fresh else "miss"
+    RESULT_CACHE.inc(endpoint=endpoint, result=result)
+    # с дедлайном присоединяемся только к расчёту с тем же сроком: расчёт без него (фоновое
+    # дочитывание) может идти дольше, а чужой срок обрезал бы ответ раньше или позже нашего
+    flight_key = key if deadline is None else f"{key}:deadline:{deadline!r}"
+    data = await _flight.run(flight_key, lambda: _compute_and_store(key, partial(compute, deadline=deadline)))
+    if data.get("deadline_exceeded"):
+        await _revalidate(endpoint, key, partial(compute, deadline=None, resume_token=data.get("resume_token")))
+    return Served(data, 0.0, result)
@@ -0,0 +1,243 @@
+# app/services/rollup.py
+"""
+Дневные роллапы заказов для /orders/analytics.
+
+Дашборду нужны только счётчики и суммы по дням, городам и статусам, поэтому вместо
+пересчёта сырых заказов на каждый запрос (и на предыдущий период) они лежат в таблице
+daily_order_rollup с ключом (tenant, assign_mode, variant, day, state, city):
+
+  tenant  — kaspi_transport.tenant_key(токен): данные принадлежат магазину Kaspi;
+  variant — настройки, от которых зависит, в какой день попал заказ
+            (tz, поле даты, cut-off приёма, начало бизнес-дня).
+
+Какие дни уже посчитаны — daily_order_rollup_days (день без заказов строк не имеет).
+Последние ROLLUP_HOT_DAYS дней «горячие»: заказы в них ещё меняют статус и дату отгрузки,
+поэтому такой день пересобирается, если собран раньше ROLLUP_HOT_TTL сек назад. День,
+собранный уже после выхода из горячего окна, помечается frozen и больше не пересчитывается.
+Так год на дашборде стоит O(дней), а не O(заказов).
+
+Хранилище — как у app_state: PG (DATABASE_URL) или SQLite (DB_PATH).
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import time
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.services import metrics
+
+try:
+    import psycopg
+    STORAGE_ERRORS: tuple = (sqlite3.Error, psycopg.Error)
+except ImportError:  # pragma: no cover
+    STORAGE_ERRORS = (sqlite3.Error,)
+
+ROLLUP_ENABLED = os.getenv("ROLLUP_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+ROLLUP_HOT_DAYS = int(os.getenv("ROLLUP_HOT_DAYS", "14") or 14)
+ROLLUP_HOT_TTL = float(os.getenv("ROLLUP_HOT_TTL", os.getenv("CACHE_TTL", "300")) or 300)
+
+_SQLITE_BUSY_MS = 5000
+
+Row = Tuple[str, str, str, int, float]  # day, state, city, orders, amount
+
+ROLLUP_DAYS = metrics.counter(
+    "rollup_days_total", "Analytics days served from rollups vs rebuilt from Kaspi", ("result",))
+
+
+def variant(assign_mode: str, *, tz: str, date_field: str,
+            store_accept_until: str, business_day_start: str) -> str:
+    """Только те настройки, что влияют на день заказа в данном assign_mode."""
+    if assign_mode == "smart":
+        return f"{tz}|{store_accept_until}|{business_day_start}"
+    if assign_mode == "business":
+        return f"{tz}|{date_field}|{business_day_start}"
+    return tz
+
+
+def day_range(start_day: str, end_day: str) -> List[str]:
+    cur, end = date.fromisoformat(start_day), date.fromisoformat(end_day)
+    out: List[str] = []
+    while cur <= end:
+        out.append(cur.isoformat())
+        cur += timedelta(days=1)
+    return out
+
+
+def runs(days: Sequence[str]) -> List[Tuple[str, str]]:
+    """Отсортированные дни → непрерывные отрезки [(первый, последний), …]."""
+    out: List[Tuple[str, str]] = []
+    for d in sorted(days):
+        if out and date.fromisoformat(out[-1][1]) + timedelta(days=1) == date.fromisoformat(d):
+            out[-1] = (out[-1][0], d)
+        else:
+            out.append((d, d))
+    return out
+
+
+def group_rows(rows: Iterable[Dict[str, object]]) -> List[Row]:
+    """Строки aggregate_orders (op_day/state/city/amount) → строки роллапа."""
+    acc: Dict[Tuple[str, str, str], List[float]] = {}
+    for r in rows:
+        k = (str(r["op_day"]), str(r["state"]), str(r.get("city") or ""))
+        cell = acc.setdefault(k, [0, 0.0])
+        cell[0] += 1
+        cell[1] += float(r.get("amount") or 0.0)
+    return [(d, s, c, int(v[0]), v[1]) for (d, s, c), v in acc.items()]
+
+
+def stale_days(days: Sequence[str], built: Dict[str, Tuple[float, bool]], now: Optional[float] = None) -> List[str]:
+    now = time.time() if now is None else now
+    out: List[str] = []
+    for d in days:
+        info = built.get(d)
+        if info is None:
+            out.append(d)
+            continue
+        built_at, frozen = info
+        if not frozen and now - built_at > ROLLUP_HOT_TTL:
+            out.append(d)
+    return out
+
+
+def frozen_before(today: date) -> str:
+    return (today - timedelta(days=ROLLUP_HOT_DAYS)).isoformat()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# хранилище
+# ──────────────────────────────────────────────────────────────────────────────
+class _Pg:
+    def _conn(self):
+        from app.db import get_conn
+        return get_conn("rollup")
+
+    def built(self, tenant, mode, var, start_day, end_day):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                "SELECT day, frozen, extract(epoch FROM built_at) AS built_at FROM daily_order_rollup_days "
+                "WHERE tenant=%s AND assign_mode=%s AND variant=%s AND day BETWEEN %s::date AND %s::date",
+                (tenant, mode, var, start_day, end_day),
+            )
+            return {r["day"].isoformat(): (float(r["built_at"]), bool(r["frozen"])) for r in cur.fetchall()}
+
+    def read(self, tenant, mode, var, start_day, end_day):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                "SELECT day, state, city, orders, amount FROM daily_order_rollup "
+                "WHERE tenant=%s AND assign_mode=%s AND variant=%s AND day BETWEEN %s::date AND %s::date",
+                (tenant, mode, var, start_day, end_day),
+            )
+            return [(r["day"].isoformat(), r["state"], r["city"], int(r["orders"]), float(r["amount"]))
+                    for r in cur.fetchall()]
+
+    def replace(self, tenant, mode, var, days, rows, frozen_before_day):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                "DELETE FROM daily_order_rollup WHERE tenant=%s AND assign_mode=%s AND variant=%s "
+                "AND day = ANY(%s::date[])",
+                (tenant, mode, var, list(days)),
+            )
+            if rows:
+                cur.executemany(
+                    "INSERT INTO daily_order_rollup(tenant, assign_mode, variant, day, state, city, orders, amount) "
+                    "VALUES (%s, %s, %s, %s::date, %s, %s, %s, %s)",
+                    [(tenant, mode, var, d, s, c, n, a) for d, s, c, n, a in rows],
+                )
+            cur.executemany(
+                "INSERT INTO daily_order_rollup_days(tenant, assign_mode, variant, day, frozen, built_at) "
+                "VALUES (%s, %s, %s, %s::date, %s, now()) "
+                "ON CONFLICT (tenant, assign_mode, variant, day) DO UPDATE "
+                "SET frozen = excluded.frozen, built_at = excluded.built_at",
+                [(tenant, mode, var, d, d < frozen_before_day) for d in days],
+            )
+            con.commit()
+
+
+class _Sqlite:
+    def _conn(self) -> sqlite3.Connection:
+        from app.api.products import DB_PATH
+        con = sqlite3.connect(DB_PATH, timeout=_SQLITE_BUSY_MS / 1000.0, isolation_level=None,
+                              factory=metrics.sqlite_factory("rollup"))
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA busy_timeout={_SQLITE_BUSY_MS}")
+        return con
+
+    def built(self, tenant, mode, var, start_day, end_day):
+        con = self._conn()
+        try:
+            rows = con.execute(
+                "SELECT day, frozen, built_at FROM daily_order_rollup_days "
+                "WHERE tenant=? AND assign_mode=? AND variant=? AND day BETWEEN ? AND ?",
+                (tenant, mode, var, start_day, end_day),
+            ).fetchall()
+            return {d: (float(b), bool(f)) for d, f, b in rows}
+        finally:
+            con.close()
+
+    def read(self, tenant, mode, var, start_day, end_day):
+        con = self._conn()
+        try:
+            return [tuple(r) for r in con.execute(
+                "SELECT day, state, city, orders, amount FROM daily_order_rollup "
+                "WHERE tenant=? AND assign_mode=? AND variant=? AND day BETWEEN ? AND ?",
+                (tenant, mode, var, start_day, end_day),
+            ).fetchall()]
+        finally:
+            con.close()
+
+    def replace(self, tenant, mode, var, days, rows, frozen_before_day):
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            con.executemany(
+                "DELETE FROM daily_order_rollup WHERE tenant=? AND assign_mode=? AND variant=? AND day=?",
+                [(tenant, mode, var, d) for d in days],
+            )
+            con.executemany(
+                "INSERT INTO daily_order_rollup(tenant, assign_mode, variant, day, state, city, orders, amount) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(tenant, mode, var, d, s, c, n, a) for d, s, c, n, a in rows],
+            )
+            now = time.time()
+            con.executemany(
+                "INSERT INTO daily_order_rollup_days(tenant, assign_mode, variant, day, frozen, built_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(tenant, assign_mode, variant, day) DO UPDATE "
+                "SET frozen=excluded.frozen, built_at=excluded.built_at",
+                [(tenant, mode, var, d, int(d < frozen_before_day), now) for d in days],
+            )
+            con.execute("COMMIT")
+        except Exception:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+
+_store = None
+
+
+def _db():
+    global _store
+    if _store is None:
+        from app.api.products import _USE_PG
+        _store = _Pg() if _USE_PG else _Sqlite()
+    return _store
+
+
+def built(tenant: str, mode: str, var: str, start_day: str, end_day: str) -> Dict[str, Tuple[float, bool]]:
+    """{day: (built_at, frozen)} для уже посчитанных дней отрезка."""
+    return _db().built(tenant, mode, var, start_day, end_day)
+
+
+def read(tenant: str, mode: str, var: str, start_day: str, end_day: str) -> List[Row]:
+    return _db().read(tenant, mode, var, start_day, end_day)
+
+
+def replace(tenant: str, mode: str, var: str, days: Sequence[str], rows: Sequence[Row], today: date) -> None:
+    """Атомарно заменяет роллапы дней days; дни старше горячего окна помечаются frozen."""
+    days_set = set(days)
+    _db().replace(tenant, mode, var, list(days), [r for r in rows if r[0] in days_set], frozen_before(today))
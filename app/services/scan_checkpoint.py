@@ -0,0 +1,197 @@
+# app/services/scan_checkpoint.py
+"""
+Возобновляемые сканирования длинных периодов.
+
+Раньше ошибка любого окна в _scan_range (HTTPStatusError, RequestError, открытый
+circuit breaker) роняла весь запрос с 502, и уже прочитанные окна пропадали: повторный
+экспорт за полгода начинался с нуля. Теперь окна сканируются до конца, а при сбое готовые
+окна сохраняются в общем состоянии (Namespace "scan_resume", SCAN_RESUME_TTL сек) под
+токеном возобновления:
+
+  {token}:{sig}     — план окон и номера готовых;
+  {token}:{sig}:{i} — колоночный батч, счётчики по суткам и stats окна i.
+
+sig — тенант, поле сканирования, границы и фильтры статусов: один токен покрывает все
+сканирования запроса (текущий и предыдущий период, отрезки роллапов). Запрос с тем же
+токеном (resume=…) и теми же параметрами читает из Kaspi только недостающие окна.
+
+Параметры запроса (токен, partial) кладёт в контекст эндпойнт через begin(); потоки
+сканирования видят ту же сессию — copy_context копирует ссылку на неё. Без partial
+незавершённое сканирование поднимает ScanIncomplete (502/503 с resume_token и списком
+недостающих окон), с partial — возвращает то, что прочитано, а окна копятся в
+session.missing.
+
+Дедлайн запроса (deadline=… сек или REQUEST_DEADLINE) тоже живёт в сессии: окна, не
+дочитанные к сроку, считаются недостающими (как при partial), ответ помечается
+deadline_exceeded и days_covered — дни периода, которых не касается ни одно недочитанное окно.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pytz
+
+from app.services import kaspi_transport, metrics
+from app.services.state import Namespace
+
+SCAN_RESUME_TTL = float(os.getenv("SCAN_RESUME_TTL", "21600") or 21600)
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "0") or 0)   # сек; 0 — без дедлайна
+
+Window = Tuple[int, int]
+
+SCAN_WINDOWS_FAILED = metrics.counter("scan_windows_failed_total", "Scan windows that failed and were left for resume")
+SCAN_WINDOWS_RESUMED = metrics.counter("scan_windows_resumed_total", "Scan windows restored from a resume checkpoint")
+
+_store = Namespace("scan_resume", ttl=SCAN_RESUME_TTL)
+
+
+@dataclass
+class Session:
+    token: Optional[str] = None
+    partial: bool = False
+    missing: List[Window] = field(default_factory=list)
+    error: Optional[str] = None
+    plans: List[Dict[str, Any]] = field(default_factory=list)   # планы scan_fields — для debug ответа
+    deadline: Optional[float] = None        # time.monotonic(), к которому нужен ответ
+    deadline_hit: bool = False
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing
+
+    def remaining(self) -> Optional[float]:
+        """Секунд до дедлайна (не меньше 0); None — дедлайна нет."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def summary(self) -> Dict[str, Any]:
+        """Поля ответа: complete / missing_windows / resume_token / deadline_exceeded."""
+        return {
+            "complete": self.complete,
+            "missing_windows": windows_iso(self.missing),
+            "resume_token": None if self.complete else self.token,
+            "deadline_exceeded": self.deadline_hit,
+        }
+
+
+_session: ContextVar[Optional[Session]] = ContextVar("scan_session", default=None)
+
+
+def begin(token: Optional[str] = None, partial: bool = False, deadline: Optional[float] = None) -> Session:
+    """Новая сессия сканирования для текущего запроса (задачи); deadline — по time.monotonic()."""
+    sess = Session(token=(token or "").strip() or None, partial=partial, deadline=deadline)
+    _session.set(sess)
+    return sess
+
+
+def deadline_at(seconds: Optional[float]) -> Optional[float]:
+    """Параметр deadline запроса (сек) → момент по time.monotonic(); без параметра — REQUEST_DEADLINE."""
+    if seconds is None:
+        seconds = REQUEST_DEADLINE
+    return time.monotonic() + seconds if seconds and seconds > 0 else None
+
+
+def current() -> Optional[Session]:
+    return _session.get()
+
+
+class ScanIncomplete(Exception):
+    """Часть окон не прочиталась; готовые сохранены под resume_token."""
+
+    def __init__(self, token: str, missing: List[Window], error: Optional[str],
+                 retry_after: Optional[float] = None) -> None:
+        super().__init__(f"Scan incomplete: {len(missing)} window(s) failed" + (f" ({error})" if error else ""))
+        self.token = token
+        self.missing = missing
+        self.error = error
+        self.retry_after = retry_after
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"detail": str(self), "resume_token": self.token, "missing_windows": windows_iso(self.missing)}
+
+
+def _iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def windows_iso(windows: Iterable[Window]) -> List[Dict[str, str]]:
+    return [{"start": _iso(s), "end": _iso(e)} for s, e in windows]
+
+
+def days_covered(missing: Iterable[Window], start_day: str, end_day: str, tz: str) -> List[str]:
+    """Дни start_day..end_day (в tz), которых не касается ни одно недочитанное окно."""
+    tzinfo = pytz.timezone(tz)
+    touched = set()
+    for s, e in missing:
+        d0 = datetime.fromtimestamp(s / 1000, tz=tzinfo).date()
+        d1 = datetime.fromtimestamp(e / 1000, tz=tzinfo).date()
+        while d0 <= d1:
+            touched.add(d0.isoformat())
+            d0 += timedelta(days=1)
+    out: List[str] = []
+    d, last = date.fromisoformat(start_day), date.fromisoformat(end_day)
+    while d <= last:
+        if d.isoformat() not in touched:
+            out.append(d.isoformat())
+        d += timedelta(days=1)
+    return out
+
+
+def signature(kaspi_token: Optional[str], scan_field: str, start_ms: int, end_ms: int,
+              date_field: str, states_inc: Iterable[str], states_ex: Iterable[str]) -> str:
+    raw = "|".join((kaspi_transport.tenant_key(kaspi_token), scan_field, str(start_ms), str(end_ms), date_field,
+                    ",".join(sorted(states_inc)), ",".join(sorted(states_ex))))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def load(token: Optional[str], sig: str) -> Tuple[Optional[List[Window]], Dict[int, tuple]]:
+    """(план окон, {номер окна: результат}) прошлой попытки; (None, {}) — возобновлять нечего."""
+    if not token:
+        return None, {}
+    cp = _store.get(f"{token}:{sig}")
+    if not cp:
+        return None, {}
+    done: Dict[int, tuple] = {}
+    for i in cp.get("done") or []:
+        part = _store.get(f"{token}:{sig}:{i}")
+        if part:
+            done[int(i)] = (part["batch"], part["days"], part["stats"])
+    SCAN_WINDOWS_RESUMED.inc(len(done))
+    return [(int(s), int(e)) for s, e in cp["windows"]], done
+
+
+def save(token: str, sig: str, windows: List[Window], results: List[Optional[tuple]],
+         stored: Iterable[int] = ()) -> None:
+    """Сохраняет готовые окна (кроме уже лежащих в stored) и план."""
+    stored = set(stored)
+    done: List[int] = []
+    for i, res in enumerate(results):
+        if res is None:
+            continue
+        done.append(i)
+        if i in stored:
+            continue
+        batch, days, stats = res
+        _store.set(f"{token}:{sig}:{i}", {"batch": batch, "days": days, "stats": stats})
+    _store.set(f"{token}:{sig}", {"windows": [list(w) for w in windows], "done": done})
+
+
+def discard(token: Optional[str], sig: str, stored: Iterable[int]) -> None:
+    """Сканирование дочитано — чекпойнт больше не нужен."""
+    if not token:
+        return
+    for i in stored:
+        _store.delete(f"{token}:{sig}:{i}")
+    _store.delete(f"{token}:{sig}")
+
+
+def new_token() -> str:
+    return uuid.uuid4().hex
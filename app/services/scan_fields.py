@@ -0,0 +1,249 @@
+# app/services/scan_fields.py
+"""
+Выбор полей и границ сканирования /orders под assign_mode.
+
+Раньше период всегда читался по SCAN_FIELD (creationDate) с запасом ±SCAN_MARGIN_DAYS.
+В raw запас не нужен вовсе, а в smart/business день заказа считается по плановой или
+фактической дате отгрузки: если заказ отгружен через неделю после создания, двух дней
+запаса мало, а для свежих заказов — много. Здесь для каждого режима строятся кандидаты —
+наборы фильтрованных сканов (поле из ALLOWED_DATE_FIELDS + [start; end] в мс) — и
+выбирается самый дешёвый по оценке заказов (плотность из app/services/scan_plan.py):
+
+  raw      — creationDate ровно по [start; end]: день = дата приёма;
+  business — поле date_field по интервалу бизнес-дней; заказы без этого поля берут дату
+             приёма, поэтому к нему добавляется creationDate по тому же интервалу ("union");
+  smart    — shipmentDate по интервалу бизнес-дней (доставленные), plannedShipmentDate
+             (календарный день и бизнес-день), creationDate с учётом cut-off ("union").
+
+union покрывает дни строго по правилам aggregation.operational_day, но читает заказы
+несколько раз. Кандидат "lag" — один скан creationDate, расширенный на наблюдённый лаг
+(поле − creationDate; min/max по суткам создания, SCAN_LAG_DAYS последних суток в
+Namespace "scan_lags") плюс SCAN_LAG_PAD_HOURS. Он дешевле на длинных периодах и
+доступен, только если лаг наблюдался хотя бы за SCAN_LAG_MIN_DAYS суток. Без статистики
+и для полей вне ALLOWED_DATE_FIELDS — прежний запас ±SCAN_MARGIN_DAYS ("margin").
+
+Выбранный план (стратегия, сканы, оценки кандидатов) отдаётся в debug ответа.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pytz
+
+from app.services import kaspi_transport, scan_plan
+from app.services.aggregation import bd_delta
+from app.services.state import Namespace
+
+SCAN_PLANNER = os.getenv("SCAN_PLANNER", "true").lower() in ("1", "true", "yes", "on")
+SCAN_LAG_DAYS = int(os.getenv("SCAN_LAG_DAYS", "90") or 90)
+SCAN_LAG_MIN_DAYS = int(os.getenv("SCAN_LAG_MIN_DAYS", "7") or 7)
+SCAN_LAG_PAD_HOURS = float(os.getenv("SCAN_LAG_PAD_HOURS", "12") or 12)
+
+# должен совпадать с kaspi_client_tenant.ALLOWED_DATE_FIELDS
+ALLOWED_DATE_FIELDS = ("creationDate", "plannedShipmentDate", "plannedDeliveryDate", "shipmentDate", "deliveryDate")
+BASE_FIELD = "creationDate"
+HOUR_MS = 3_600_000
+DAY_MS = scan_plan.DAY_MS
+
+_lags = Namespace("scan_lags", ttl=scan_plan.SCAN_DENSITY_TTL_DAYS * 86400)
+_lock = threading.Lock()
+
+
+@dataclass
+class Scan:
+    field: str
+    start_ms: int
+    end_ms: int    # включительно
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"field": self.field, "start": _iso(self.start_ms), "end": _iso(self.end_ms)}
+
+
+@dataclass
+class Plan:
+    assign_mode: str
+    strategy: str                     # exact | union | lag | margin
+    scans: List[Scan]
+    est_orders: float
+    candidates: Dict[str, float] = field(default_factory=dict)
+    lag_ms: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "assign_mode": self.assign_mode,
+            "strategy": self.strategy,
+            "scans": [s.as_dict() for s in self.scans],
+            "est_orders": round(self.est_orders, 1),
+            "candidates": {k: round(v, 1) for k, v in self.candidates.items()},
+            "lag_hours": {f: [round(lo / HOUR_MS, 1), round(hi / HOUR_MS, 1)] for f, (lo, hi) in self.lag_ms.items()},
+        }
+
+
+def _iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# лаги полей относительно creationDate
+# ──────────────────────────────────────────────────────────────────────────────
+def _key(token: Optional[str]) -> str:
+    return kaspi_transport.tenant_key(token)
+
+
+def load_lags(token: Optional[str]) -> Dict[str, Tuple[int, int]]:
+    """{поле: (min_ms, max_ms)} по сохранённым суткам; поле без SCAN_LAG_MIN_DAYS суток — не в ответе."""
+    try:
+        raw = _lags.get(_key(token)) or {}
+    except Exception:
+        raw = {}
+    out: Dict[str, Tuple[int, int]] = {}
+    for f, days in raw.items():
+        if len(days) < SCAN_LAG_MIN_DAYS:
+            continue
+        out[f] = (min(v[0] for v in days.values()), max(v[1] for v in days.values()))
+    return out
+
+
+def lags_from_batch(batch: Dict[str, list], date_field: str) -> Dict[str, Dict[str, List[int]]]:
+    """Колоночный батч → {поле: {UTC-сутки создания: [min, max] лага}}."""
+    cols = {"plannedShipmentDate": batch["ms_planned"], "shipmentDate": batch["ms_ship"]}
+    if date_field not in cols and date_field != BASE_FIELD:
+        cols[date_field] = batch["ms_pivot"]
+    out: Dict[str, Dict[str, List[int]]] = {}
+    for f, values in cols.items():
+        per_day = out.setdefault(f, {})
+        for created, ms in zip(batch["ms_creation"], values):
+            if ms is None or created is None:
+                continue
+            lag = int(ms) - int(created)
+            cell = per_day.get(scan_plan.day_of(created))
+            if cell is None:
+                per_day[scan_plan.day_of(created)] = [lag, lag]
+            else:
+                cell[0] = min(cell[0], lag)
+                cell[1] = max(cell[1], lag)
+    return {f: d for f, d in out.items() if d}
+
+
+def observe_lags(token: Optional[str], batch: Dict[str, list], date_field: str) -> None:
+    lags = lags_from_batch(batch, date_field)
+    if not lags:
+        return
+    key = _key(token)
+    with _lock:
+        try:
+            raw = _lags.get(key) or {}
+            for f, days in lags.items():
+                cur = dict(raw.get(f) or {})
+                for d, (lo, hi) in days.items():
+                    old = cur.get(d)
+                    cur[d] = [min(lo, old[0]), max(hi, old[1])] if old else [lo, hi]
+                if len(cur) > SCAN_LAG_DAYS:
+                    cur = {d: cur[d] for d in sorted(cur)[-SCAN_LAG_DAYS:]}
+                raw[f] = cur
+            _lags.set(key, raw)
+        except Exception:
+            # статистика — только подсказка планировщику, сбой хранилища не должен ронять скан
+            pass
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# план
+# ──────────────────────────────────────────────────────────────────────────────
+def _local_ms(day: str, tzinfo: pytz.BaseTzInfo, plus: timedelta = timedelta(0)) -> int:
+    naive = datetime.combine(date.fromisoformat(day), datetime.min.time()) + plus
+    return round(tzinfo.localize(naive).timestamp() * 1000)
+
+
+def _hhmm(s: str) -> timedelta:
+    h, m = map(int, s.split(":"))
+    return timedelta(hours=h, minutes=m)
+
+
+def estimate(scans: Sequence[Scan], token: Optional[str]) -> float:
+    """Оценка заказов, которые прочитают сканы: плотность поля, иначе creationDate, иначе 1/сутки."""
+    base = scan_plan.load(token, BASE_FIELD)
+    total = 0.0
+    for s in scans:
+        dens = scan_plan.load(token, s.field) if s.field != BASE_FIELD else base
+        for day, seg_s, seg_e in scan_plan.day_segments(s.start_ms, s.end_ms):
+            per_day = dens.per_day(day)
+            if per_day is None:
+                per_day = base.per_day(day)
+            total += (1.0 if per_day is None else per_day) * (seg_e - seg_s + 1) / DAY_MS
+    return total
+
+
+def _hull(*ranges: Tuple[int, int]) -> Tuple[int, int]:
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+
+def union(scans: Sequence[Scan]) -> List[Scan]:
+    """Сканы нескольких планов → по полю объединение пересекающихся и смежных интервалов."""
+    out: List[Scan] = []
+    for sc in sorted(scans, key=lambda s: (s.field, s.start_ms)):
+        last = out[-1] if out else None
+        if last is not None and last.field == sc.field and sc.start_ms <= last.end_ms + 1:
+            last.end_ms = max(last.end_ms, sc.end_ms)
+        else:
+            out.append(Scan(sc.field, sc.start_ms, sc.end_ms))
+    return out
+
+
+def plan(assign_mode: str, *, start_ms: int, end_ms: int, start_day: str, end_day: str, tz: str,
+         date_field: str, store_accept_until: str, business_day_start: str,
+         token: Optional[str], margin_days: int, base_field: str = BASE_FIELD) -> Plan:
+    """Самый дешёвый набор сканов, покрывающий операционные дни start_day..end_day."""
+    margin = Scan(base_field, start_ms - margin_days * DAY_MS, end_ms + margin_days * DAY_MS)
+    if not SCAN_PLANNER or base_field != BASE_FIELD:
+        return Plan(assign_mode, "margin", [margin], estimate([margin], token))
+
+    if assign_mode == "raw":
+        exact = [Scan(BASE_FIELD, start_ms, end_ms)]
+        return Plan(assign_mode, "exact", exact, estimate(exact, token))
+
+    tzinfo = pytz.timezone(tz)
+    d0 = _local_ms(start_day, tzinfo)
+    d1 = _local_ms(end_day, tzinfo, timedelta(days=1))          # начало дня после end_day
+    shift = round((timedelta(hours=24) - bd_delta(business_day_start)).total_seconds() * 1000)
+    bd = (d0 - shift, d1 - shift - 1)                           # бизнес-дни: bucket_date(t) ∈ [S; E]
+    lags = load_lags(token)
+
+    candidates: Dict[str, List[Scan]] = {}
+    if assign_mode == "business":
+        if date_field == BASE_FIELD:
+            candidates["exact"] = [Scan(BASE_FIELD, *bd)]
+        else:
+            if date_field in ALLOWED_DATE_FIELDS:
+                candidates["union"] = [Scan(date_field, *bd), Scan(BASE_FIELD, *bd)]
+            if date_field in lags:
+                lo, hi = lags[date_field]
+                pad = round(SCAN_LAG_PAD_HOURS * HOUR_MS)
+                candidates["lag"] = [Scan(BASE_FIELD, bd[0] - max(0, hi) - pad, bd[1] - min(0, lo) + pad)]
+    else:  # smart
+        cutoff = round(_hhmm(store_accept_until).total_seconds() * 1000)
+        # приём до cut-off — этот день, после — следующий
+        accept = (d0 - DAY_MS + cutoff + 1, d1 - DAY_MS + cutoff)
+        candidates["union"] = [
+            Scan("shipmentDate", *bd),
+            Scan("plannedShipmentDate", *_hull(bd, (d0, d1 - 1))),
+            Scan(BASE_FIELD, *_hull(bd, accept)),
+        ]
+        if "plannedShipmentDate" in lags and "shipmentDate" in lags:
+            hi = max(0, lags["plannedShipmentDate"][1], lags["shipmentDate"][1])
+            lo = min(0, lags["plannedShipmentDate"][0], lags["shipmentDate"][0])
+            pad = round(SCAN_LAG_PAD_HOURS * HOUR_MS)
+            s, e = _hull(bd, (d0, d1 - 1), accept)
+            candidates["lag"] = [Scan(BASE_FIELD, s - hi - pad, e - lo + pad)]
+
+    if not candidates:
+        return Plan(assign_mode, "margin", [margin], estimate([margin], token))
+    costs = {name: estimate(scans, token) for name, scans in candidates.items()}
+    best = min(costs, key=lambda n: (costs[n], len(candidates[n])))
+    relevant = ("plannedShipmentDate", "shipmentDate") if assign_mode == "smart" else (date_field,)
+    return Plan(assign_mode, best, candidates[best], costs[best], candidates=costs,
+                lag_ms={f: lags[f] for f in relevant if f in lags})
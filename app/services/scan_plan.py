@@ -0,0 +1,208 @@
+# app/services/scan_plan.py
+"""
+Разбиение окна сканирования /orders на куски под плотность заказов тенанта.
+
+Фиксированный CHUNK_DAYS плох в обе стороны: у крупного магазина неделя — это десятки
+страниц подряд в одном потоке, у маленького — лишние пустые запросы. Поэтому по каждому
+тенанту (ключ — kaspi_transport.tenant_key) и полю сканирования запоминается, сколько
+заказов было в каждые UTC-сутки (точный счёт из прошлых сканов; для ещё не виденных дней —
+оценка по meta.pageCount первой страницы куска), и окно режется так, чтобы на кусок
+приходилось около SCAN_TARGET_PAGES страниц:
+
+  плотные сутки делятся на под-окна (до 24 — не мельче часа), которые читаются параллельно;
+  редкие дни склеиваются в один кусок, но не длиннее SCAN_CHUNK_MAX_DAYS;
+  тенант без истории — по-старому, куски по CHUNK_DAYS.
+
+Плотность хранится в общем состоянии (Namespace "scan_density"), поэтому её видят все
+воркеры; SCAN_DENSITY_DAYS последних суток, ключ живёт SCAN_DENSITY_TTL_DAYS.
+"""
+from __future__ import annotations
+
+import math
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from app.services import kaspi_transport
+from app.services.state import Namespace
+
+SCAN_TARGET_PAGES = max(1, int(os.getenv("SCAN_TARGET_PAGES", "4") or 4))
+SCAN_CHUNK_MAX_DAYS = max(1, int(os.getenv("SCAN_CHUNK_MAX_DAYS", "31") or 31))
+SCAN_PARALLEL_CHUNKS = max(1, int(os.getenv("SCAN_PARALLEL_CHUNKS", "4") or 4))
+SCAN_DENSITY_DAYS = int(os.getenv("SCAN_DENSITY_DAYS", "400") or 400)
+SCAN_DENSITY_TTL_DAYS = float(os.getenv("SCAN_DENSITY_TTL_DAYS", "90") or 90)
+
+PAGE_SIZE = 100          # Kaspi отдаёт не больше 100 заказов на страницу, как бы ни просили
+DAY_MS = 86_400_000
+MAX_DAY_SPLIT = 24       # плотные сутки режем не мельче часа
+RECENT_DAYS = 28         # по скольким последним известным суткам оценивать неизвестные
+
+_density = Namespace("scan_density", ttl=SCAN_DENSITY_TTL_DAYS * 86400)
+_lock = threading.Lock()
+
+Window = Tuple[int, int]  # [start_ms; end_ms] включительно
+
+
+def _key(token: Optional[str], field: str) -> str:
+    return f"{kaspi_transport.tenant_key(token)}:{field}"
+
+
+def day_of(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).date().isoformat()
+
+
+def target_orders() -> int:
+    return SCAN_TARGET_PAGES * PAGE_SIZE
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# модель плотности
+# ──────────────────────────────────────────────────────────────────────────────
+class Density:
+    """Заказов за UTC-сутки: days — точный счёт, estimates — оценки по pageCount."""
+
+    def __init__(self, days: Optional[Dict[str, int]] = None, estimates: Optional[Dict[str, float]] = None) -> None:
+        self.days = dict(days or {})
+        self.estimates = dict(estimates or {})
+        recent = [self.days[d] for d in sorted(self.days)[-RECENT_DAYS:]]
+        self.typical: Optional[float] = (sum(recent) / len(recent)) if recent else None
+
+    @property
+    def known(self) -> bool:
+        return bool(self.days or self.estimates)
+
+    def per_day(self, day: str) -> Optional[float]:
+        if day in self.days:
+            return float(self.days[day])
+        if day in self.estimates:
+            return self.estimates[day]
+        return self.typical
+
+
+def load(token: Optional[str], field: str) -> Density:
+    try:
+        raw = _density.get(_key(token, field)) or {}
+    except Exception:
+        raw = {}
+    return Density(raw.get("days"), raw.get("estimates"))
+
+
+def observe(token: Optional[str], field: str, *,
+            day_counts: Optional[Dict[str, int]] = None,
+            estimates: Optional[Dict[str, float]] = None) -> None:
+    """Дописывает наблюдения: точный счёт по суткам и/или оценки по pageCount."""
+    if not day_counts and not estimates:
+        return
+    key = _key(token, field)
+    with _lock:
+        try:
+            raw = _density.get(key) or {}
+            days: Dict[str, int] = dict(raw.get("days") or {})
+            est: Dict[str, float] = dict(raw.get("estimates") or {})
+            days.update(day_counts or {})
+            for d, v in (estimates or {}).items():
+                if d not in days:
+                    est[d] = round(v, 1)
+            for d in list(est):
+                if d in days:
+                    del est[d]
+            if len(days) > SCAN_DENSITY_DAYS:
+                days = {d: days[d] for d in sorted(days)[-SCAN_DENSITY_DAYS:]}
+            if len(est) > SCAN_DENSITY_DAYS:
+                est = {d: est[d] for d in sorted(est)[-SCAN_DENSITY_DAYS:]}
+            _density.set(key, {"days": days, "estimates": est})
+        except Exception:
+            # плотность — только подсказка планировщику, сбой хранилища не должен ронять скан
+            pass
+
+
+def estimates_from_page_count(window: Window, page_count: int) -> Dict[str, float]:
+    """meta.pageCount куска → оценка заказов/сутки для каждых суток окна (равномерно)."""
+    s, e = window
+    orders = max(0, page_count) * PAGE_SIZE
+    span = max(1, e - s + 1)
+    out: Dict[str, float] = {}
+    for day, seg_s, seg_e in day_segments(s, e):
+        out[day] = orders * DAY_MS / span
+    return out
+
+
+def full_days(counts: Dict[str, int], start_ms: int, end_ms: int) -> Dict[str, int]:
+    """Оставляет только сутки, целиком лежащие в [start_ms; end_ms] — для них счёт точный."""
+    out: Dict[str, int] = {}
+    for day, seg_s, seg_e in day_segments(start_ms, end_ms):
+        if seg_e - seg_s + 1 == DAY_MS:
+            out[day] = counts.get(day, 0)
+    return out
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# план
+# ──────────────────────────────────────────────────────────────────────────────
+def day_segments(start_ms: int, end_ms: int):
+    cur = start_ms
+    while cur <= end_ms:
+        day_start = cur - cur % DAY_MS
+        seg_e = min(day_start + DAY_MS - 1, end_ms)
+        yield day_of(cur), cur, seg_e
+        cur = seg_e + 1
+
+
+def fixed_windows(start_ms: int, end_ms: int, step_days: int) -> List[Window]:
+    out: List[Window] = []
+    cur = start_ms
+    step = max(1, step_days) * DAY_MS
+    while cur <= end_ms:
+        nxt = min(cur + step - 1, end_ms)
+        out.append((cur, nxt))
+        cur = nxt + 1
+    return out
+
+
+def plan(start_ms: int, end_ms: int, density: Density, default_days: int) -> List[Window]:
+    """Окна сканирования по порядку времени, каждое ≈ target_orders() заказов."""
+    if not density.known:
+        return fixed_windows(start_ms, end_ms, default_days)
+
+    target = target_orders()
+    max_span = SCAN_CHUNK_MAX_DAYS * DAY_MS
+    fallback = target / max(1, default_days)  # нет оценки — как при CHUNK_DAYS
+    out: List[Window] = []
+    cur_s: Optional[int] = None
+    cur_e = 0
+    acc = 0.0
+
+    for day, seg_s, seg_e in day_segments(start_ms, end_ms):
+        per_day = density.per_day(day)
+        est = (fallback if per_day is None else per_day) * (seg_e - seg_s + 1) / DAY_MS
+
+        if est > target:
+            if cur_s is not None:
+                out.append((cur_s, cur_e))
+                cur_s, acc = None, 0.0
+            parts = min(MAX_DAY_SPLIT, math.ceil(est / target))
+            step = (seg_e - seg_s + 1) // parts
+            s = seg_s
+            for i in range(parts):
+                e = seg_e if i == parts - 1 else s + step - 1
+                out.append((s, e))
+                s = e + 1
+            continue
+
+        if cur_s is not None and (acc + est > target or seg_e - cur_s + 1 > max_span):
+            out.append((cur_s, cur_e))
+            cur_s, acc = None, 0.0
+        if cur_s is None:
+            cur_s = seg_s
+        cur_e = seg_e
+        acc += est
+
+    if cur_s is not None:
+        out.append((cur_s, cur_e))
+    return out
+
+
+def parallelism(token: Optional[str], windows: int) -> int:
+    """Сколько кусков читать одновременно: не больше текущего AIMD-лимита тенанта."""
+    return max(1, min(windows, SCAN_PARALLEL_CHUNKS, kaspi_transport.concurrency(token)))
@@ -0,0 +1,108 @@
+# app/services/single_flight.py
+"""
+Склейка одинаковых одновременных вычислений (single-flight).
+
+В 20:00 несколько операторов одного магазина открывают дашборд, и одинаковые запросы
+/orders/analytics и /orders/ids запускали каждый свой _collect_range. Group.run отдаёт
+всем одновременным вызовам с одним ключом результат одного вычисления: первый вызов
+(лидер) запускает его отдельной задачей, остальные ждут её же. Ошибка тоже общая.
+
+Задача лидера защищена asyncio.shield: отключившийся клиент-лидер не отменяет
+вычисление для остальных. Контекст (токен тенанта, профиль, сессия сканирования) —
+копия контекста лидера, поэтому в ключ входят тенант и всё, от чего зависит результат.
+
+Group.run_sync — то же для потоков (окна сканирования в _scan_range): ведомый поток ждёт
+Event лидера. Результаты общие — вызывающие их не меняют (копируют, если нужно).
+
+Склейка — в пределах процесса; SINGLE_FLIGHT=false выключает её.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from app.services import metrics
+
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes", "on")
+
+SINGLE_FLIGHT_CALLS = metrics.counter("single_flight_calls_total",
+                                      "Coalesced computations by group and role (leader/shared)", ("group", "role"))
+
+T = TypeVar("T")
+
+
+def key(*parts: Any) -> str:
+    """Ключ из нормализованных параметров (множества — отсортированными списками)."""
+    norm = [sorted(p) if isinstance(p, (set, frozenset)) else p for p in parts]
+    raw = json.dumps(norm, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class Group:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._tasks: Dict[str, asyncio.Future] = {}
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    async def run(self, k: str, fn: Callable[[], Awaitable[T]]) -> T:
+        if not SINGLE_FLIGHT:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(k)
+        if task is not None and not task.done() and task.get_loop() is loop:
+            SINGLE_FLIGHT_CALLS.inc(group=self.name, role="shared")
+            return await asyncio.shield(task)
+
+        SINGLE_FLIGHT_CALLS.inc(group=self.name, role="leader")
+        task = loop.create_task(fn())
+        self._tasks[k] = task
+
+        def _done(t: asyncio.Future) -> None:
+            if self._tasks.get(k) is t:
+                del self._tasks[k]
+            if not t.cancelled():
+                t.exception()   # все ожидающие могли уйти — не оставляем «exception was never retrieved»
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+    def run_sync(self, k: str, fn: Callable[[], T]) -> T:
+        if not SINGLE_FLIGHT:
+            return fn()
+        with self._lock:
+            call = self._calls.get(k)
+            leader = call is None
+            if leader:
+                call = self._calls[k] = _Call()
+        if not leader:
+            SINGLE_FLIGHT_CALLS.inc(group=self.name, role="shared")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        SINGLE_FLIGHT_CALLS.inc(group=self.name, role="leader")
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(k, None)
+            call.done.set()
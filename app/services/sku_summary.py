@@ -0,0 +1,44 @@
+# app/services/sku_summary.py
+"""
+Сводка склада по SKU (таблица sku_inventory_summary): число партий, остаток в штуках и по
+себестоимости, себестоимость и комиссия последней партии.
+
+Единственный SQL пересчёта — upsert_sql. Его вызывают products (правки партий, PG и
+SQLite), profit_fifo (сдвиг qty_sold по журналу FIFO) и миграции (бэкфилл при создании
+таблицы). Условие where вызывающий пишет в своём стиле параметров.
+"""
+from __future__ import annotations
+
+_UPSERT_SQL = """
+    INSERT INTO sku_inventory_summary(
+        sku, batch_count, left_qty, left_cost, last_unit_cost, last_commission_pct, updated_at
+    )
+    SELECT t.sku, t.batch_count, t.left_qty, t.left_cost, t.last_unit_cost, t.last_commission_pct, {now}
+      FROM (
+        SELECT b.sku,
+               COUNT(*) AS batch_count,
+               COALESCE(SUM(b.qty - COALESCE(b.qty_sold,0)), 0) AS left_qty,
+               COALESCE(SUM((b.qty - COALESCE(b.qty_sold,0)) * b.unit_cost), 0) AS left_cost,
+               (SELECT x.unit_cost FROM batches x
+                 WHERE x.sku = b.sku ORDER BY x.date DESC, x.id DESC LIMIT 1) AS last_unit_cost,
+               (SELECT x.commission_pct FROM batches x
+                 WHERE x.sku = b.sku ORDER BY x.date DESC, x.id DESC LIMIT 1) AS last_commission_pct
+          FROM batches b
+         {where}
+      GROUP BY b.sku
+      ) t
+     WHERE true
+    ON CONFLICT (sku) DO UPDATE SET
+        batch_count         = excluded.batch_count,
+        left_qty            = excluded.left_qty,
+        left_cost           = excluded.left_cost,
+        last_unit_cost      = excluded.last_unit_cost,
+        last_commission_pct = excluded.last_commission_pct,
+        updated_at          = excluded.updated_at
+"""
+
+
+def upsert_sql(where: str = "", *, pg: bool) -> str:
+    """INSERT … ON CONFLICT для SKU из batches, отобранных where ("" — все SKU)."""
+    # WHERE true: без него SQLite путает ON CONFLICT с JOIN … ON в INSERT … SELECT
+    return _UPSERT_SQL.format(now="NOW()" if pg else "datetime('now')", where=where)
@@ -0,0 +1,71 @@
+# app/services/startup.py
+"""
+Замер времени холодного старта.
+
+main.py отмечает момент начала импорта (`StartupReport()` в самом верху модуля),
+затем lifespan оборачивает каждый шаг инициализации в `report.step(name)`.
+Итог пишется в лог uvicorn одной строкой и доступен через GET /meta/startup.
+Если суммарное время превышает STARTUP_BUDGET_MS — строка пишется как warning.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+STARTUP_BUDGET_MS = int(os.getenv("STARTUP_BUDGET_MS", "3000") or 3000)
+
+log = logging.getLogger("uvicorn.error")
+
+
+class StartupReport:
+    def __init__(self, budget_ms: int = STARTUP_BUDGET_MS):
+        self.budget_ms = int(budget_ms)
+        self._t0 = time.perf_counter()
+        self.steps: List[Dict[str, Any]] = []
+        self.ready_ms: Optional[float] = None
+
+    def _since_start(self) -> float:
+        return round((time.perf_counter() - self._t0) * 1000.0, 1)
+
+    def mark(self, name: str) -> None:
+        """Шаг, который уже закончился (например, импорт модуля): время от предыдущей отметки."""
+        prev = sum(s["ms"] for s in self.steps)
+        self.steps.append({"step": name, "ms": round(self._since_start() - prev, 1), "ok": True})
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[Dict[str, Any]]:
+        t = time.perf_counter()
+        rec: Dict[str, Any] = {"step": name, "ms": 0.0, "ok": True}
+        try:
+            yield rec
+        except Exception as e:
+            rec["ok"] = False
+            rec["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            rec["ms"] = round((time.perf_counter() - t) * 1000.0, 1)
+            self.steps.append(rec)
+
+    def finish(self) -> Dict[str, Any]:
+        self.ready_ms = self._since_start()
+        data = self.as_dict()
+        line = "startup %.0f ms (budget %d ms): %s" % (
+            self.ready_ms, self.budget_ms,
+            ", ".join(f"{s['step']}={s['ms']:.0f}ms" + ("" if s["ok"] else "!") for s in self.steps),
+        )
+        if data["over_budget"]:
+            log.warning(line)
+        else:
+            log.info(line)
+        return data
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "ready_ms": self.ready_ms,
+            "budget_ms": self.budget_ms,
+            "over_budget": bool(self.ready_ms is not None and self.ready_ms > self.budget_ms),
+            "steps": list(self.steps),
+        }
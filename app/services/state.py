@@ -0,0 +1,427 @@
+# app/services/state.py
+"""
+Общее состояние процессов (jobs, кэши) с подключаемым бэкендом.
+
+При `uvicorn --workers N` каждый воркер — отдельный процесс, и глобальные dict'ы
+(Jobs, orders_cache) у каждого свои: статус задачи, созданной в одном воркере,
+не виден из другого. Поэтому состояние хранится через бэкенд:
+
+  STATE_BACKEND=memory — dict в процессе (один воркер, локальная разработка);
+  STATE_BACKEND=db     — таблица app_state в PG (DATABASE_URL) или в SQLite (DB_PATH, WAL);
+  STATE_BACKEND=redis  — Redis-совместимое хранилище по REDIS_URL (пакет `redis` опционален);
+  STATE_BACKEND=auto   — memory при WEB_CONCURRENCY<=1, иначе redis (если задан REDIS_URL) или db.
+
+Значения — JSON-совместимые dict'ы; у каждого ключа может быть TTL.
+
+Вызовы db/redis блокирующие: из async-кода — только через Namespace.aget/aset/aupdate/
+aadd/adelete (поток asyncio.to_thread; memory — сразу, без потока). Соединения
+переиспользуются: PG — пул до STATE_PG_POOL соединений, SQLite — одно на поток.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from app.services import metrics
+
+STATE_BACKEND = (os.getenv("STATE_BACKEND", "auto") or "auto").strip().lower()
+REDIS_URL = (os.getenv("REDIS_URL") or "").strip()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1") or 1)
+STATE_PG_POOL = int(os.getenv("STATE_PG_POOL", "4") or 4)
+
+_SQLITE_BUSY_MS = 5000
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class StateBackend:
+    name = "base"
+    blocking = True   # False — вызывать из event loop можно напрямую
+
+    def get(self, ns: str, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, ns: str, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def update(self, ns: str, key: str, patch: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Атомарно мержит patch в существующее значение; None — если ключа нет."""
+        raise NotImplementedError
+
+    def add(self, ns: str, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> bool:
+        """Записывает значение, только если ключа нет (или он просрочен); True — если записали."""
+        raise NotImplementedError
+
+    def delete(self, ns: str, key: str) -> None:
+        raise NotImplementedError
+
+    def purge_expired(self) -> int:
+        """Удаляет просроченные ключи (для бэкендов без собственного TTL)."""
+        return 0
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# memory
+# ──────────────────────────────────────────────────────────────────────────────
+class MemoryBackend(StateBackend):
+    name = "memory"
+    blocking = False
+
+    def __init__(self) -> None:
+        self._data: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, k: tuple) -> Optional[Dict[str, Any]]:
+        item = self._data.get(k)
+        if item is None:
+            return None
+        value, exp = item
+        if exp is not None and exp < time.time():
+            self._data.pop(k, None)
+            return None
+        return value
+
+    def get(self, ns, key):
+        with self._lock:
+            return self._alive((ns, key))
+
+    def set(self, ns, key, value, ttl=None):
+        with self._lock:
+            self._data[(ns, key)] = (value, time.time() + ttl if ttl else None)
+
+    def update(self, ns, key, patch):
+        with self._lock:
+            value = self._alive((ns, key))
+            if value is None:
+                return None
+            value.update(patch)
+            return value
+
+    def add(self, ns, key, value, ttl=None):
+        with self._lock:
+            if self._alive((ns, key)) is not None:
+                return False
+            self._data[(ns, key)] = (value, time.time() + ttl if ttl else None)
+            return True
+
+    def delete(self, ns, key):
+        with self._lock:
+            self._data.pop((ns, key), None)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# db: таблица app_state (см. migrations/)
+# ──────────────────────────────────────────────────────────────────────────────
+class PgBackend(StateBackend):
+    name = "db:postgresql"
+
+    def __init__(self, size: int = STATE_PG_POOL) -> None:
+        # простаивающие соединения (autocommit: каждая операция — один запрос)
+        self._idle: "queue.LifoQueue" = queue.LifoQueue(maxsize=max(1, size))
+
+    @contextmanager
+    def _conn(self) -> Iterator[Any]:
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            from app.db import get_conn
+            con = get_conn("state")
+            con.autocommit = True
+        try:
+            yield con
+        except Exception:
+            # соединение могло оборваться — в пул не возвращаем
+            con.close()
+            raise
+        try:
+            self._idle.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+    def get(self, ns, key):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                "SELECT value FROM app_state WHERE ns=%s AND key=%s "
+                "AND (expires_at IS NULL OR expires_at > now())",
+                (ns, key),
+            )
+            row = cur.fetchone()
+            return row["value"] if row else None
+
+    def set(self, ns, key, value, ttl=None):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO app_state(ns, key, value, expires_at)
+                VALUES (%s, %s, %s::jsonb, CASE WHEN %s::float8 IS NULL THEN NULL
+                                               ELSE now() + make_interval(secs => %s::float8) END)
+                ON CONFLICT (ns, key) DO UPDATE
+                   SET value = excluded.value, expires_at = excluded.expires_at
+                """,
+                (ns, key, _dumps(value), ttl, ttl),
+            )
+
+    def update(self, ns, key, patch):
+        # jsonb || jsonb — мерж на стороне БД, без гонки read-modify-write
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                "UPDATE app_state SET value = value || %s::jsonb "
+                "WHERE ns=%s AND key=%s AND (expires_at IS NULL OR expires_at > now()) "
+                "RETURNING value",
+                (_dumps(patch), ns, key),
+            )
+            row = cur.fetchone()
+            return row["value"] if row else None
+
+    def add(self, ns, key, value, ttl=None):
+        # просроченный ключ перезаписывается, живой — нет
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO app_state(ns, key, value, expires_at)
+                VALUES (%s, %s, %s::jsonb, CASE WHEN %s::float8 IS NULL THEN NULL
+                                               ELSE now() + make_interval(secs => %s::float8) END)
+                ON CONFLICT (ns, key) DO UPDATE
+                   SET value = excluded.value, expires_at = excluded.expires_at
+                 WHERE app_state.expires_at IS NOT NULL AND app_state.expires_at <= now()
+                """,
+                (ns, key, _dumps(value), ttl, ttl),
+            )
+            return (cur.rowcount or 0) > 0
+
+    def delete(self, ns, key):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute("DELETE FROM app_state WHERE ns=%s AND key=%s", (ns, key))
+
+    def purge_expired(self):
+        with self._conn() as con, con.cursor() as cur:
+            cur.execute("DELETE FROM app_state WHERE expires_at IS NOT NULL AND expires_at <= now()")
+            return cur.rowcount or 0
+
+
+class SqliteBackend(StateBackend):
+    name = "db:sqlite"
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path
+        self._local = threading.local()   # sqlite3.Connection привязано к потоку — по одному на поток
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            if self._path is None:
+                from app.api.products import DB_PATH
+                self._path = DB_PATH
+            con = sqlite3.connect(self._path, timeout=_SQLITE_BUSY_MS / 1000.0, isolation_level=None,
+                                  factory=metrics.sqlite_factory("state"))
+            # WAL: читатели не блокируют писателя из соседнего воркера
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(f"PRAGMA busy_timeout={_SQLITE_BUSY_MS}")
+            self._local.con = con
+        try:
+            yield con
+        except sqlite3.DatabaseError:
+            self._local.con = None
+            con.close()
+            raise
+
+    def get(self, ns, key):
+        with self._conn() as con:
+            row = con.execute(
+                "SELECT value FROM app_state WHERE ns=? AND key=? AND (expires_at IS NULL OR expires_at > ?)",
+                (ns, key, time.time()),
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def set(self, ns, key, value, ttl=None):
+        with self._conn() as con:
+            con.execute(
+                "INSERT INTO app_state(ns, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(ns, key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at",
+                (ns, key, _dumps(value), time.time() + ttl if ttl else None),
+            )
+
+    def update(self, ns, key, patch):
+        with self._conn() as con:
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                row = con.execute(
+                    "SELECT value FROM app_state WHERE ns=? AND key=? AND (expires_at IS NULL OR expires_at > ?)",
+                    (ns, key, time.time()),
+                ).fetchone()
+                if not row:
+                    con.execute("ROLLBACK")
+                    return None
+                value = json.loads(row[0])
+                value.update(patch)
+                con.execute("UPDATE app_state SET value=? WHERE ns=? AND key=?", (_dumps(value), ns, key))
+                con.execute("COMMIT")
+                return value
+            except Exception:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                raise
+
+    def add(self, ns, key, value, ttl=None):
+        with self._conn() as con:
+            now = time.time()
+            cur = con.execute(
+                "INSERT INTO app_state(ns, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(ns, key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at "
+                "WHERE app_state.expires_at IS NOT NULL AND app_state.expires_at <= ?",
+                (ns, key, _dumps(value), now + ttl if ttl else None, now),
+            )
+            return (cur.rowcount or 0) > 0
+
+    def delete(self, ns, key):
+        with self._conn() as con:
+            con.execute("DELETE FROM app_state WHERE ns=? AND key=?", (ns, key))
+
+    def purge_expired(self):
+        with self._conn() as con:
+            cur = con.execute("DELETE FROM app_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+            return cur.rowcount or 0
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# redis (опционально)
+# ──────────────────────────────────────────────────────────────────────────────
+class RedisBackend(StateBackend):
+    name = "redis"
+
+    def __init__(self, url: str) -> None:
+        import redis  # опциональная зависимость
+        self._r = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+
+    @staticmethod
+    def _k(ns: str, key: str) -> str:
+        return f"kaspi:{ns}:{key}"
+
+    def get(self, ns, key):
+        raw = self._r.get(self._k(ns, key))
+        return json.loads(raw) if raw else None
+
+    def set(self, ns, key, value, ttl=None):
+        self._r.set(self._k(ns, key), _dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def update(self, ns, key, patch):
+        k = self._k(ns, key)
+        with self._r.pipeline() as p:
+            while True:
+                try:
+                    p.watch(k)
+                    raw = p.get(k)
+                    if not raw:
+                        p.unwatch()
+                        return None
+                    value = json.loads(raw)
+                    value.update(patch)
+                    p.multi()
+                    p.set(k, _dumps(value), keepttl=True)
+                    p.execute()
+                    return value
+                except self._watch_error:
+                    continue
+
+    def add(self, ns, key, value, ttl=None):
+        return bool(self._r.set(self._k(ns, key), _dumps(value), px=int(ttl * 1000) if ttl else None, nx=True))
+
+    def delete(self, ns, key):
+        self._r.delete(self._k(ns, key))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# выбор бэкенда
+# ──────────────────────────────────────────────────────────────────────────────
+def _db_backend() -> StateBackend:
+    from app.api.products import _USE_PG
+    return PgBackend() if _USE_PG else SqliteBackend()
+
+
+def _make_backend(kind: str) -> StateBackend:
+    if kind == "auto":
+        if WEB_CONCURRENCY <= 1:
+            kind = "memory"
+        else:
+            kind = "redis" if REDIS_URL else "db"
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "db":
+        return _db_backend()
+    if kind == "redis":
+        if not REDIS_URL:
+            raise RuntimeError("STATE_BACKEND=redis требует REDIS_URL")
+        return RedisBackend(REDIS_URL)
+    raise RuntimeError(f"Неизвестный STATE_BACKEND={kind!r} (memory|db|redis|auto)")
+
+
+_backend: Optional[StateBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> StateBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _make_backend(STATE_BACKEND)
+    return _backend
+
+
+class Namespace:
+    """Именованная область состояния (jobs, orders_cache, …) с TTL по умолчанию."""
+
+    def __init__(self, ns: str, ttl: Optional[float] = None,
+                 backend: Optional[Callable[[], StateBackend]] = None) -> None:
+        self.ns = ns
+        self.ttl = ttl
+        self._backend = backend or get_backend
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._backend().get(self.ns, key)
+        metrics.STATE_GETS.inc(ns=self.ns, result="hit" if value is not None else "miss")
+        return value
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        self._backend().set(self.ns, key, value, ttl if ttl is not None else self.ttl)
+
+    def update(self, key: str, **patch: Any) -> Optional[Dict[str, Any]]:
+        return self._backend().update(self.ns, key, patch)
+
+    def add(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> bool:
+        return self._backend().add(self.ns, key, value, ttl if ttl is not None else self.ttl)
+
+    def delete(self, key: str) -> None:
+        self._backend().delete(self.ns, key)
+
+    # для async-кода: блокирующий бэкенд — в потоке, memory — сразу
+    async def _call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if not self._backend().blocking:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        return await self._call(self.get, key)
+
+    async def aset(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        await self._call(self.set, key, value, ttl)
+
+    async def aupdate(self, key: str, **patch: Any) -> Optional[Dict[str, Any]]:
+        return await self._call(lambda: self.update(key, **patch))
+
+    async def aadd(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> bool:
+        return await self._call(self.add, key, value, ttl)
+
+    async def adelete(self, key: str) -> None:
+        await self._call(self.delete, key)
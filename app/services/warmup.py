@@ -0,0 +1,259 @@
+# app/services/warmup.py
+"""
+Прогрев дашборда к началу рабочего дня.
+
+Операторы открывают дашборд сразу после границы бизнес-дня (BUSINESS_DAY_START) и после
+cut-off приёма (STORE_ACCEPT_UNTIL), и первый запрос всегда самый медленный. Планировщик
+живёт в процессе (запускается в lifespan) и через WARMUP_DELAY_MIN минут после каждой из
+этих границ — по времени тенанта — прогоняет за него типовые запросы: аналитику за день /
+неделю / месяц (с предыдущим периодом — заполняет daily_order_rollup), /orders/ids за
+текущий день с обогащением (кэш позиций заказов), дельта-синхронизацию строк заказов в
+bridge_lines (app/services/bridge_ingest.sync) и разбор очереди FIFO (fifo_queue; он же
+обновляет sku_inventory_summary, из которой читается stock-value).
+
+Настройка — по тенанту, в tenant_settings с ключом "warmup" (GET/POST /settings/warmup):
+  {"enabled": true, "ranges": ["day", "week", "month"], "ids": true, "bridge": true, "fifo": true,
+   "delay_min": 5}
+Границы дня и cut-off берутся из основных настроек тенанта ("settings").
+
+Что именно прогонять, решает колбэк run(cfg, reason) из app.main — модуль про него не знает.
+Общее для всех тенантов (очередь FIFO одна на базу) — колбэк after(тенанты) один раз после
+прогона тенантов цикла; его результат — в статусе каждого из них ("cycle").
+Каждый тик (WARMUP_TICK сек) планировщик ищет тенантов, у которых последняя граница + задержка
+наступила не позже WARMUP_GRACE сек назад; при нескольких воркерах запуск один — его
+захватывает Namespace.add в общем состоянии.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import pytz
+
+from app.services import metrics
+from app.services.state import Namespace
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+WARMUP_DELAY_MIN = int(os.getenv("WARMUP_DELAY_MIN", "5") or 5)
+WARMUP_TICK = float(os.getenv("WARMUP_TICK", "60") or 60)
+WARMUP_GRACE = float(os.getenv("WARMUP_GRACE", "1800") or 1800)
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "900") or 900)
+
+RANGES = {"day": 1, "week": 7, "month": 30}
+DEFAULT_CONFIG: Dict[str, Any] = {
+    "enabled": False,
+    "ranges": ["day", "week", "month"],
+    "ids": True,
+    "bridge": True,
+    "fifo": True,
+    "delay_min": WARMUP_DELAY_MIN,
+}
+
+WARMUP_RUNS = metrics.counter("warmup_runs_total", "Dashboard warm-up runs", ("reason", "status"))
+
+_status = Namespace("warmup", ttl=7 * 86400)
+_locks = Namespace("warmup_locks", ttl=6 * 3600)
+
+
+@dataclass
+class TenantWarmup:
+    tenant_id: str
+    token: str
+    tz: str
+    business_day_start: str
+    store_accept_until: str
+    ranges: List[str] = field(default_factory=lambda: list(DEFAULT_CONFIG["ranges"]))
+    ids: bool = True
+    bridge: bool = True
+    fifo: bool = True
+    delay_min: int = WARMUP_DELAY_MIN
+
+
+def normalize_config(raw: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    cfg = dict(DEFAULT_CONFIG)
+    for k, v in (raw or {}).items():
+        if k in cfg:
+            cfg[k] = v
+    cfg["enabled"] = bool(cfg["enabled"])
+    cfg["ranges"] = [r for r in (cfg["ranges"] or []) if r in RANGES]
+    cfg["ids"] = bool(cfg["ids"])
+    cfg["bridge"] = bool(cfg["bridge"])
+    cfg["fifo"] = bool(cfg["fifo"])
+    try:
+        cfg["delay_min"] = max(0, min(180, int(cfg["delay_min"])))
+    except (TypeError, ValueError):
+        cfg["delay_min"] = WARMUP_DELAY_MIN
+    return cfg
+
+
+def _tenant(tenant_id: str, settings: Dict[str, Any], raw_cfg: Optional[Dict[str, Any]],
+            *, default_tz: str, default_bds: str, default_cutoff: str) -> Optional[TenantWarmup]:
+    token = str(settings.get("kaspi_token") or settings.get("KASPI_TOKEN") or "").strip()
+    if not token:
+        return None
+    cfg = normalize_config(raw_cfg)
+    return TenantWarmup(
+        tenant_id=tenant_id,
+        token=token,
+        tz=str(settings.get("timezone") or default_tz),
+        business_day_start=str(settings.get("business_day_start") or default_bds),
+        store_accept_until=str(settings.get("store_accept_until") or default_cutoff),
+        ranges=cfg["ranges"],
+        ids=cfg["ids"],
+        bridge=cfg["bridge"],
+        fifo=cfg["fifo"],
+        delay_min=cfg["delay_min"],
+    )
+
+
+def load_tenants(*, default_tz: str, default_bds: str, default_cutoff: str,
+                 only: Optional[str] = None, include_disabled: bool = False) -> List[TenantWarmup]:
+    """Тенанты с включённым прогревом (нужен PG: настройки тенантов живут в tenant_settings)."""
+    if not (os.getenv("DATABASE_URL") or "").strip():
+        return []
+    from app.deps.tenant import SETTINGS_KEY, WARMUP_KEY, list_settings
+
+    by_tenant: Dict[str, Dict[str, Any]] = {}
+    for tenant_id, key, value in list_settings((SETTINGS_KEY, WARMUP_KEY)):
+        if only and tenant_id != only:
+            continue
+        by_tenant.setdefault(tenant_id, {})[key] = value if isinstance(value, dict) else {}
+    out: List[TenantWarmup] = []
+    for tenant_id, rows in by_tenant.items():
+        raw_cfg = rows.get(WARMUP_KEY)
+        if not include_disabled and not normalize_config(raw_cfg)["enabled"]:
+            continue
+        t = _tenant(tenant_id, rows.get(SETTINGS_KEY) or {}, raw_cfg,
+                    default_tz=default_tz, default_bds=default_bds, default_cutoff=default_cutoff)
+        if t is not None:
+            out.append(t)
+    return out
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# расписание
+# ──────────────────────────────────────────────────────────────────────────────
+def _at(day_local: datetime, hhmm: str) -> datetime:
+    hh, mm = map(int, hhmm.split(":"))
+    return day_local.replace(hour=hh, minute=mm, second=0, microsecond=0)
+
+
+def last_fire(t: TenantWarmup, now_utc: datetime) -> tuple[datetime, str]:
+    """Последний момент прогрева не позже now: (граница + delay_min, "business_day" | "cutoff")."""
+    tzinfo = pytz.timezone(t.tz)
+    now_local = now_utc.astimezone(tzinfo)
+    delay = timedelta(minutes=t.delay_min)
+    best: Optional[tuple[datetime, str]] = None
+    for back in (0, 1):
+        day = tzinfo.normalize(now_local - timedelta(days=back))
+        for hhmm, reason in ((t.business_day_start, "business_day"), (t.store_accept_until, "cutoff")):
+            fire = tzinfo.localize(_at(day.replace(tzinfo=None), hhmm)) + delay
+            if fire <= now_local and (best is None or fire > best[0]):
+                best = (fire, reason)
+    assert best is not None  # за двое суток хотя бы одна граница уже прошла
+    return best
+
+
+def status(tenant_id: str) -> Optional[Dict[str, Any]]:
+    return _status.get(tenant_id)
+
+
+RunFn = Callable[[TenantWarmup, str], Awaitable[Dict[str, Any]]]
+AfterFn = Callable[[List[TenantWarmup]], Awaitable[Optional[Dict[str, Any]]]]
+
+
+async def run_one(t: TenantWarmup, reason: str, run: RunFn) -> Dict[str, Any]:
+    started = datetime.utcnow().isoformat() + "Z"
+    await _status.aset(t.tenant_id, {"status": "running", "reason": reason, "started": started})
+    try:
+        result = await asyncio.wait_for(run(t, reason), timeout=WARMUP_TIMEOUT)
+    except Exception as e:
+        WARMUP_RUNS.inc(reason=reason, status="error")
+        st = {"status": "error", "reason": reason, "started": started,
+              "finished": datetime.utcnow().isoformat() + "Z", "error": f"{type(e).__name__}: {e}"}
+        await _status.aset(t.tenant_id, st)
+        return st
+    WARMUP_RUNS.inc(reason=reason, status="ok")
+    st = {"status": "ok", "reason": reason, "started": started,
+          "finished": datetime.utcnow().isoformat() + "Z", "result": result}
+    await _status.aset(t.tenant_id, st)
+    return st
+
+
+class Scheduler:
+    def __init__(self, run: RunFn, tenants: Callable[[], List[TenantWarmup]],
+                 tenant: Callable[[str], Optional[TenantWarmup]], after: Optional[AfterFn] = None) -> None:
+        self._run = run
+        self._tenants = tenants
+        self._tenant = tenant
+        self._after = after
+        self._task: Optional[asyncio.Task] = None
+        self._manual: Dict[str, asyncio.Task] = {}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        for task in self._manual.values():
+            task.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def trigger(self, tenant_id: str) -> bool:
+        """Ручной запуск (POST /settings/warmup/run) в фоне; False — нет токена или уже идёт."""
+        running = self._manual.get(tenant_id)
+        if running is not None and not running.done():
+            return False
+        t = await asyncio.to_thread(self._tenant, tenant_id)
+        if t is None:
+            return False
+        self._manual[tenant_id] = asyncio.create_task(self._cycle([(t, "manual")]))
+        return True
+
+    async def _cycle(self, due: List[tuple[TenantWarmup, str]]) -> None:
+        """Прогрев тенантов по очереди, затем один раз after — для всех прогнанных."""
+        ran = [(t, await run_one(t, reason, self._run)) for t, reason in due]
+        if self._after is None or not ran:
+            return
+        try:
+            cycle: Dict[str, Any] = {"result": await self._after([t for t, _ in ran])}
+        except Exception as e:
+            cycle = {"error": f"{type(e).__name__}: {e}"}
+        for t, st in ran:
+            await _status.aset(t.tenant_id, {**st, "cycle": cycle})
+
+    async def tick(self, now_utc: Optional[datetime] = None) -> List[str]:
+        """Один проход: запускает прогрев у тенантов, чья граница наступила. Возвращает их id."""
+        now_utc = now_utc or datetime.now(pytz.UTC)
+        due: List[tuple[TenantWarmup, str]] = []
+        for t in await asyncio.to_thread(self._tenants):
+            fire, reason = last_fire(t, now_utc)
+            if (now_utc - fire).total_seconds() > WARMUP_GRACE:
+                continue
+            # один запуск на границу, даже при нескольких воркерах
+            if not await _locks.aadd(f"{t.tenant_id}:{fire.isoformat()}", {"reason": reason}):
+                continue
+            due.append((t, reason))
+        await self._cycle(due)
+        return [t.tenant_id for t, _ in due]
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # БД настроек недоступна и т. п. — попробуем на следующем тике
+                pass
+            await asyncio.sleep(WARMUP_TICK)
+
+
+# экземпляр создаётся в lifespan приложения (app.main); None — планировщик выключен
+scheduler: Optional[Scheduler] = None
@@ -0,0 +1,299 @@
+# bench/kaspi_sim.py
+"""
+Локальный симулятор Kaspi Shop API v2 для бенчмарков и отладки без сети.
+
+Отдаёт то, что читает сервис:
+  GET /orders                  — JSON:API, page[number]/page[size], links.next, include=entries,
+                                 fields[orders] (sparse fieldset),
+                                 filter[orders][<поле>][$ge|$le], filter[orders][state], filter[orders][code];
+  GET /orders/{id}/entries     — позиции заказа;
+  GET /orderentries            — позиции по filter[order.id].
+
+Заказы генерируются детерминированно (seed) и равномерно раскладываются по периоду.
+Можно задать задержку ответа, долю ответов 429 (с Retry-After) и базу нумерации
+страниц (SIM_PAGE_BASE, у Kaspi — 0).
+
+Использование:
+  - как ASGI-приложение:  uvicorn bench.kaspi_sim:app --port 8980
+    (параметры — SIM_ORDERS, SIM_DAYS, SIM_START, SIM_LATENCY_MS, SIM_RATE_429, SIM_PAGE_BASE, SIM_SEED);
+  - в процессе:           httpx.Client(transport=KaspiSim(...).mock_transport(), base_url=...)
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+STATES = (
+    ("ARCHIVE", 40), ("KASPI_DELIVERY", 15), ("DELIVERED", 10), ("ACCEPTED_BY_MERCHANT", 10),
+    ("APPROVED_BY_BANK", 5), ("NEW", 5), ("CANCELED", 8), ("RETURNED", 2), ("ARCHIVED", 5),
+)
+CITIES = ("Алматы", "Астана", "Шымкент", "Караганда", "Актобе", "Павлодар")
+DATE_FIELDS = ("creationDate", "plannedShipmentDate", "plannedDeliveryDate", "shipmentDate", "deliveryDate")
+
+_DAY_MS = 86_400_000
+
+
+@dataclass
+class SimConfig:
+    orders: int = 1000
+    days: int = 30
+    start: str = "2025-01-01"          # первый день периода (UTC)
+    latency_ms: float = 0.0            # задержка каждого ответа
+    rate_429: float = 0.0              # доля ответов 429 на /orders
+    retry_after: int = 1
+    max_page_size: int = 100           # как у Kaspi: больший page[size] урезается
+    page_base: int = 0                 # Kaspi нумерует страницы с 0
+    skus: int = 500
+    seed: int = 42
+
+    @classmethod
+    def from_env(cls) -> "SimConfig":
+        return cls(
+            orders=int(os.getenv("SIM_ORDERS", "1000")),
+            days=int(os.getenv("SIM_DAYS", "30")),
+            start=os.getenv("SIM_START", "2025-01-01"),
+            latency_ms=float(os.getenv("SIM_LATENCY_MS", "0")),
+            rate_429=float(os.getenv("SIM_RATE_429", "0")),
+            page_base=int(os.getenv("SIM_PAGE_BASE", "0")),
+            seed=int(os.getenv("SIM_SEED", "42")),
+        )
+
+
+def _stat_path(path: str) -> str:
+    path = "/" + path.strip("/")
+    cut = path.find("/order")
+    if cut > 0:
+        path = path[cut:]
+    return path if not path.startswith("/orders/") else "/orders/{id}/entries"
+
+
+@dataclass
+class SimStats:
+    requests: Counter = field(default_factory=Counter)
+    bytes: Counter = field(default_factory=Counter)
+    throttled: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"requests": dict(self.requests), "bytes": dict(self.bytes), "throttled": self.throttled}
+
+
+class KaspiSim:
+    def __init__(self, cfg: Optional[SimConfig] = None) -> None:
+        self.stats = SimStats()
+        self._lock = threading.Lock()
+        self.configure(cfg or SimConfig())
+
+    # ── данные ────────────────────────────────────────────────────────────────
+    def configure(self, cfg: SimConfig) -> None:
+        rnd = random.Random(cfg.seed)
+        start_ms = int(datetime.fromisoformat(cfg.start).replace(tzinfo=timezone.utc).timestamp() * 1000)
+        span = max(1, cfg.days) * _DAY_MS
+        states, weights = zip(*STATES)
+
+        orders: List[Dict[str, Any]] = []
+        entries: Dict[str, List[Dict[str, Any]]] = {}
+        for i in range(cfg.orders):
+            created = start_ms + (span * i) // max(1, cfg.orders) + rnd.randint(0, 59_999)
+            oid = f"sim{i:07d}"
+            st = rnd.choices(states, weights)[0]
+            attrs: Dict[str, Any] = {
+                "code": str(500_000_000 + i),
+                "state": st,
+                "status": "COMPLETED" if st in ("ARCHIVE", "ARCHIVED") else "ACCEPTED_BY_MERCHANT",
+                "creationDate": created,
+                "plannedShipmentDate": created + rnd.randint(0, 2) * _DAY_MS,
+                "plannedDeliveryDate": created + rnd.randint(1, 4) * _DAY_MS,
+                "deliveryAddress": {"city": f"г. {rnd.choice(CITIES)}", "streetName": "ул. Абая"},
+                "deliveryMode": rnd.choice(("DELIVERY_LOCAL", "DELIVERY_PICKUP", "DELIVERY_REGIONAL_TODOOR")),
+            }
+            if st in ("KASPI_DELIVERY", "DELIVERED", "ARCHIVE", "ARCHIVED", "RETURNED"):
+                attrs["shipmentDate"] = created + rnd.randint(0, 3) * _DAY_MS
+            if st in ("DELIVERED", "ARCHIVE", "ARCHIVED"):
+                attrs["deliveryDate"] = attrs["shipmentDate"] + rnd.randint(1, 3) * _DAY_MS
+
+            lines = []
+            total = 0
+            for li in range(rnd.choice((1, 1, 1, 2, 3))):
+                sku = f"SKU-{rnd.randint(1, max(1, cfg.skus)):05d}"
+                qty = rnd.choice((1, 1, 1, 2))
+                price = rnd.randint(20, 900) * 100
+                total += qty * price
+                lines.append({
+                    "type": "orderentries",
+                    "id": f"{oid}-e{li}",
+                    "attributes": {
+                        "quantity": qty,
+                        "basePrice": price,
+                        "totalPrice": qty * price,
+                        "entryNumber": li,
+                        "offer": {"code": sku, "name": f"Товар {sku}"},
+                        "offerName": f"Товар {sku}",
+                    },
+                    "relationships": {"order": {"data": {"type": "orders", "id": oid}}},
+                })
+            attrs["totalPrice"] = total
+            orders.append({
+                "type": "orders",
+                "id": oid,
+                "attributes": attrs,
+                "relationships": {"entries": {"data": [{"type": "orderentries", "id": e["id"]} for e in lines]}},
+            })
+            entries[oid] = lines
+
+        with self._lock:
+            self.cfg = cfg
+            self.orders = orders
+            self.entries = entries
+            # индексы для диапазонных фильтров по каждому полю даты
+            self._index: Dict[str, Tuple[List[int], List[int]]] = {}
+            for f in DATE_FIELDS:
+                pairs = sorted(
+                    (o["attributes"][f], n) for n, o in enumerate(orders) if o["attributes"].get(f) is not None
+                )
+                self._index[f] = ([p[0] for p in pairs], [p[1] for p in pairs])
+            self.stats = SimStats()
+
+    # ── обработка запросов ────────────────────────────────────────────────────
+    def handle(self, method: str, path: str, query: List[Tuple[str, str]],
+               base_url: str = "") -> Tuple[int, Dict[str, str], Any]:
+        """Чистая обработка: (status, headers, json-тело)."""
+        path = "/" + path.strip("/")
+        # /shop/api/v2/orders и /orders — одно и то же; префикс сохраняем для links.next
+        prefix = ""
+        cut = path.find("/order")
+        if cut > 0:
+            prefix, path = path[:cut], path[cut:]
+        base_url = base_url + prefix
+        self.stats.requests[_stat_path(path)] += 1
+
+        if method != "GET":
+            return 405, {}, {"errors": [{"title": "method not allowed"}]}
+
+        if self.cfg.rate_429 and path == "/orders" and random.random() < self.cfg.rate_429:
+            self.stats.throttled += 1
+            return 429, {"Retry-After": str(self.cfg.retry_after)}, {"errors": [{"title": "Too Many Requests"}]}
+
+        params = dict(query)
+        if path == "/orders":
+            return self._orders(params, query, base_url)
+        if path.startswith("/orders/") and path.endswith("/entries"):
+            oid = path[len("/orders/"):-len("/entries")]
+            return 200, {}, {"data": self.entries.get(oid, [])}
+        if path == "/orderentries":
+            oid = params.get("filter[order.id]") or ""
+            return 200, {}, {"data": self.entries.get(oid, [])}
+        return 404, {}, {"errors": [{"title": "not found"}]}
+
+    def _orders(self, params: Dict[str, str], query: List[Tuple[str, str]], base_url: str):
+        field_ = None
+        ge = le = None
+        for f in DATE_FIELDS + ("date",):
+            a, b = params.get(f"filter[orders][{f}][$ge]"), params.get(f"filter[orders][{f}][$le]")
+            if a is not None or b is not None:
+                field_ = "creationDate" if f == "date" else f
+                ge = int(a) if a is not None else None
+                le = int(b) if b is not None else None
+                break
+        code = params.get("filter[orders][code]")
+        if field_ is None and not code:
+            return 400, {}, {"errors": [{"title": "filter[orders][creationDate] is required"}]}
+
+        if field_ is None:
+            rows = [o for o in self.orders if o["attributes"]["code"] == code]
+        else:
+            keys, idx = self._index[field_]
+            lo = bisect.bisect_left(keys, ge) if ge is not None else 0
+            hi = bisect.bisect_right(keys, le) if le is not None else len(keys)
+            rows = [self.orders[i] for i in sorted(idx[lo:hi])]
+            if code:
+                rows = [o for o in rows if o["attributes"]["code"] == code]
+
+        raw_states = params.get("filter[orders][state]")
+        if raw_states:
+            wanted = {s.strip().upper() for s in raw_states.split(",") if s.strip()}
+            rows = [o for o in rows if o["attributes"]["state"] in wanted]
+
+        size = max(1, min(int(params.get("page[size]") or 20), self.cfg.max_page_size))
+        number = int(params.get("page[number]") or self.cfg.page_base)
+        page_count = max(1, -(-len(rows) // size))
+        off = (number - self.cfg.page_base) * size
+        page = rows[off: off + size] if off >= 0 else []
+
+        # sparse fieldset: fields[orders]=a,b,c — только эти атрибуты
+        wanted = {f.strip() for f in (params.get("fields[orders]") or "").split(",") if f.strip()}
+        if wanted:
+            page = [{**o, "attributes": {k: v for k, v in o["attributes"].items() if k in wanted}} for o in page]
+        body: Dict[str, Any] = {"data": page, "meta": {"pageCount": page_count, "totalCount": len(rows)}}
+        if "entries" in (params.get("include") or ""):
+            body["included"] = [e for o in page for e in self.entries.get(o["id"], [])]
+        if off + size < len(rows):
+            nxt = [(k, v) for k, v in query if k != "page[number]"] + [("page[number]", str(number + 1))]
+            body["links"] = {"next": f"{base_url}/orders?{urlencode(nxt)}"}
+        return 200, {}, body
+
+    # ── транспорты ────────────────────────────────────────────────────────────
+    def mock_transport(self):
+        """httpx.MockTransport поверх симулятора (работает и с Client, и с AsyncClient)."""
+        import httpx
+
+        def handler(request: "httpx.Request") -> "httpx.Response":
+            if self.cfg.latency_ms:
+                time.sleep(self.cfg.latency_ms / 1000.0)
+            base = f"{request.url.scheme}://{request.url.netloc.decode()}"
+            status, headers, body = self.handle(
+                request.method, request.url.path,
+                parse_qsl(request.url.query.decode(), keep_blank_values=True), base,
+            )
+            resp = httpx.Response(status, headers=headers, json=body)
+            self.stats.bytes[_stat_path(request.url.path)] += len(resp.content)
+            return resp
+
+        return httpx.MockTransport(handler)
+
+    async def __call__(self, scope, receive, send) -> None:
+        """ASGI-приложение."""
+        if scope["type"] == "lifespan":
+            while True:
+                msg = await receive()
+                if msg["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif msg["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        if self.cfg.latency_ms:
+            await asyncio.sleep(self.cfg.latency_ms / 1000.0)
+        hdrs = dict(scope.get("headers") or [])
+        host = (hdrs.get(b"host") or b"localhost").decode()
+        base = f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}"
+        if scope["path"] == "/_sim/stats":
+            status, headers, body = 200, {}, self.stats.as_dict()
+        else:
+            status, headers, body = self.handle(
+                scope["method"], scope["path"],
+                parse_qsl(scope.get("query_string", b"").decode(), keep_blank_values=True), base,
+            )
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.stats.bytes[_stat_path(scope["path"])] += len(raw)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/vnd.api+json"),
+                        (b"content-length", str(len(raw)).encode())]
+                       + [(k.lower().encode(), str(v).encode()) for k, v in headers.items()],
+        })
+        await send({"type": "http.response.body", "body": raw})
+
+
+app = KaspiSim(SimConfig.from_env())
@@ -0,0 +1,332 @@
+# bench/run_bench.py
+"""
+Сквозные бенчмарки сервиса на локальном симуляторе Kaspi (bench/kaspi_sim.py).
+
+Симулятор поднимается на localhost (uvicorn в отдельном потоке), приложение
+получает его как KASPI_BASE_URL и работает по обычному HTTP-пути, с временной
+SQLite-базой. Для каждого размера (число заказов) сценарии гоняются --repeat раз,
+в отчёт идёт медиана. Медианы сравниваются с bench/baselines.json.
+
+Меряется расчёт, а не кэши: запросы заказов идут с fresh=1 (мимо кэша результатов), а
+роллапы выключены (ROLLUP_ENABLED=false) — иначе повторы читали бы готовые дни.
+Перед замерами каждый сценарий прогоняется один раз вхолостую: первый запуск делает другую
+работу (bridge_sync и products_import вставляют строки, обогащение наполняет кэш позиций),
+и без этого медиана зависела бы от --repeat.
+
+    python -m bench.run_bench                          # 1k и 10k, сравнение с базовыми
+    python -m bench.run_bench --sizes 1000,10000,100000
+    python -m bench.run_bench --only orders_analytics,orders_ids --repeat 5
+    python -m bench.run_bench --latency-ms 30 --rate-429 0.02
+    python -m bench.run_bench --update-baseline        # записать текущие медианы как базовые
+
+Код возврата 1 — если какой-то сценарий медленнее базового больше чем на --tolerance.
+FIFO (/profit/bridge/fifo/*) работает только на PostgreSQL и запускается, если задан DATABASE_URL.
+Те же сценарии с проверкой ответов и обхода кэша — pytest-обёртка bench/test_bench.py
+(session() и scenario_names() ниже — общие для неё и для run()).
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import io
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+BASELINES = Path(__file__).resolve().parent / "baselines.json"
+
+SIM_START = "2025-01-01"
+SIM_DAYS = 30
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# окружение
+# ──────────────────────────────────────────────────────────────────────────────
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_sim(sim, port: int):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(sim, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    th = threading.Thread(target=server.run, daemon=True)
+    th.start()
+    for _ in range(200):
+        if server.started:
+            return server
+        time.sleep(0.02)
+    raise RuntimeError("simulator did not start")
+
+
+def _fake_jwt(sub: str = "bench") -> str:
+    def b64(d: Dict[str, Any]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip("=")
+    return f"{b64({'alg': 'none'})}.{b64({'sub': sub})}.x"
+
+
+def _make_app(sim_url: str, db_dir: str):
+    os.environ["KASPI_BASE_URL"] = sim_url
+    os.environ.setdefault("DB_PATH", os.path.join(db_dir, "bench.sqlite3"))
+    os.environ.setdefault("STATE_BACKEND", "memory")
+    os.environ.setdefault("ROLLUP_ENABLED", "false")
+    # у симулятора нет квоты: лимитер тенанта не должен упираться в RPS, 429 задаются --rate-429
+    os.environ.setdefault("KASPI_RPS", "1000")
+    os.environ.setdefault("KASPI_BURST", "1000")
+    sys.path.insert(0, str(ROOT))
+
+    # токен тенанта обычно берётся из tenant_settings (PG) — в бенче подставляем фиксированный
+    import app.deps.auth as auth
+    auth.resolve_kaspi_token = lambda tenant_id: "bench-token" if tenant_id else None
+
+    from app.main import app
+    return app
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# сценарии
+# ──────────────────────────────────────────────────────────────────────────────
+class Ctx:
+    def __init__(self, client, sim, size: int) -> None:
+        self.client = client
+        self.sim = sim
+        self.size = size
+        start = datetime.fromisoformat(SIM_START)
+        self.start = (start + timedelta(days=3)).date().isoformat()
+        self.end = (start + timedelta(days=SIM_DAYS - 3)).date().isoformat()
+        self.info: Dict[str, Any] = {}
+
+    def get(self, url: str, **params):
+        r = self.client.get(url, params=params)
+        if r.status_code >= 400:
+            raise RuntimeError(f"GET {url}: {r.status_code} {r.text[:300]}")
+        return r
+
+    def post(self, url: str, **kw):
+        r = self.client.post(url, **kw)
+        if r.status_code >= 400:
+            raise RuntimeError(f"POST {url}: {r.status_code} {r.text[:300]}")
+        return r
+
+
+def orders_analytics(ctx: Ctx) -> None:
+    j = ctx.get("/orders/analytics", start=ctx.start, end=ctx.end, fresh=1).json()
+    ctx.info["analytics_total_orders"] = j["total_orders"]
+
+
+def orders_ids(ctx: Ctx) -> None:
+    j = ctx.get("/orders/ids", start=ctx.start, end=ctx.end, with_items=0, fresh=1).json()
+    ctx.info["ids_count"] = j["period_total_count"]
+
+
+def orders_ids_enrich(ctx: Ctx) -> None:
+    ctx.get("/orders/ids", start=ctx.start, end=ctx.end, with_items=1, enrich_scope="last_week", fresh=1)
+
+
+def orders_ids_csv(ctx: Ctx) -> None:
+    ctx.get("/orders/ids.csv", start=ctx.start, end=ctx.end)
+
+
+def _bridge_lines(ctx: Ctx) -> List[Dict[str, Any]]:
+    out = []
+    for o in ctx.sim.orders:
+        a = o["attributes"]
+        for e in ctx.sim.entries[o["id"]]:
+            ea = e["attributes"]
+            out.append({
+                "id": o["id"], "code": a["code"], "date": a["creationDate"], "state": a["state"],
+                "sku": ea["offer"]["code"], "title": ea["offerName"], "qty": ea["quantity"],
+                "unit_price": ea["basePrice"], "total_price": ea["totalPrice"], "line_index": ea["entryNumber"],
+            })
+    return out
+
+
+def bridge_sync(ctx: Ctx) -> None:
+    lines = ctx.info.setdefault("_lines", None) or _bridge_lines(ctx)
+    ctx.info["_lines"] = lines
+    for i in range(0, len(lines), 1000):
+        ctx.post("/profit/bridge/sync-by-ids", json=lines[i:i + 1000])
+
+
+def bridge_by_orders(ctx: Ctx) -> None:
+    j = ctx.get("/profit/bridge/by-orders", date_from=ctx.start, date_to=ctx.end).json()
+    ctx.info["bridge_orders"] = j["stats"].get("orders")
+
+
+def _xlsx(rows: int) -> bytes:
+    import openpyxl
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["SKU", "Наименование", "Бренд", "Цена", "Остаток"])
+    for i in range(rows):
+        ws.append([f"SKU-{i + 1:05d}", f"Товар {i + 1}", "Bench", 1000 + i, 5])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def products_import(ctx: Ctx) -> None:
+    raw = ctx.info.get("_xlsx") or _xlsx(min(ctx.size, 20000))
+    ctx.info["_xlsx"] = raw
+    ctx.post("/products/import/sync", params={"mode": "merge"}, files={"file": ("bench.xlsx", raw)})
+
+
+def products_list(ctx: Ctx) -> None:
+    ctx.get("/products/db/list", active_only=0, limit=500)
+
+
+def products_stock_value(ctx: Ctx) -> None:
+    ctx.get("/products/db/stock-value")
+
+
+def fifo_rebuild(ctx: Ctx) -> None:
+    ctx.post(f"/profit/bridge/fifo/rebuild?date_from={ctx.start}&date_to={ctx.end}")
+
+
+SCENARIOS: Dict[str, Callable[[Ctx], None]] = {
+    "orders_analytics": orders_analytics,
+    "orders_ids": orders_ids,
+    "orders_ids_enrich": orders_ids_enrich,
+    "orders_ids_csv": orders_ids_csv,
+    "bridge_sync": bridge_sync,
+    "bridge_by_orders": bridge_by_orders,
+    "products_import": products_import,
+    "products_list": products_list,
+    "products_stock_value": products_stock_value,
+    "fifo_rebuild": fifo_rebuild,
+}
+PG_ONLY = {"fifo_rebuild"}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# запуск
+# ──────────────────────────────────────────────────────────────────────────────
+def _time(fn: Callable[[Ctx], None], ctx: Ctx, repeat: int) -> Dict[str, Any]:
+    fn(ctx)  # вхолостую, см. docstring модуля
+    runs: List[float] = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(ctx)
+        runs.append((time.perf_counter() - t) * 1000.0)
+    return {"median_ms": round(statistics.median(runs), 1), "min_ms": round(min(runs), 1), "runs": len(runs)}
+
+
+@contextmanager
+def session() -> Iterator[Tuple[Any, Any]]:
+    """Симулятор на localhost + приложение на него (TestClient с токеном тенанта): (client, sim)."""
+    from bench.kaspi_sim import KaspiSim, SimConfig
+    from fastapi.testclient import TestClient
+
+    sim = KaspiSim(SimConfig(orders=1, days=SIM_DAYS, start=SIM_START))
+    port = _free_port()
+    server = _start_sim(sim, port)
+    db_dir = tempfile.mkdtemp(prefix="kaspi-bench-")
+    try:
+        app = _make_app(f"http://127.0.0.1:{port}/shop/api/v2", db_dir)
+        with TestClient(app, headers={"Authorization": f"Bearer {_fake_jwt()}"}) as client:
+            yield client, sim
+    finally:
+        server.should_exit = True
+
+
+def scenario_names(only: Optional[List[str]] = None) -> List[str]:
+    names = [n for n in SCENARIOS if not only or n in only]
+    if not os.getenv("DATABASE_URL"):
+        names = [n for n in names if n not in PG_ONLY]
+    return names
+
+
+def run(sizes: List[int], only: Optional[List[str]], repeat: int,
+        latency_ms: float, rate_429: float) -> Dict[str, Any]:
+    from bench.kaspi_sim import SimConfig
+
+    names = scenario_names(only)
+    results: Dict[str, Any] = {}
+    with session() as (client, sim):
+        for size in sizes:
+            sim.configure(SimConfig(orders=size, days=SIM_DAYS, start=SIM_START,
+                                    latency_ms=latency_ms, rate_429=rate_429))
+            ctx = Ctx(client, sim, size)
+            for name in names:
+                try:
+                    res = _time(SCENARIOS[name], ctx, repeat)
+                except Exception as e:  # сценарий упал — фиксируем, остальные гоняем дальше
+                    res = {"error": str(e)[:300]}
+                results[f"{name}@{size}"] = res
+                print(f"  {name:<22} {size:>7}  " + (
+                    f"{res['median_ms']:>10.1f} ms" if "median_ms" in res else f"ERROR {res['error']}"
+                ), flush=True)
+            info = {k: v for k, v in ctx.info.items() if not k.startswith("_")}
+            info["kaspi_requests"] = sim.stats.as_dict()
+            results[f"_info@{size}"] = info
+            print(f"  info {size}: {info}", flush=True)
+    return results
+
+
+def compare(results: Dict[str, Any], baselines: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    print(f"\n{'scenario@size':<32}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for key, res in results.items():
+        if key.startswith("_") or "median_ms" not in res:
+            continue
+        base = (baselines.get(key) or {}).get("median_ms")
+        cur = res["median_ms"]
+        if not base:
+            print(f"{key:<32}{'—':>12}{cur:>12.1f}{'':>8}")
+            continue
+        ratio = cur / base if base else 0.0
+        mark = ""
+        if ratio > 1.0 + tolerance:
+            mark = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:<32}{base:>12.1f}{cur:>12.1f}{ratio:>8.2f}{mark}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Kaspi Orders Analytics — бенчмарки на симуляторе Kaspi")
+    ap.add_argument("--sizes", default="1000,10000", help="CSV: число заказов в симуляторе")
+    ap.add_argument("--only", default="", help="CSV сценариев: " + ",".join(SCENARIOS))
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="задержка каждого ответа симулятора")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 на /orders")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление относительно базового")
+    ap.add_argument("--baseline", default=str(BASELINES))
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--json", default="", help="сохранить результаты в файл")
+    args = ap.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    only = [s.strip() for s in args.only.split(",") if s.strip()] or None
+    results = run(sizes, only, args.repeat, args.latency_ms, args.rate_429)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    path = Path(args.baseline)
+    baselines = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+    if args.update_baseline:
+        for k, v in results.items():
+            if not k.startswith("_") and "median_ms" in v:
+                baselines[k] = {"median_ms": v["median_ms"]}
+        path.write_text(json.dumps(dict(sorted(baselines.items())), indent=2) + "\n", encoding="utf-8")
+        print(f"\nbaselines updated: {path}")
+        return 0
+    return 1 if compare(results, baselines, args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# bench/test_bench.py
+"""
+Сценарии бенчмарка (bench/run_bench.py) как pytest-тесты: python -m pytest bench
+
+Каждый сценарий гоняется на симуляторе с 1k заказов и проверяется по ответам: числа
+заказов в analytics / ids / ids.csv сходятся, fresh=1 идёт мимо кэша результатов в Kaspi,
+а без него повтор берётся из кэша. Время по умолчанию не проверяется (общие раннеры шумят);
+BENCH_COMPARE=1 добавляет сравнение медиан с bench/baselines.json (допуск — BENCH_TOLERANCE,
+по умолчанию 0.25, как у --tolerance).
+"""
+from __future__ import annotations
+
+import json
+import os
+
+import pytest
+
+from bench import run_bench
+from bench.kaspi_sim import SimConfig
+
+SIZE = 1000
+
+
+@pytest.fixture(scope="module")
+def ctx():
+    with run_bench.session() as (client, sim):
+        sim.configure(SimConfig(orders=SIZE, days=run_bench.SIM_DAYS, start=run_bench.SIM_START))
+        yield run_bench.Ctx(client, sim, SIZE)
+
+
+def _kaspi_orders(ctx) -> int:
+    return ctx.sim.stats.as_dict()["requests"].get("/orders", 0)
+
+
+@pytest.mark.parametrize("name", run_bench.scenario_names())
+def test_scenario(ctx, name):
+    run_bench.SCENARIOS[name](ctx)
+
+
+def test_orders_counts_agree(ctx):
+    total = ctx.get("/orders/analytics", start=ctx.start, end=ctx.end, fresh=1).json()["total_orders"]
+    ids = ctx.get("/orders/ids", start=ctx.start, end=ctx.end, with_items=0, fresh=1).json()
+    csv = ctx.get("/orders/ids.csv", start=ctx.start, end=ctx.end).text
+    assert total > 0
+    assert ids["period_total_count"] == total
+    assert len(ids["items"]) == total
+    assert len([ln for ln in csv.splitlines() if ln.strip()]) == total
+
+
+@pytest.mark.parametrize("url", ["/orders/analytics", "/orders/ids"])
+def test_fresh_bypasses_result_cache(ctx, url):
+    params = dict(start=ctx.start, end=ctx.end, with_items=0)
+    first = ctx.get(url, **params)
+
+    before = _kaspi_orders(ctx)
+    cached = ctx.get(url, **params)
+    assert cached.headers["X-Cache"] == "fresh"
+    assert _kaspi_orders(ctx) == before
+    assert cached.json() == first.json()
+
+    bypass = ctx.get(url, fresh=1, **params)
+    assert bypass.headers["X-Cache"] == "bypass"
+    assert _kaspi_orders(ctx) > before
+
+
+@pytest.mark.skipif(os.getenv("BENCH_COMPARE", "").lower() not in ("1", "true", "yes", "on"),
+                    reason="сравнение времени с baselines.json — только с BENCH_COMPARE=1")
+@pytest.mark.parametrize("name", run_bench.scenario_names())
+def test_no_regression(ctx, name):
+    baselines = json.loads(run_bench.BASELINES.read_text(encoding="utf-8"))
+    base = (baselines.get(f"{name}@{SIZE}") or {}).get("median_ms")
+    if not base:
+        pytest.skip(f"нет базового значения для {name}@{SIZE}")
+    res = run_bench._time(run_bench.SCENARIOS[name], ctx, 3)
+    tolerance = float(os.getenv("BENCH_TOLERANCE", "0.25"))
+    assert res["median_ms"] <= base * (1.0 + tolerance), f"{res['median_ms']} ms vs {base} ms"
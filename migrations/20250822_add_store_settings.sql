@@ -1,10 +1,15 @@
 
--- SQL migration for store settings. Adjust types/dialect for your DB if needed (PostgreSQL syntax).
+-- SQL migration for store settings (PostgreSQL).
+-- Used to be applied by hand; the startup runner (app/services/migrations.py) now applies it,
+-- so every statement is idempotent on databases where it was already run.
 CREATE TABLE IF NOT EXISTS store_settings (
     id SERIAL PRIMARY KEY,
     business_day_start VARCHAR(5) NOT NULL DEFAULT '20:00',
     timezone VARCHAR(64) NOT NULL DEFAULT 'Asia/Almaty'
 );
+-- hand-made copies of the table may lack a column
+ALTER TABLE store_settings ADD COLUMN IF NOT EXISTS business_day_start VARCHAR(5) NOT NULL DEFAULT '20:00';
+ALTER TABLE store_settings ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) NOT NULL DEFAULT 'Asia/Almaty';
 -- If you plan a single-row table, you can insert defaults once:
 INSERT INTO store_settings (business_day_start, timezone)
 SELECT '20:00', 'Asia/Almaty'
@@ -0,0 +1,171 @@
+-- Core schema (PostgreSQL). Replaces the per-request bootstraps that used to live in
+-- app/api/products.py, app/api/profit_fifo.py, app/api/bridge_v2.py and app/deps/tenant.py.
+-- Every statement is idempotent so the migration is safe on databases created by those bootstraps.
+
+-- ── tenants / settings ─────────────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS public.tenants (
+    id uuid PRIMARY KEY,
+    email text,
+    phone text,
+    created_at timestamptz DEFAULT now(),
+    is_active boolean DEFAULT true
+);
+
+CREATE TABLE IF NOT EXISTS public.tenant_settings (
+    tenant_id uuid NOT NULL REFERENCES public.tenants(id) ON DELETE CASCADE,
+    key text NOT NULL DEFAULT 'settings',
+    value jsonb NOT NULL,
+    updated_at timestamptz DEFAULT now(),
+    PRIMARY KEY (tenant_id, key)
+);
+
+ALTER TABLE public.tenant_settings ADD COLUMN IF NOT EXISTS key text;
+ALTER TABLE public.tenant_settings ALTER COLUMN key SET DEFAULT 'settings';
+UPDATE public.tenant_settings SET key = 'settings' WHERE key IS NULL;
+ALTER TABLE public.tenant_settings ALTER COLUMN key SET NOT NULL;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_constraint
+     WHERE conrelid = 'public.tenant_settings'::regclass AND contype = 'p'
+  ) THEN
+    ALTER TABLE public.tenant_settings
+      ADD CONSTRAINT tenant_settings_pkey PRIMARY KEY (tenant_id, key);
+  END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS tenant_settings_tenant_id_key_idx
+    ON public.tenant_settings(tenant_id, key);
+
+-- ── products / batches / categories ───────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS products(
+    sku TEXT PRIMARY KEY,
+    name TEXT,
+    brand TEXT,
+    category TEXT,
+    price DOUBLE PRECISION,
+    quantity INTEGER,
+    active INTEGER DEFAULT 1,
+    barcode TEXT,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS batches(
+    id SERIAL PRIMARY KEY,
+    sku TEXT NOT NULL REFERENCES products(sku) ON DELETE CASCADE,
+    date DATE NOT NULL,
+    qty INTEGER NOT NULL,
+    unit_cost DOUBLE PRECISION NOT NULL,
+    note TEXT,
+    commission_pct DOUBLE PRECISION,
+    batch_code TEXT UNIQUE,
+    qty_sold INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- таблица могла быть создана старым bridge_v2 в урезанном виде
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS qty INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS note TEXT;
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS commission_pct DOUBLE PRECISION;
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS batch_code TEXT;
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS qty_sold INTEGER DEFAULT 0;
+ALTER TABLE batches ALTER COLUMN commission_pct DROP NOT NULL;
+
+CREATE TABLE IF NOT EXISTS categories(
+    name TEXT PRIMARY KEY,
+    base_percent DOUBLE PRECISION DEFAULT 0.0,
+    extra_percent DOUBLE PRECISION DEFAULT 3.0,
+    tax_percent DOUBLE PRECISION DEFAULT 0.0
+);
+
+CREATE INDEX IF NOT EXISTS idx_batches_sku ON batches(sku);
+CREATE INDEX IF NOT EXISTS idx_batches_date ON batches(date);
+
+DELETE FROM products p USING (
+    SELECT ctid, row_number() OVER (PARTITION BY sku ORDER BY updated_at NULLS LAST) AS rn
+      FROM products
+) t
+WHERE p.ctid = t.ctid AND t.rn > 1;
+
+INSERT INTO categories(name, base_percent, extra_percent, tax_percent)
+SELECT v.name, v.base_percent, v.extra_percent, v.tax_percent
+  FROM (VALUES
+        ('Витамины/БАДы',   10.0, 3.0, 0.0),
+        ('Сад/освещение',   10.0, 3.0, 0.0),
+        ('Товары для дома', 10.0, 3.0, 0.0),
+        ('Прочее',          10.0, 3.0, 0.0)
+       ) AS v(name, base_percent, extra_percent, tax_percent)
+ WHERE NOT EXISTS (SELECT 1 FROM categories)
+ON CONFLICT (name) DO NOTHING;
+
+-- ── per-SKU inventory summary ─────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS sku_inventory_summary(
+    sku TEXT PRIMARY KEY,
+    batch_count INTEGER NOT NULL DEFAULT 0,
+    left_qty INTEGER NOT NULL DEFAULT 0,
+    left_cost DOUBLE PRECISION NOT NULL DEFAULT 0,
+    last_unit_cost DOUBLE PRECISION,
+    last_commission_pct DOUBLE PRECISION,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- заполняется шагом данных после этого файла (app.services.migrations → sku_summary.upsert_sql)
+
+-- ── FIFO ledger ───────────────────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS profit_fifo_ledger(
+    id BIGSERIAL PRIMARY KEY,
+    order_id TEXT,
+    order_code TEXT,
+    date_utc_ms BIGINT,
+    sku TEXT NOT NULL,
+    line_index INTEGER DEFAULT 0,
+    qty INTEGER NOT NULL,
+    unit_price DOUBLE PRECISION DEFAULT 0,
+    total_price DOUBLE PRECISION DEFAULT 0,
+    batch_id BIGINT,
+    batch_date DATE,
+    unit_cost DOUBLE PRECISION DEFAULT 0,
+    commission_pct DOUBLE PRECISION DEFAULT 0,
+    commission_amount DOUBLE PRECISION DEFAULT 0,
+    cost_amount DOUBLE PRECISION DEFAULT 0,
+    profit_amount DOUBLE PRECISION DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_fifo_order ON profit_fifo_ledger(order_code);
+CREATE INDEX IF NOT EXISTS idx_fifo_sku   ON profit_fifo_ledger(sku);
+CREATE INDEX IF NOT EXISTS idx_fifo_batch ON profit_fifo_ledger(batch_id);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_fifo_code_line_batch
+    ON profit_fifo_ledger(order_code, line_index, batch_id);
+
+-- ── bridge lines ──────────────────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS public.bridge_lines(
+    order_id     text NOT NULL,
+    order_code   text,
+    state        text,
+    date_utc_ms  bigint,
+    sku          text,
+    title        text,
+    qty          integer DEFAULT 1,
+    unit_price   double precision DEFAULT 0,
+    total_price  double precision DEFAULT 0,
+    line_index   integer NOT NULL,
+    created_at   bigint,
+    updated_at   bigint,
+    PRIMARY KEY(order_id, line_index)
+);
+CREATE INDEX IF NOT EXISTS ix_lines_date  ON public.bridge_lines(date_utc_ms);
+CREATE INDEX IF NOT EXISTS ix_lines_state ON public.bridge_lines(state);
+CREATE INDEX IF NOT EXISTS ix_lines_sku   ON public.bridge_lines(sku);
+CREATE INDEX IF NOT EXISTS ix_lines_code  ON public.bridge_lines(order_code);
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'bridge_sales')
+     AND NOT EXISTS (SELECT 1 FROM information_schema.views WHERE table_name = 'bridge_sales') THEN
+    CREATE VIEW bridge_sales AS
+    SELECT order_id, order_code, date_utc_ms, state, line_index,
+           sku, title, qty, unit_price, total_price
+      FROM bridge_lines;
+  END IF;
+END $$;
@@ -0,0 +1,9 @@
+-- Shared process state (jobs, caches) for STATE_BACKEND=db, see app/services/state.py.
+CREATE TABLE IF NOT EXISTS app_state(
+    ns         TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    value      JSONB NOT NULL,
+    expires_at TIMESTAMPTZ,
+    PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS idx_app_state_expires ON app_state(expires_at);
@@ -0,0 +1,25 @@
+-- Per-day order rollups for /orders/analytics, see app/services/rollup.py.
+-- tenant — hash of the Kaspi token; variant — settings that move orders between days
+-- (tz, date field, cut-off, business-day start).
+CREATE TABLE IF NOT EXISTS daily_order_rollup(
+    tenant      TEXT NOT NULL,
+    assign_mode TEXT NOT NULL,
+    variant     TEXT NOT NULL,
+    day         DATE NOT NULL,
+    state       TEXT NOT NULL,
+    city        TEXT NOT NULL DEFAULT '',
+    orders      INTEGER NOT NULL,
+    amount      DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (tenant, assign_mode, variant, day, state, city)
+);
+
+-- which days are built (a day without orders has no rollup rows) and whether they are final
+CREATE TABLE IF NOT EXISTS daily_order_rollup_days(
+    tenant      TEXT NOT NULL,
+    assign_mode TEXT NOT NULL,
+    variant     TEXT NOT NULL,
+    day         DATE NOT NULL,
+    frozen      BOOLEAN NOT NULL DEFAULT FALSE,
+    built_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (tenant, assign_mode, variant, day)
+);
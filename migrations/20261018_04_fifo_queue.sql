@@ -0,0 +1,12 @@
+-- SKUs waiting for an incremental FIFO replay, see app/services/fifo_queue.py.
+-- since_ms — earliest changed sale (bridge_lines.date_utc_ms), since_batch — earliest edited batch date.
+CREATE TABLE IF NOT EXISTS fifo_queue(
+    sku         TEXT PRIMARY KEY,
+    since_ms    BIGINT,
+    since_batch DATE,
+    queued_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- replay drops a SKU's ledger tail: WHERE sku = ? AND date_utc_ms >= ?
+CREATE INDEX IF NOT EXISTS idx_fifo_sku_date ON profit_fifo_ledger(sku, date_utc_ms);
+CREATE INDEX IF NOT EXISTS ix_lines_sku_date ON public.bridge_lines(sku, date_utc_ms);
@@ -0,0 +1,114 @@
+-- Core schema (local SQLite fallback, DB_PATH). Mirrors migrations/20261018_01_core_schema.sql.
+-- ALTER TABLE ... ADD COLUMN has no IF NOT EXISTS in SQLite: the runner skips
+-- "duplicate column name" errors, so these statements are safe on existing files.
+
+CREATE TABLE IF NOT EXISTS products(
+    sku TEXT PRIMARY KEY,
+    name TEXT,
+    brand TEXT,
+    category TEXT,
+    price REAL,
+    quantity INTEGER,
+    active INTEGER DEFAULT 1,
+    barcode TEXT,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS batches(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sku TEXT NOT NULL,
+    date TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    unit_cost REAL NOT NULL,
+    note TEXT,
+    commission_pct REAL,
+    batch_code TEXT UNIQUE,
+    qty_sold INTEGER DEFAULT 0,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+-- таблица могла быть создана старым bridge_v2 в урезанном виде (без qty, с NOT NULL
+-- commission_pct): добиваем недостающие колонки и один раз пересобираем таблицу
+ALTER TABLE batches ADD COLUMN qty INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE batches ADD COLUMN note TEXT;
+ALTER TABLE batches ADD COLUMN commission_pct REAL;
+ALTER TABLE batches ADD COLUMN batch_code TEXT;
+ALTER TABLE batches ADD COLUMN qty_sold INTEGER DEFAULT 0;
+ALTER TABLE batches ADD COLUMN created_at TEXT;
+
+CREATE TABLE batches__rebuild(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sku TEXT NOT NULL,
+    date TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    unit_cost REAL NOT NULL,
+    note TEXT,
+    commission_pct REAL,
+    batch_code TEXT UNIQUE,
+    qty_sold INTEGER DEFAULT 0,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO batches__rebuild(id, sku, date, qty, unit_cost, note, commission_pct, batch_code, qty_sold, created_at)
+SELECT id, sku, COALESCE(date, ''), COALESCE(qty, 0), COALESCE(unit_cost, 0), note, commission_pct,
+       NULLIF(batch_code, ''), COALESCE(qty_sold, 0), created_at
+  FROM batches;
+DROP TABLE batches;
+ALTER TABLE batches__rebuild RENAME TO batches;
+
+CREATE TABLE IF NOT EXISTS categories(
+    name TEXT PRIMARY KEY,
+    base_percent REAL DEFAULT 0.0,
+    extra_percent REAL DEFAULT 3.0,
+    tax_percent REAL DEFAULT 0.0
+);
+
+CREATE INDEX IF NOT EXISTS idx_batches_sku ON batches(sku);
+CREATE INDEX IF NOT EXISTS idx_batches_date ON batches(date);
+
+UPDATE batches SET batch_code = upper(substr(hex(randomblob(4)), 1, 6))
+ WHERE batch_code IS NULL OR batch_code = '';
+
+DELETE FROM products
+ WHERE rowid NOT IN (SELECT MIN(rowid) FROM products GROUP BY sku);
+
+INSERT OR IGNORE INTO categories(name, base_percent, extra_percent, tax_percent)
+SELECT v.column1, v.column2, v.column3, v.column4
+  FROM (VALUES
+        ('Витамины/БАДы',   10.0, 3.0, 0.0),
+        ('Сад/освещение',   10.0, 3.0, 0.0),
+        ('Товары для дома', 10.0, 3.0, 0.0),
+        ('Прочее',          10.0, 3.0, 0.0)
+       ) AS v
+ WHERE NOT EXISTS (SELECT 1 FROM categories);
+
+CREATE TABLE IF NOT EXISTS sku_inventory_summary(
+    sku TEXT PRIMARY KEY,
+    batch_count INTEGER NOT NULL DEFAULT 0,
+    left_qty INTEGER NOT NULL DEFAULT 0,
+    left_cost REAL NOT NULL DEFAULT 0,
+    last_unit_cost REAL,
+    last_commission_pct REAL,
+    updated_at TEXT
+);
+
+-- заполняется шагом данных после этого файла (app.services.migrations → sku_summary.upsert_sql)
+
+CREATE TABLE IF NOT EXISTS bridge_lines(
+    order_id     text NOT NULL,
+    order_code   text,
+    state        text,
+    date_utc_ms  integer,
+    sku          text,
+    title        text,
+    qty          integer DEFAULT 1,
+    unit_price   real DEFAULT 0,
+    total_price  real DEFAULT 0,
+    line_index   integer NOT NULL,
+    created_at   integer,
+    updated_at   integer,
+    PRIMARY KEY(order_id, line_index)
+);
+CREATE INDEX IF NOT EXISTS ix_lines_date  ON bridge_lines(date_utc_ms);
+CREATE INDEX IF NOT EXISTS ix_lines_state ON bridge_lines(state);
+CREATE INDEX IF NOT EXISTS ix_lines_sku   ON bridge_lines(sku);
+CREATE INDEX IF NOT EXISTS ix_lines_code  ON bridge_lines(order_code);
@@ -0,0 +1,10 @@
+-- Shared process state (jobs, caches) for STATE_BACKEND=db, see app/services/state.py.
+-- expires_at — unix time (seconds).
+CREATE TABLE IF NOT EXISTS app_state(
+    ns         TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    value      TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS idx_app_state_expires ON app_state(expires_at);
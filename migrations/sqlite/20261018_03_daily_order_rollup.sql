@@ -0,0 +1,23 @@
+-- Per-day order rollups for /orders/analytics, see app/services/rollup.py.
+-- Mirrors migrations/20261018_03_daily_order_rollup.sql; day — ISO date, built_at — unix time.
+CREATE TABLE IF NOT EXISTS daily_order_rollup(
+    tenant      TEXT NOT NULL,
+    assign_mode TEXT NOT NULL,
+    variant     TEXT NOT NULL,
+    day         TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    city        TEXT NOT NULL DEFAULT '',
+    orders      INTEGER NOT NULL,
+    amount      REAL NOT NULL,
+    PRIMARY KEY (tenant, assign_mode, variant, day, state, city)
+);
+
+CREATE TABLE IF NOT EXISTS daily_order_rollup_days(
+    tenant      TEXT NOT NULL,
+    assign_mode TEXT NOT NULL,
+    variant     TEXT NOT NULL,
+    day         TEXT NOT NULL,
+    frozen      INTEGER NOT NULL DEFAULT 0,
+    built_at    REAL NOT NULL,
+    PRIMARY KEY (tenant, assign_mode, variant, day)
+);
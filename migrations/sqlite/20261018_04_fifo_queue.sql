@@ -0,0 +1,12 @@
+-- SKUs waiting for an incremental FIFO replay, see app/services/fifo_queue.py.
+-- Mirrors migrations/20261018_04_fifo_queue.sql; since_batch — ISO date, queued_at — unix time.
+-- Kept for schema parity only: the FIFO ledger lives in PostgreSQL, so fifo_queue.enqueue
+-- does not write here and the table stays empty.
+CREATE TABLE IF NOT EXISTS fifo_queue(
+    sku         TEXT PRIMARY KEY,
+    since_ms    INTEGER,
+    since_batch TEXT,
+    queued_at   REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_lines_sku_date ON bridge_lines(sku, date_utc_ms);